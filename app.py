@@ -1,31 +1,137 @@
-"""Flask App for Flask Cafe."""
+"""Flask App for Flask Cafe.
 
+Make the app with create_app(); `flask run` does so for you, with the
+profile named by $FLASK_CAFE_CONFIG (see config.py).
+"""
 
-from flask import Flask, render_template, request, flash, jsonify
-from flask import redirect, session, g
-from flask_debugtoolbar import DebugToolbarExtension
+import time
 
-from models import db, connect_db, Cafe, City, User, UserLikesCafe
+# for reporting how long we take to start up
+STARTED = time.perf_counter()
+
+import logging
+import os
+import threading
+
+from flask import Flask, Blueprint, render_template, request, flash, jsonify
+from flask import redirect, session, g, abort, current_app
+from markupsafe import Markup
+
+from config import PROFILES
+from models import db, connect_db, Cafe, User, UserLikesCafe
+from models import UserIdentity, CatalogVersion, city_registry
 from forms import AddOrEditCafeForm, SignupForm, LoginForm, ProfileEditForm
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
+from pagination import InvalidCursor
+from jobs import job_queue
+from maps import queue_map_fetch
+from mapcache import map_cache
+from mapquest import mapquest
+from commands import backfill_maps, generate_data, import_cafes
+from commands import rebuild_recommendations, reconcile_like_counts
+from caching import TTLCache
+from search import cafe_search
+from geo import nearby_cafes
+from likebuffer import like_buffer
+from recommend import recommender
+from pagecache import page_cache
+from etags import etags
+from instrumentation import sql_instrumentation
+from passwords import PasswordHasherBusy, password_hasher
+from ratelimit import rate_limiter
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+views = Blueprint('views', __name__)
+
+
+def create_app(config=None):
+    """Make the Flask Cafe app.
+
+    config is a profile name from config.PROFILES (by default,
+    $FLASK_CAFE_CONFIG, or 'dev'), or a config object.
+
+    Make one app per process: the extensions (job_queue, rate_limiter,
+    recommender...) are module-level singletons, and refuse to attach to
+    a second app (see extensions.attach).
+    """
+
+    created = time.perf_counter()
+
+    if config is None:
+        config = os.environ.get('FLASK_CAFE_CONFIG', 'dev')
+    if isinstance(config, str):
+        config = PROFILES[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    if not app.config['SECRET_KEY']:
+        raise RuntimeError("Set FLASK_SECRET_KEY in the environment")
+
+    if app.config['DEBUG_TOOLBAR']:
+        # imported here so production never loads it
+        from flask_debugtoolbar import DebugToolbarExtension
+        DebugToolbarExtension(app)
+
+    connect_db(app)
+    # first, so rejected requests cost as little as possible
+    rate_limiter.init_app(app, user_key=CURR_USER_KEY)
+    sql_instrumentation.init_app(app)
+    job_queue.init_app(app)
+    map_cache.init_app(app)
+    mapquest.init_app(app)
+    cafe_search.init_app(app)
+    nearby_cafes.init_app(app)
+    recommender.init_app(app)
+    page_cache.init_app(app)
+    etags.init_app(app)
+    password_hasher.init_app(app)
+    like_buffer.init_app(app, user_key=CURR_USER_KEY)
+
+    user_cache.maxsize = app.config['USER_CACHE_SIZE']
 
+    app.register_blueprint(views)
 
+    app.cli.add_command(backfill_maps)
+    app.cli.add_command(reconcile_like_counts)
+    app.cli.add_command(import_cafes)
+    app.cli.add_command(generate_data)
+    app.cli.add_command(rebuild_recommendations)
 
+    ready = time.perf_counter()
+    startup_lock = threading.Lock()
 
-from secrets import FLASK_SECRET_KEY
+    @app.before_request
+    def report_startup_time():
+        """On the first request, log how long we took to get to it."""
 
+        if 'startup_times' in app.extensions:
+            return
 
-app = Flask(__name__)
+        first_request = time.perf_counter()
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres:///flaskcafe'
-app.config['SECRET_KEY'] = FLASK_SECRET_KEY
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = True
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
+        with startup_lock:
+            if 'startup_times' in app.extensions:
+                return
 
-toolbar = DebugToolbarExtension(app)
+            times = app.extensions['startup_times'] = {
+                'imports': created - STARTED,
+                'create_app': ready - created,
+                'first_request': first_request - STARTED,
+            }
 
-connect_db(app)
+        logger.info(
+            "First request %.0f ms after import "
+            "(imports %.0f ms, create_app %.0f ms)",
+            times['first_request'] * 1000, times['imports'] * 1000,
+            times['create_app'] * 1000)
+
+    return app
 
 
 #######################################
@@ -34,13 +140,71 @@ connect_db(app)
 CURR_USER_KEY = "user_id"
 NOT_LOGGED_IN_MSG = "You are not logged in."
 
+# ?sort= options for the cafe listing -> label
+CAFE_SORTS = {
+    'name': 'Name',
+    'popular': 'Most liked',
+}
+
+# ?sort= options for a user's favorite cafes -> label
+FAVORITE_SORTS = {
+    'recent': 'Recently liked',
+    'name': 'Name',
+}
+
+
+# user id -> UserIdentity, so we needn't query for the user every request
+user_cache = TTLCache()
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def note_edited_user(mapper, connection, user):
+    """Note a user's been edited (incl. made admin), to forget on commit.
+
+    Not before: until then, other requests could cache the old row again.
+    """
+
+    session = Session.object_session(user)
+    session.info.setdefault('edited_users', set()).add(user.id)
+
+
+@event.listens_for(Session, 'after_commit')
+def forget_cached_users(session):
+    for user_id in session.info.pop('edited_users', ()):
+        user_cache.pop(user_id)
 
-@app.before_request
+
+@event.listens_for(Session, 'after_rollback')
+def forget_edited_users(session):
+    session.info.pop('edited_users', None)
+
+
+def get_user_identity(user_id):
+    """Return UserIdentity for user id, from cache if we can."""
+
+    ttl = current_app.config['USER_CACHE_TTL']
+    identity = user_cache.get(user_id) if ttl else None
+
+    if identity is None:
+        identity = UserIdentity.load(user_id)
+
+        if identity and ttl:
+            user_cache.set(user_id, identity, ttl)
+
+    return identity
+
+
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is a UserIdentity; routes that need the whole User should call
+    g.user.get_user().
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = get_user_identity(session[CURR_USER_KEY])
 
     else:
         g.user = None
@@ -59,12 +223,81 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
+#######################################
+# validators for conditional GETs (see etags.py)
+#
+# Each returns (parts identifying the response, last modified) cheaply,
+# before the view renders anything.
+
+
+def viewer():
+    """Who's asking, as far as shared page parts (like the navbar) go."""
+
+    if g.user:
+        return (g.user.id, g.user.get_full_name(), g.user.admin)
+
+
+def cache_epoch():
+    """Return (number, start) of the current PAGE_CACHE_TTL-long period.
+
+    For validating responses showing things that change without bumping
+    any version, like like counts & recommendations: they're revalidated
+    at least once a period.
+    """
+
+    max_age = current_app.config['PAGE_CACHE_TTL']
+    epoch = int(time.time() // max_age)
+
+    return epoch, datetime.utcfromtimestamp(epoch * max_age)
+
+
+def catalog_validator(*names, like_counts=False):
+    """Validate a response depending on whole collections of cafes/cities.
+
+    Like counts aren't part of the catalog version; if the response shows
+    them, it's revalidated every cache epoch instead.
+
+    Returns None (don't validate) if a version row is missing.
+    """
+
+    versions = CatalogVersion.get(*names)
+
+    if len(versions) < len(names):
+        return None
+
+    last_modified = max(updated_at for _, updated_at in versions.values())
+    parts = [sorted(versions.items()), request.full_path, viewer()]
+
+    if like_counts:
+        epoch, started = cache_epoch()
+        parts.append(epoch)
+        last_modified = max(last_modified, started)
+
+    return parts, last_modified
+
+
+def user_validator(*parts):
+    """Validate a response depending on the current user's likes & more."""
+
+    if not g.user:
+        return None
+
+    revision, updated_at, likes_version, likes_updated_at = (
+        db.session
+        .query(User.revision, User.updated_at,
+               User.likes_version, User.likes_updated_at)
+        .filter_by(id=g.user.id)
+        .one())
+
+    return ([revision, likes_version, request.full_path, viewer(), *parts],
+            max(updated_at, likes_updated_at))
 
 
 #######################################
 # homepage
 
-@app.route("/")
+@views.route("/")
+@page_cache.cached(tags=lambda: [])
 def homepage():
     """Show homepage."""
 
@@ -75,36 +308,126 @@ def homepage():
 # cafes
 
 
-@app.route('/cafes')
+def get_page_size():
+    """Return page size requested in query string, clamped to our limits."""
+
+    default = current_app.config['CAFES_PER_PAGE']
+    limit = request.args.get('limit', default, type=int)
+
+    return max(1, min(limit, current_app.config['CAFES_MAX_PER_PAGE']))
+
+
+@views.route('/cafes')
+@etags.conditional(
+    lambda: catalog_validator('cafes', 'cities', like_counts=True))
+@page_cache.cached(tags=lambda: ['cafes', 'cities'])
 def cafe_list():
-    """Return list of all cafes."""
+    """Return a page of cafes, ordered by name or (?sort=popular) likes.
+
+    Pages are selected with ?after=<cursor> or ?before=<cursor>.
+    """
 
-    cafes = Cafe.query.order_by('name').all()
+    limit = get_page_size()
+    sort = request.args.get('sort', 'name')
+
+    if sort not in CAFE_SORTS:
+        abort(400)
+
+    try:
+        cafes = Cafe.get_list_page(
+            limit,
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            sort=sort,
+        )
+    except InvalidCursor:
+        abort(400)
 
     return render_template(
         'cafe/list.html',
         cafes=cafes,
+        limit=limit,
+        sort=sort,
+        sorts=CAFE_SORTS,
     )
 
-@app.route('/cafes/<int:cafe_id>')
+@views.route('/cafes/search')
+def search_cafes():
+    """Show cafes matching ?q=, best matches first."""
+
+    q = request.args.get('q', '').strip()
+    cafes = cafe_search.search(q) if q else []
+
+    return render_template(
+        'cafe/search.html',
+        cafes=cafes,
+        q=q,
+    )
+
+def cafe_detail_tags(cafe_id):
+    """Cache tags for a cafe's detail page."""
+
+    return [f'cafe:{cafe_id}', 'cafe:*', 'cities']
+
+def cafe_detail_validator(cafe_id):
+    """Validator for a cafe's detail page (None if there's no such cafe)."""
+
+    cafe = (db.session.query(Cafe.revision, Cafe.updated_at)
+            .filter_by(id=cafe_id).first())
+
+    if cafe is None:
+        return None
+
+    cities = CatalogVersion.get('cities').get('cities')
+
+    if cities is None:
+        return None
+
+    # for the similar cafes
+    epoch, started = cache_epoch()
+
+    return ([cafe_id, cafe.revision, cities, viewer(), epoch],
+            max(cafe.updated_at, cities[1], started))
+
+@views.route('/cafes/<int:cafe_id>')
+@etags.conditional(cafe_detail_validator)
+@page_cache.cached(tags=cafe_detail_tags)
 def cafe_detail(cafe_id):
-    """Show detail for cafe."""
+    """Show detail for cafe.
 
-    cafe = Cafe.query.get_or_404(cafe_id)
+    The page body is the same for everyone, so it's cached for logged-in
+    users too; their like button & admin links are filled in by script.js
+    from /api/cafes/<cafe_id>/state.
+    """
+
+    def render_body():
+        cafe = Cafe.query.get_or_404(cafe_id)
+        return cafe.name, render_template(
+            'cafe/_detail.html',
+            cafe=cafe,
+            similar=recommender.similar_cafes(cafe_id),
+        )
+
+    name, body = page_cache.fragment(
+        f'cafe-detail:{cafe_id}',
+        cafe_detail_tags(cafe_id),
+        render_body,
+    )
 
     return render_template(
         'cafe/detail.html',
-        cafe=cafe,
+        name=name,
+        body=Markup(body),
     )
 
-@app.route('/cafes/add', methods=['GET', 'POST'])
+@views.route('/cafes/add', methods=['GET', 'POST'])
 def add_cafe_form():
     """ GET: show add cafe form, POST: adds cafe to database"""
     if not g.user or not g.user.admin:
         return 'not authorized', 401
 
     form = AddOrEditCafeForm()
-    form.city_code.choices = db.session.query(City.code, City.name).all()
+    form.city_code.choices = city_registry.choices()
 
     if form.validate_on_submit():
         name = form.name.data
@@ -125,8 +448,7 @@ def add_cafe_form():
         
         db.session.add(cafe)
         db.session.commit()
-        cafe.save_map()
-
+        queue_map_fetch(cafe)
 
         flash(f'{name} added')
         return redirect(f'/cafes/{cafe.id}')
@@ -134,7 +456,7 @@ def add_cafe_form():
         return render_template('cafe/add-form.html', form=form)
 
 
-@app.route('/cafes/<cafe_id>/edit', methods=['GET', 'POST'])
+@views.route('/cafes/<cafe_id>/edit', methods=['GET', 'POST'])
 def edit_cafe_form(cafe_id):
     """ GET: show cafe edit form, POST: update cafe details """
     if not g.user or not g.user.admin:
@@ -143,7 +465,7 @@ def edit_cafe_form(cafe_id):
     cafe = Cafe.query.get_or_404(cafe_id)
 
     form = AddOrEditCafeForm(obj=cafe)
-    form.city_code.choices = db.session.query(City.code, City.name).all()
+    form.city_code.choices = city_registry.choices()
 
     if form.validate_on_submit():
         name = form.name.data
@@ -160,16 +482,21 @@ def edit_cafe_form(cafe_id):
         cafe.city_code = city_code
         cafe.image_url = image_url
 
-
         db.session.commit()
-        cafe.save_map()
+
+        # only refetch the map (and geocode) if the cafe has moved
+        if not cafe.map_is_current():
+            cafe.map_status = 'pending'
+            cafe.latitude = cafe.longitude = None
+            db.session.commit()
+            queue_map_fetch(cafe)
 
         flash(f'{name} edited')
         return redirect(f'/cafes/{cafe.id}')
     else:
         return render_template('cafe/edit-form.html', form=form)
 
-@app.route('/signup', methods=['GET', 'POST'])
+@views.route('/signup', methods=['GET', 'POST'])
 def signup_user():
     """ Registers user """
 
@@ -204,7 +531,7 @@ def signup_user():
     else:
         return render_template('auth/signup-form.html', form=form)
 
-@app.route('/login', methods=['GET', 'POST'])
+@views.route('/login', methods=['GET', 'POST'])
 def login_user():
     """ Logs in user """
     form = LoginForm()
@@ -216,6 +543,8 @@ def login_user():
         user = User.authenticate(username, password)
 
         if user:
+            # saves the password's hash, if it was re-hashed
+            db.session.commit()
             do_login(user)
             flash(f'Hello, {username}!')
             return redirect("/cafes")
@@ -225,7 +554,7 @@ def login_user():
 
     return render_template('auth/login-form.html', form=form)
 
-@app.route('/logout', methods=['POST'])
+@views.route('/logout', methods=['POST'])
 def logout_user():
     """ Logs user out """
     do_logout()
@@ -233,24 +562,74 @@ def logout_user():
     flash('You should have successfully logged out.')
     return redirect('/cafes')
 
-@app.route('/profile')
+def profile_validator():
+    """Validator for the profile page; its picks change every cache epoch."""
+
+    epoch, started = cache_epoch()
+    validated = user_validator(CatalogVersion.get('cafes', 'cities'), epoch)
+
+    if validated is None:
+        return None
+
+    parts, last_modified = validated
+
+    return parts, max(last_modified, started)
+
+@views.route('/profile')
+@etags.conditional(profile_validator)
 def show_profile():
-    """ show user profile """
+    """ show user profile, with a page of their favorite cafes and
+        cafes picked for them
+
+        Favorites are paged like the cafe listing (?sort=, ?after=,
+        ?before=, ?limit=); script.js loads more from /api/profile/likes.
+    """
     if not g.user:
         flash(NOT_LOGGED_IN_MSG)
         return redirect('/login')
-    else:
-        return render_template('profile/detail.html')
 
+    limit = get_page_size()
+    sort = request.args.get('sort', 'recent')
 
-@app.route('/profile/edit', methods=['GET', 'POST'])
+    if sort not in FAVORITE_SORTS:
+        abort(400)
+
+    try:
+        favorites = get_favorites_page(limit, sort)
+    except InvalidCursor:
+        abort(400)
+
+    return render_template(
+        'profile/detail.html',
+        user=g.user.get_user(),
+        favorites=favorites,
+        picks=recommender.picks(g.user.id),
+        limit=limit,
+        sort=sort,
+        sorts=FAVORITE_SORTS,
+    )
+
+
+def get_favorites_page(limit, sort):
+    """Return the page of the current user's favorites asked for."""
+
+    return g.user.liked_cafes_page(
+        limit,
+        after=request.args.get('after'),
+        before=request.args.get('before'),
+        sort=sort,
+    )
+
+
+@views.route('/profile/edit', methods=['GET', 'POST'])
 def edit_profile():
     """ GET: show profile edit form, POST: updates user profile """
     if not g.user:
         flash(NOT_LOGGED_IN_MSG)
         return redirect('/login')
 
-    form = ProfileEditForm(obj=g.user)
+    user = g.user.get_user()
+    form = ProfileEditForm(obj=user)
 
     if form.validate_on_submit():
         first_name = form.first_name.data
@@ -259,11 +638,11 @@ def edit_profile():
         email = form.email.data
         image_url = form.image_url.data
 
-        g.user.first_name=first_name
-        g.user.last_name=last_name
-        g.user.description=description
-        g.user.email=email
-        g.user.image_url=image_url
+        user.first_name=first_name
+        user.last_name=last_name
+        user.description=description
+        user.email=email
+        user.image_url=image_url
 
         db.session.commit()
 
@@ -273,22 +652,103 @@ def edit_profile():
     else:
         return render_template('profile/edit-form.html', form=form)
 
-@app.route('/api/likes')
+@views.route('/api/likes')
+@etags.conditional(user_validator)
 def check_if_user_likes_cafe():
-    """ Check if user has liked cafe
+    """ Check if user has liked cafe, or several cafes at once
+
+        ?cafe_id=1 returns JSON: {likes: true}
+        ?cafe_ids=1,2,3 returns JSON: {likes: {"1": true, "2": false, ...}}
 
         Returns JSON: {error}
     """
     if not g.user:
         return jsonify(error="Not logged in")
-    
+
+    if 'cafe_ids' in request.args:
+        try:
+            cafe_ids = [
+                int(cafe_id)
+                for cafe_id in request.args['cafe_ids'].split(',')
+                if cafe_id
+            ]
+        except ValueError:
+            return jsonify(error="Invalid cafe id"), 400
+
+        if len(cafe_ids) > current_app.config['LIKES_BULK_MAX']:
+            return jsonify(error="Too many cafe ids"), 400
+
+        liked = g.user.liked_cafe_ids(cafe_ids)
+
+        return jsonify(likes={
+            str(cafe_id): cafe_id in liked for cafe_id in cafe_ids
+        })
+
     cafe_id = request.args['cafe_id']
     
     return jsonify(likes=g.user.has_liked(cafe_id))
 
-@app.route('/api/like', methods=['POST'])
+@views.route('/api/profile/likes')
+@etags.conditional(
+    lambda: user_validator(CatalogVersion.get('cafes', 'cities')))
+def profile_likes_api():
+    """ A page of the user's favorite cafes, paged like /profile
+
+        Returns JSON: {cafes: [{id, name, url, image_url, address,
+        description, liked_at}, ...], next: cursor or null} or {error}
+    """
+
+    if not g.user:
+        return jsonify(error="Not logged in")
+
+    sort = request.args.get('sort', 'recent')
+
+    if sort not in FAVORITE_SORTS:
+        return jsonify(error="Invalid sort"), 400
+
+    try:
+        favorites = get_favorites_page(get_page_size(), sort)
+    except InvalidCursor:
+        return jsonify(error="Invalid cursor"), 400
+
+    return jsonify(
+        cafes=[
+            dict(
+                id=cafe.id,
+                name=cafe.name,
+                url=f'/cafes/{cafe.id}',
+                image_url=cafe.image_url,
+                address=cafe.address,
+                description=cafe.description,
+                liked_at=cafe.liked_at.isoformat(),
+            )
+            for cafe in favorites
+        ],
+        next=favorites.next_cursor,
+    )
+
+@views.route('/api/cafes/<int:cafe_id>/state')
+@etags.conditional(lambda cafe_id: user_validator())
+def cafe_user_state(cafe_id):
+    """ Per-user parts of the cafe detail page
+
+        Returns JSON: {liked: true/false, admin: true/false} or {error}
+    """
+
+    if not g.user:
+        return jsonify(error="Not logged in")
+
+    return jsonify(
+        liked=g.user.has_liked(cafe_id),
+        admin=g.user.admin,
+    )
+
+@views.route('/api/like', methods=['POST'])
 def like_cafe():
-    """ Likes a post, stores the 'like' in database
+    """ Likes a post, stores the 'like' in database (or, with
+        LIKE_BUFFER, buffers it to be stored shortly)
+
+        Liking an already-liked cafe is a no-op.
 
         Returns JSON: {error}
     """
@@ -296,17 +756,31 @@ def like_cafe():
     if not g.user:
         return jsonify(error="Not logged in")
 
-    cafe_id = request.json['cafe_id']
+    try:
+        cafe_id = int(request.json['cafe_id'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    if like_buffer.enabled:
+        if db.session.query(Cafe.id).filter_by(id=cafe_id).first() is None:
+            abort(404)
+        like_buffer.add(g.user.id, cafe_id, True)
+        return jsonify(liked=cafe_id)
 
-    g.user.liked_cafes.append(Cafe.query.get_or_404(cafe_id))
+    if not UserLikesCafe.like(g.user.id, cafe_id):
+        if not g.user.has_liked(cafe_id):
+            abort(404)
 
     db.session.commit()
 
     return jsonify(liked=cafe_id)
 
-@app.route('/api/unlike', methods=['POST'])
+@views.route('/api/unlike', methods=['POST'])
 def unlike_cafe():
-    """ Unlikes a post, delete the 'like' from database
+    """ Unlikes a post, delete the 'like' from database (or, with
+        LIKE_BUFFER, buffers it to be deleted shortly)
+
+        Unliking a cafe that isn't liked is a no-op.
 
         Returns JSON: {error}
     """
@@ -314,14 +788,131 @@ def unlike_cafe():
     if not g.user:
         return jsonify(error="Not logged in")
 
-    cafe_id = request.json['cafe_id']
-
-    g.user.liked_cafes.remove(Cafe.query.get_or_404(cafe_id))
+    try:
+        cafe_id = int(request.json['cafe_id'])
+    except (KeyError, TypeError, ValueError):
+        abort(400)
 
-    db.session.commit()
+    if like_buffer.enabled:
+        like_buffer.add(g.user.id, cafe_id, False)
+    else:
+        UserLikesCafe.unlike(g.user.id, cafe_id)
+        db.session.commit()
 
     return jsonify(unliked=cafe_id)
 
-@app.errorhandler(404)
+def is_like_op(op):
+    """Is op a valid {cafe_id, action} for batch_like_cafes?"""
+
+    return (isinstance(op, dict)
+            and type(op.get('cafe_id')) is int
+            and op.get('action') in ('like', 'unlike'))
+
+@views.route('/api/likes/batch', methods=['POST'])
+def batch_like_cafes():
+    """ Applies many likes/unlikes, in order, in one transaction (or,
+        with LIKE_BUFFER, buffers them)
+
+        Expects JSON: {ops: [{cafe_id, action: "like" | "unlike"}, ...]}
+
+        Returns JSON: {liked: [cafe_id, ...], unliked: [cafe_id, ...]}
+        listing each cafe's final state (cafes that don't exist are
+        skipped), or {error}
+    """
+
+    if not g.user:
+        return jsonify(error="Not logged in")
+
+    body = request.json or {}
+
+    if not isinstance(body, dict):
+        return jsonify(error="Invalid operation"), 400
+
+    ops = body.get('ops', [])
+
+    if not isinstance(ops, list) or not all(map(is_like_op, ops)):
+        return jsonify(error="Invalid operation"), 400
+
+    if len(ops) > current_app.config['LIKES_BULK_MAX']:
+        return jsonify(error="Too many operations"), 400
+
+    # only the last operation on each cafe matters
+    final = {op['cafe_id']: op['action'] for op in ops}
+    existing = {id for (id,) in (db.session.query(Cafe.id)
+                                 .filter(Cafe.id.in_(final)))}
+    final = {id: action for id, action in final.items() if id in existing}
+
+    for cafe_id, action in final.items():
+        if like_buffer.enabled:
+            like_buffer.add(g.user.id, cafe_id, action == 'like')
+        elif action == 'like':
+            UserLikesCafe.like(g.user.id, cafe_id)
+        else:
+            UserLikesCafe.unlike(g.user.id, cafe_id)
+
+    if not like_buffer.enabled:
+        db.session.commit()
+
+    return jsonify(
+        liked=[id for id, action in final.items() if action == 'like'],
+        unliked=[id for id, action in final.items() if action == 'unlike'],
+    )
+
+@views.route('/api/cafes/search')
+@etags.conditional(lambda: catalog_validator('cafes', 'cities'))
+def search_cafes_api():
+    """ Search cafes matching ?q= (up to ?limit=), best matches first
+
+        Returns JSON: {cafes: [{id, name, city, url, image_url}, ...]}
+    """
+
+    q = request.args.get('q', '').strip()
+    limit = request.args.get('limit', type=int)
+    cafes = cafe_search.search(q, limit) if q else []
+
+    return jsonify(cafes=[
+        dict(
+            id=cafe.id,
+            name=cafe.name,
+            city=cafe.get_city_state(),
+            url=f'/cafes/{cafe.id}',
+            image_url=cafe.image_url,
+        )
+        for cafe in cafes
+    ])
+
+@views.route('/api/cafes/nearby')
+@etags.conditional(lambda: catalog_validator('cafes', 'cities'))
+def nearby_cafes_api():
+    """ Find the ?k= cafes nearest ?lat= & ?lng=, nearest first
+
+        Returns JSON: {cafes: [{id, name, city, url, distance_km}, ...]}
+        or {error}
+    """
+
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    k = request.args.get('k', 10, type=int)
+
+    if lat is None or lng is None or not (-90 <= lat <= 90
+                                          and -180 <= lng <= 180):
+        return jsonify(error="Invalid lat/lng"), 400
+
+    return jsonify(cafes=[
+        dict(
+            id=cafe.id,
+            name=cafe.name,
+            city=cafe.get_city_state(),
+            url=f'/cafes/{cafe.id}',
+            distance_km=round(distance, 3),
+        )
+        for cafe, distance in nearby_cafes.nearest(lat, lng, k)
+    ])
+
+@views.app_errorhandler(404)
 def page_not_found(e):
-    return render_template('404.html'), 404
\ No newline at end of file
+    return render_template('404.html'), 404
+
+@views.app_errorhandler(PasswordHasherBusy)
+def too_busy(e):
+    return render_template('503.html'), 503, {'Retry-After': '1'}
\ No newline at end of file
@@ -0,0 +1,443 @@
+"""Route-level benchmarks for Flask Cafe.
+
+Drives each route in app.py with a seeded mix of requests, either
+through the Flask test client (no network; shows the app's own cost) or
+through a real threaded WSGI server over HTTP. For each route it reports
+throughput, latency percentiles and how many SQL statements a request
+runs. Results can be saved, and compared against a saved baseline:
+
+    python bench.py --database postgresql:///flaskcafe-bench --generate
+    python bench.py --mode server --concurrency 8 --save baseline.json
+    python bench.py --mode server --concurrency 8 --baseline baseline.json
+
+Comparing exits with status 1 if any route got slower (or runs more SQL)
+than the baseline allows.
+"""
+
+import json
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import requests
+from sqlalchemy import event
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import create_app
+from commands import generate_data
+from config import ProductionConfig
+from models import db, Cafe
+from pagination import encode_cursor
+
+
+class BenchmarkConfig(ProductionConfig):
+    """Production settings, minus secrets, the network & rate limits."""
+
+    SECRET_KEY = 'benchmark'
+    RATE_LIMITS = {}
+    WTF_CSRF_ENABLED = False
+    JOB_QUEUE_BACKEND = 'inline'
+    GEOCODER = 'gazetteer'
+
+
+class Scenario:
+    """A kind of request to benchmark.
+
+    make(rng, data) returns (method, path, json body or form dict).
+    Requests are sent as `who`: 'anonymous', 'user' (logged in), or
+    'fresh' (a new client each time, with no cookies). weight scales how
+    many requests of this kind are made.
+    """
+
+    def __init__(self, name, make, who='anonymous', weight=1.0):
+        self.name = name
+        self.make = make
+        self.who = who
+        self.weight = weight
+
+
+def like_or_unlike(rng, data):
+    action = rng.choice(['like', 'unlike'])
+    return 'POST', f'/api/{action}', {'cafe_id': rng.choice(data.cafe_ids)}
+
+
+def batch_likes(rng, data):
+    ops = [dict(cafe_id=rng.choice(data.cafe_ids),
+                action=rng.choice(['like', 'unlike']))
+           for _ in range(5)]
+    return 'POST', '/api/likes/batch', {'ops': ops}
+
+
+def likes_for_page(rng, data):
+    ids = ','.join(str(rng.choice(data.cafe_ids)) for _ in range(24))
+    return 'GET', f'/api/likes?cafe_ids={ids}', None
+
+
+SCENARIOS = [
+    Scenario('home', lambda rng, data: ('GET', '/', None)),
+    Scenario('cafe_list', lambda rng, data: ('GET', '/cafes', None)),
+    Scenario('cafe_list_popular',
+             lambda rng, data: ('GET', '/cafes?sort=popular', None)),
+    Scenario('cafe_list_deep', lambda rng, data: (
+        'GET', f'/cafes?after={rng.choice(data.cursors)}', None)),
+    Scenario('cafe_detail', lambda rng, data: (
+        'GET', f'/cafes/{rng.choice(data.cafe_ids)}', None)),
+    Scenario('cafe_detail_user', lambda rng, data: (
+        'GET', f'/cafes/{rng.choice(data.cafe_ids)}', None),
+        who='user'),
+    Scenario('cafe_search', lambda rng, data: (
+        'GET', f'/cafes/search?q={rng.choice(data.words)}', None)),
+    Scenario('api_search', lambda rng, data: (
+        'GET', f'/api/cafes/search?q={rng.choice(data.words)}', None)),
+    Scenario('api_nearby', lambda rng, data: (
+        'GET', '/api/cafes/nearby?lat={:.4f}&lng={:.4f}'.format(
+            *rng.choice(data.locations)), None)),
+    Scenario('login', lambda rng, data: (
+        'POST', '/login',
+        {'username': data.username, 'password': data.password}),
+        who='fresh', weight=0.1),
+    Scenario('profile', lambda rng, data: ('GET', '/profile', None),
+             who='user'),
+    Scenario('api_cafe_state', lambda rng, data: (
+        'GET', f'/api/cafes/{rng.choice(data.cafe_ids)}/state', None),
+        who='user'),
+    Scenario('api_likes', likes_for_page, who='user'),
+    Scenario('api_like', like_or_unlike, who='user'),
+    Scenario('api_likes_batch', batch_likes, who='user'),
+]
+
+
+class Dataset:
+    """What the scenarios pick their cafes, users, etc. from."""
+
+    def __init__(self, username, password, sample_size=1000, seed=0):
+        rng = random.Random(seed)
+        rows = (Cafe.query
+                .with_entities(Cafe.id, Cafe.name, Cafe.latitude,
+                               Cafe.longitude)
+                .order_by(Cafe.id)
+                .all())
+
+        if not rows:
+            raise click.ClickException(
+                "No cafes to benchmark; run with --generate.")
+
+        sample = rng.sample(rows, min(sample_size, len(rows)))
+
+        self.username = username
+        self.password = password
+        self.cafe_ids = [row.id for row in sample]
+        self.cursors = [encode_cursor([row.name, row.id]) for row in sample]
+        self.words = sorted({word.lower() for row in sample
+                             for word in row.name.split()})
+        self.locations = [(row.latitude, row.longitude) for row in sample
+                          if row.latitude is not None] or [(37.77, -122.42)]
+
+
+class StatementCounter:
+    """Counts SQL statements run by an engine."""
+
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        with self._lock:
+            self.count += 1
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+
+
+class ClientDriver:
+    """Sends requests through Flask's test client, in this thread."""
+
+    def __init__(self, app, data):
+        self.app = app
+        self.clients = {'anonymous': app.test_client(),
+                        'user': app.test_client()}
+        self.clients['user'].post('/login', data=dict(
+            username=data.username, password=data.password))
+
+    def send(self, who, method, path, body):
+        if who == 'fresh':
+            client = self.app.test_client()
+        else:
+            client = self.clients[who]
+
+        kwargs = self.body_kwargs(path, body)
+        return client.open(path, method=method, **kwargs).status_code
+
+    @staticmethod
+    def body_kwargs(path, body):
+        if body is None:
+            return {}
+        if path.startswith('/api/'):
+            return {'json': body}
+        return {'data': body}
+
+    def close(self):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """Doesn't log every request (there are thousands)."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class ServerDriver(ClientDriver):
+    """Sends requests over HTTP to the app on a threaded WSGI server."""
+
+    def __init__(self, app, data):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True,
+                                  request_handler=QuietRequestHandler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.data = data
+        self.local = threading.local()
+
+    def session(self, who):
+        """This thread's HTTP session (each keeps its connection open)."""
+
+        sessions = self.local.__dict__.setdefault('sessions', {})
+
+        if who not in sessions:
+            session = requests.Session()
+            if who == 'user':
+                session.post(f'{self.base_url}/login', data=dict(
+                    username=self.data.username,
+                    password=self.data.password,
+                ), allow_redirects=False)
+            sessions[who] = session
+
+        return sessions[who]
+
+    def send(self, who, method, path, body):
+        # a 'fresh' request goes on a new connection, with no cookies
+        sender = requests if who == 'fresh' else self.session(who)
+        response = sender.request(
+            method, f'{self.base_url}{path}', allow_redirects=False,
+            **self.body_kwargs(path, body))
+        return response.status_code
+
+    def close(self):
+        self.server.shutdown()
+
+
+def percentile(values, pct):
+    """pct-th percentile of sorted values, by nearest rank."""
+
+    if not values:
+        return 0.0
+
+    rank = max(1, round(pct / 100 * len(values)))
+    return values[min(rank, len(values)) - 1]
+
+
+def run_scenario(driver, counter, scenario, data, n, concurrency=1,
+                 warmup=10, seed=0):
+    """Benchmark one scenario with n requests; return dict of results."""
+
+    rng = random.Random(f'{seed}-{scenario.name}')
+    n = max(1, round(n * scenario.weight))
+    plan = [scenario.make(rng, data) for _ in range(warmup + n)]
+
+    def send(request):
+        method, path, body = request
+        start = time.perf_counter()
+        status = driver.send(scenario.who, method, path, body)
+        return time.perf_counter() - start, status
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, plan[:warmup]))
+
+        counter.reset()
+        start = time.perf_counter()
+        timings = list(executor.map(send, plan[warmup:]))
+        elapsed = time.perf_counter() - start
+        statements = counter.count
+
+    latencies = sorted(latency for latency, _ in timings)
+
+    return dict(
+        requests=n,
+        errors=sum(status >= 400 for _, status in timings),
+        rps=n / elapsed,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p95_ms=percentile(latencies, 95) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        sql_per_request=statements / n,
+    )
+
+
+def run_benchmarks(app, data, mode='client', n=200, concurrency=1,
+                   warmup=10, seed=0, only=None):
+    """Run every scenario (or those named in only); return results dict."""
+
+    with app.app_context():
+        counter = StatementCounter(db.engine)
+
+    drivers = {'client': ClientDriver, 'server': ServerDriver}
+    driver = drivers[mode](app, data)
+
+    if mode == 'client':
+        # the test client can only send one request at a time
+        concurrency = 1
+
+    try:
+        results = {}
+
+        for scenario in SCENARIOS:
+            if only and scenario.name not in only:
+                continue
+
+            results[scenario.name] = run_scenario(
+                driver, counter, scenario, data, n,
+                concurrency=concurrency, warmup=warmup, seed=seed)
+
+        return results
+    finally:
+        driver.close()
+
+
+def compare(results, baseline, tolerance=0.2):
+    """Return list of regressions of results against baseline results."""
+
+    regressions = []
+
+    for name, result in results.items():
+        base = baseline.get(name)
+
+        if base is None:
+            continue
+
+        if result['p95_ms'] > base['p95_ms'] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p95 {result['p95_ms']:.1f}ms "
+                f"(was {base['p95_ms']:.1f}ms)")
+
+        if result['rps'] < base['rps'] * (1 - tolerance):
+            regressions.append(
+                f"{name}: {result['rps']:.0f} req/s "
+                f"(was {base['rps']:.0f} req/s)")
+
+        # statement counts don't vary run to run, so allow no slack
+        if result['sql_per_request'] > base['sql_per_request'] + 0.5:
+            regressions.append(
+                f"{name}: {result['sql_per_request']:.1f} SQL statements "
+                f"per request (was {base['sql_per_request']:.1f})")
+
+    return regressions
+
+
+def format_results(results, baseline=None):
+    """Return results as a text table (with baseline p95s, if given)."""
+
+    header = (f"{'route':<20} {'reqs':>6} {'errors':>6} {'req/s':>8} "
+              f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'sql/req':>8}")
+    if baseline:
+        header += f" {'was p95':>8}"
+
+    lines = [header, '-' * len(header)]
+
+    for name, r in results.items():
+        line = (f"{name:<20} {r['requests']:>6} {r['errors']:>6} "
+                f"{r['rps']:>8.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+                f"{r['p99_ms']:>8.2f} {r['sql_per_request']:>8.1f}")
+        if baseline:
+            base = baseline.get(name)
+            line += f" {base['p95_ms']:>8.2f}" if base else f" {'-':>8}"
+        lines.append(line)
+
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.option('--database', default='postgresql:///flaskcafe-bench',
+              show_default=True, help='Database to benchmark against.')
+@click.option('--generate', is_flag=True,
+              help='(Re)generate the dataset first; wipes the database!')
+@click.option('--cities', default=50, show_default=True)
+@click.option('--cafes', default=50000, show_default=True)
+@click.option('--users', default=5000, show_default=True)
+@click.option('--mode', type=click.Choice(['client', 'server']),
+              default='client', show_default=True)
+@click.option('--requests', 'n', default=200, show_default=True,
+              help='Requests per route.')
+@click.option('--concurrency', default=4, show_default=True,
+              help='Concurrent requests (server mode).')
+@click.option('--warmup', default=10, show_default=True,
+              help='Unmeasured requests per route, first.')
+@click.option('--route', 'only', multiple=True,
+              help='Only benchmark this route (may be repeated).')
+@click.option('--no-page-cache', is_flag=True,
+              help="Don't cache anonymous pages.")
+@click.option('--seed', default=0, show_default=True)
+@click.option('--save', type=click.Path(dir_okay=False),
+              help='Save results as JSON here.')
+@click.option('--baseline', type=click.Path(dir_okay=False, exists=True),
+              help='Compare results with these saved results.')
+@click.option('--tolerance', default=0.2, show_default=True,
+              help='Fraction slower than baseline to allow.')
+def main(database, generate, cities, cafes, users, mode, n, concurrency,
+         warmup, only, no_page_cache, seed, save, baseline, tolerance):
+    """Benchmark Flask Cafe's routes."""
+
+    app = create_app(BenchmarkConfig)
+    app.config['SQLALCHEMY_DATABASE_URI'] = database
+    if no_page_cache:
+        app.config['PAGE_CACHE_BACKEND'] = 'null'
+
+    if generate:
+        result = app.test_cli_runner().invoke(generate_data, [
+            '--reset', '--cities', str(cities), '--cafes', str(cafes),
+            '--users', str(users), '--seed', str(seed)])
+        if result.exception:
+            raise result.exception
+        click.echo(result.output.strip())
+
+    with app.app_context():
+        data = Dataset('user1', 'password', seed=seed)
+
+    results = run_benchmarks(app, data, mode=mode, n=n,
+                             concurrency=concurrency, warmup=warmup,
+                             seed=seed, only=only)
+
+    base = None
+    if baseline:
+        with open(baseline) as f:
+            base = json.load(f)['routes']
+
+    click.echo(format_results(results, base))
+
+    startup = app.extensions['startup_times']
+    click.echo(f"\nFirst request {startup['first_request'] * 1000:.0f} ms "
+               f"after import (imports {startup['imports'] * 1000:.0f} ms, "
+               f"create_app {startup['create_app'] * 1000:.0f} ms)")
+
+    if save:
+        with open(save, 'w') as f:
+            json.dump(dict(mode=mode, concurrency=concurrency,
+                           routes=results), f, indent=2)
+
+    if base:
+        regressions = compare(results, base, tolerance)
+        if regressions:
+            click.echo("\nRegressions:")
+            for regression in regressions:
+                click.echo(f"  {regression}")
+            sys.exit(1)
+        click.echo("\nNo regressions.")
+
+
+if __name__ == '__main__':
+    main()
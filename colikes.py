@@ -0,0 +1,241 @@
+"""Sparse matrix of which cafes are liked by the same people.
+
+The likes table is a users x cafes matrix L (1 where the user likes the
+cafe). C = L.T @ L is then cafes x cafes: C[i, j] is how many users like
+both cafe i and cafe j, and C[i, i] is how many like cafe i at all. Two
+cafes are similar (cosine similarity) by
+
+    C[i, j] / sqrt(C[i, i] * C[j, j])
+
+L and C are built once, as SciPy CSR matrices. Later likes & unlikes are
+kept as small per-cafe & per-user corrections on top, and merged in when
+reading a row, until the next full rebuild.
+"""
+
+from collections import Counter, defaultdict
+
+import numpy as np
+from scipy import sparse
+
+
+class CoLikes:
+    """Co-like counts of cafes, with incremental updates."""
+
+    def __init__(self, user_ids, cafe_ids, built_at=0.0):
+        """Build from parallel arrays of user & cafe ids, one pair a like.
+
+        built_at (a time.time()) says how fresh the likes are.
+        """
+
+        user_ids = np.asarray(user_ids, dtype=np.int64)
+        cafe_ids = np.asarray(cafe_ids, dtype=np.int64)
+        self.built_at = built_at
+
+        self.user_ids, user_rows = np.unique(user_ids, return_inverse=True)
+        self.cafe_ids, cafe_cols = np.unique(cafe_ids, return_inverse=True)
+
+        likes = sparse.csr_matrix(
+            (np.ones(len(user_rows), dtype=np.int32), (user_rows, cafe_cols)),
+            shape=(len(self.user_ids), len(self.cafe_ids)),
+        )
+        self.set_matrices(likes, (likes.T @ likes).tocsr())
+
+    @classmethod
+    def from_matrices(cls, user_ids, cafe_ids, likes, co, built_at):
+        """Remake from the parts save() wrote."""
+
+        self = cls.__new__(cls)
+        self.user_ids = user_ids
+        self.cafe_ids = cafe_ids
+        self.built_at = built_at
+        self.set_matrices(likes, co)
+        return self
+
+    def set_matrices(self, likes, co):
+        self.likes = likes
+        self.co = co
+
+        self.user_pos = {id: i for i, id in enumerate(self.user_ids.tolist())}
+        self.cafe_pos = {id: i for i, id in enumerate(self.cafe_ids.tolist())}
+        self.base_cafes = len(self.cafe_ids)
+        self.counts = co.diagonal().astype(np.float64)
+
+        # cafe position -> Counter(other cafe position -> change in C)
+        self.co_changes = defaultdict(Counter)
+        # user id -> {cafe position: liked now?}
+        self.user_changes = defaultdict(dict)
+
+    def save(self, f):
+        """Write to f (a file or path), as an .npz file."""
+
+        np.savez(
+            f,
+            user_ids=self.user_ids,
+            cafe_ids=self.cafe_ids,
+            built_at=self.built_at,
+            likes_indptr=self.likes.indptr,
+            likes_indices=self.likes.indices,
+            likes_shape=self.likes.shape,
+            co_data=self.co.data,
+            co_indptr=self.co.indptr,
+            co_indices=self.co.indices,
+            co_shape=self.co.shape,
+        )
+
+    @classmethod
+    def load(cls, f):
+        """Read what save() wrote."""
+
+        with np.load(f) as saved:
+            likes = sparse.csr_matrix(
+                (np.ones(len(saved['likes_indices']), dtype=np.int32),
+                 saved['likes_indices'], saved['likes_indptr']),
+                shape=tuple(saved['likes_shape']),
+            )
+            co = sparse.csr_matrix(
+                (saved['co_data'], saved['co_indices'], saved['co_indptr']),
+                shape=tuple(saved['co_shape']),
+            )
+
+            return cls.from_matrices(
+                saved['user_ids'], saved['cafe_ids'], likes, co,
+                float(saved['built_at']))
+
+    def _cafe_position(self, cafe_id):
+        """Position of cafe_id, giving new cafes one past the matrices."""
+
+        pos = self.cafe_pos.get(cafe_id)
+
+        if pos is None:
+            pos = len(self.cafe_ids)
+            self.cafe_pos[cafe_id] = pos
+            self.cafe_ids = np.append(self.cafe_ids, cafe_id)
+            self.counts = np.append(self.counts, 0.0)
+
+        return pos
+
+    def liked_positions(self, user_id):
+        """Set of positions of the cafes user likes."""
+
+        row = self.user_pos.get(user_id)
+        liked = set()
+
+        if row is not None:
+            start, end = self.likes.indptr[row], self.likes.indptr[row + 1]
+            liked.update(self.likes.indices[start:end].tolist())
+
+        for pos, now_liked in self.user_changes.get(user_id, {}).items():
+            if now_liked:
+                liked.add(pos)
+            else:
+                liked.discard(pos)
+
+        return liked
+
+    def update(self, user_id, cafe_id, liked):
+        """Record that user now likes (or, if not liked, unlikes) cafe."""
+
+        pos = self._cafe_position(cafe_id)
+        others = self.liked_positions(user_id)
+
+        if (pos in others) == liked:
+            return
+
+        others.discard(pos)
+        change = 1 if liked else -1
+
+        for other in others:
+            self.co_changes[pos][other] += change
+            self.co_changes[other][pos] += change
+
+        self.co_changes[pos][pos] += change
+        self.counts[pos] += change
+        self.user_changes[user_id][pos] = liked
+
+    def co_row(self, pos):
+        """Return (positions, counts) of cafes co-liked with pos."""
+
+        if pos < self.base_cafes:
+            start, end = self.co.indptr[pos], self.co.indptr[pos + 1]
+            positions = self.co.indices[start:end]
+            counts = self.co.data[start:end].astype(np.float64)
+        else:
+            positions = np.empty(0, dtype=np.int64)
+            counts = np.empty(0, dtype=np.float64)
+
+        changes = self.co_changes.get(pos)
+
+        if changes:
+            positions = np.concatenate([positions, list(changes.keys())])
+            counts = np.concatenate([counts, list(changes.values())])
+            positions, where = np.unique(positions, return_inverse=True)
+            counts = np.bincount(where, weights=counts)
+
+        return positions, counts
+
+    def _top(self, positions, scores, k, exclude=()):
+        """Ids of the k best-scoring positions (ties to the lower id)."""
+
+        if k < 1:
+            return []
+
+        keep = scores > 0
+        if exclude:
+            keep &= ~np.isin(positions, list(exclude))
+
+        positions, scores = positions[keep], scores[keep]
+
+        if len(positions) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            positions, scores = positions[best], scores[best]
+
+        ids = self.cafe_ids[positions]
+        order = np.lexsort((ids, -scores))
+
+        return ids[order][:k].tolist()
+
+    def similar(self, cafe_id, k, min_co_likes=1):
+        """Ids of up to k cafes most liked by the people who like cafe_id."""
+
+        pos = self.cafe_pos.get(cafe_id)
+
+        if pos is None or self.counts[pos] <= 0:
+            return []
+
+        positions, counts = self.co_row(pos)
+        counts[counts < min_co_likes] = 0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = counts / np.sqrt(self.counts[positions]
+                                      * self.counts[pos])
+
+        return self._top(positions, np.nan_to_num(scores), k, exclude={pos})
+
+    def picks(self, user_id, k):
+        """Ids of up to k cafes user doesn't like, but may.
+
+        A cafe's score is the sum of its similarities to each cafe user
+        likes.
+        """
+
+        liked = self.liked_positions(user_id)
+
+        if not liked:
+            return []
+
+        totals = np.zeros(len(self.cafe_ids))
+        weights = 1 / np.sqrt(np.maximum(self.counts, 1))
+
+        base = [pos for pos in liked if pos < self.base_cafes]
+        if base:
+            rows = self.co[base]
+            totals[:self.base_cafes] += rows.T @ weights[base]
+
+        for pos in liked:
+            for other, change in self.co_changes.get(pos, {}).items():
+                totals[other] += weights[pos] * change
+
+        scores = totals * weights
+        positions = np.arange(len(self.cafe_ids))
+
+        return self._top(positions, scores, k, exclude=liked)
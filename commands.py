@@ -0,0 +1,560 @@
+"""Flask CLI commands for Flask Cafe."""
+
+import csv
+import io
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, text
+from sqlalchemy.orm import load_only
+from werkzeug.datastructures import MultiDict
+
+from datagen import DataGenerator, parse_distribution
+from forms import AddOrEditCafeForm
+from geo import nearby_cafes
+from jobs import job_queue
+from models import db, Cafe, CatalogVersion, City, User
+from models import UserLikesCafe, city_registry
+from pagecache import page_cache
+from passwords import password_hasher
+from recommend import build_colikes, recommender, save_snapshot
+from search import cafe_search
+
+
+class RateLimiter:
+    """Spaces out calls so there are at most `rate` per second."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+def load_checkpoint(path):
+    """Return id of last cafe a previous backfill finished, or 0."""
+
+    try:
+        with open(path) as f:
+            return json.load(f)['last_id']
+    except FileNotFoundError:
+        return 0
+
+
+def save_checkpoint(path, last_id):
+    """Atomically record that cafes up to last_id are done."""
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({'last_id': last_id}, f)
+    os.replace(tmp_path, path)
+
+
+def clear_checkpoint(path):
+    """Forget saved progress, so the next backfill scans every cafe."""
+
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def find_stale_maps(after_id):
+    """Return (ids of cafes whose map is missing or stale, max id seen).
+
+    Only cafes with id > after_id are scanned.
+    """
+
+    query = (Cafe.query
+             .options(load_only('id', 'address', 'city_code', 'map_status',
+                                'map_key'))
+             .filter(Cafe.id > after_id)
+             .order_by(Cafe.id)
+             .yield_per(1000))
+
+    stale = []
+    max_id = after_id
+
+    for cafe in query:
+        max_id = cafe.id
+        if not cafe.map_is_current():
+            stale.append(cafe.id)
+
+    return stale, max_id
+
+
+@click.command('backfill-maps')
+@click.option('--workers', default=4, show_default=True,
+              help='Number of maps to fetch at once.')
+@click.option('--rate', default=5.0, show_default=True,
+              help='Most cafes to process per second (0 for no limit).')
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              help='Progress file [default: instance/map-backfill.json].')
+@click.option('--restart', is_flag=True,
+              help='Ignore saved progress and scan every cafe.')
+@with_appcontext
+def backfill_maps(workers, rate, checkpoint, restart):
+    """Fetch missing or stale maps for all cafes.
+
+    Progress is checkpointed, so an interrupted run (or one with
+    failures) picks up where it stopped when run again. A run that
+    finishes with no failures clears the checkpoint, so the next one
+    scans every cafe.
+    """
+
+    if checkpoint is None:
+        os.makedirs(current_app.instance_path, exist_ok=True)
+        checkpoint = os.path.join(
+            current_app.instance_path, 'map-backfill.json')
+
+    start_id = 0 if restart else load_checkpoint(checkpoint)
+    stale, max_id = find_stale_maps(start_id)
+
+    click.echo(f"{len(stale)} cafes after id {start_id} need maps.")
+
+    limiter = RateLimiter(rate)
+    done = set()
+    failed = []
+    frontier = 0
+
+    def fetch(cafe_id):
+        limiter.wait()
+        return job_queue.run_once('fetch_cafe_map', [cafe_id])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch, id): id for id in stale}
+
+        for future in as_completed(futures):
+            cafe_id = futures[future]
+
+            if future.result():
+                done.add(cafe_id)
+            else:
+                failed.append(cafe_id)
+
+            # checkpoint the highest id below which every cafe is done
+            # (failures aren't, so the next run retries them)
+            while frontier < len(stale) and stale[frontier] in done:
+                frontier += 1
+
+            if frontier < len(stale):
+                save_checkpoint(checkpoint, stale[frontier] - 1)
+
+    if failed:
+        save_checkpoint(checkpoint, min(failed) - 1)
+    else:
+        clear_checkpoint(checkpoint)
+
+    click.echo(f"Fetched {len(stale) - len(failed)} maps; "
+               f"{len(failed)} failed.")
+
+    if failed:
+        click.echo(f"Failed cafe ids: {', '.join(map(str, sorted(failed)))}")
+
+
+@click.command('reconcile-like-counts')
+@with_appcontext
+def reconcile_like_counts():
+    """Recompute every cafe's like count from its likes."""
+
+    fixed = Cafe.recount_likes()
+    db.session.commit()
+
+    click.echo(f"Fixed like counts for {fixed} cafes.")
+
+
+@click.command('rebuild-recommendations')
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Where to save it [default: RECOMMEND_SNAPSHOT].')
+@with_appcontext
+def rebuild_recommendations(output):
+    """Rebuild the recommendations matrix from every like, and save it.
+
+    Running app processes load it within RECOMMEND_CHECK_INTERVAL
+    seconds; run this periodically to share likes between processes.
+    """
+
+    start = time.monotonic()
+    colikes = build_colikes()
+    save_snapshot(colikes, output or current_app.config['RECOMMEND_SNAPSHOT'])
+
+    cafes = len(colikes.cafe_ids)
+    # co has both (i, j) & (j, i), and (i, i) for each cafe
+    pairs = (colikes.co.nnz - cafes) // 2
+
+    click.echo(
+        f"Built recommendations from the likes of {len(colikes.user_ids)} "
+        f"users for {cafes} cafes ({pairs} pairs liked together) "
+        f"in {time.monotonic() - start:.1f}s.")
+
+
+#######################################
+# importing cafes
+
+
+IMPORT_FIELDS = ('source_id', 'name', 'description', 'url', 'address',
+                 'city_code', 'image_url')
+
+# Upserts cafes by source_id from `source` (a VALUES or SELECT giving
+# IMPORT_FIELDS, then updated_at). Rows that haven't changed are left
+# alone; cafes that have moved need their map & location redone.
+UPSERT_SQL = """
+    INSERT INTO cafes ({fields}, map_status, updated_at)
+    {source}
+    ON CONFLICT (source_id) DO UPDATE SET
+        {updates},
+        map_status = CASE WHEN {moved} THEN 'pending'
+                     ELSE cafes.map_status END,
+        latitude = CASE WHEN {moved} THEN NULL ELSE cafes.latitude END,
+        longitude = CASE WHEN {moved} THEN NULL ELSE cafes.longitude END,
+        revision = cafes.revision + 1,
+        updated_at = excluded.updated_at
+    WHERE {changed}
+"""
+
+
+def upsert_sql(source, is_distinct):
+    """Build UPSERT_SQL for source, with dialect's IS DISTINCT FROM."""
+
+    def differ(*fields):
+        return ' OR '.join(f'cafes.{field} {is_distinct} excluded.{field}'
+                           for field in fields)
+
+    return UPSERT_SQL.format(
+        fields=', '.join(IMPORT_FIELDS),
+        source=source,
+        updates=', '.join(f'{field} = excluded.{field}'
+                          for field in IMPORT_FIELDS[1:]),
+        moved=differ('address', 'city_code'),
+        changed=differ(*IMPORT_FIELDS[1:]),
+    )
+
+
+def read_rows(f, format):
+    """Yield (line number, row) for each row of an open CSV/NDJSON file.
+
+    Rows are dicts; NDJSON lines that aren't JSON objects come back as
+    None.
+    """
+
+    if format == 'csv':
+        reader = csv.DictReader(f)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_num, line in enumerate(f, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_num, row if isinstance(row, dict) else None
+
+
+class CafeRowValidator:
+    """Checks feed rows with the same rules as AddOrEditCafeForm."""
+
+    def __init__(self):
+        self.form = AddOrEditCafeForm(formdata=None, meta={'csrf': False})
+        self.form.city_code.choices = city_registry.choices()
+
+    def validate(self, row):
+        """Return (cafe dict, None) for a valid row, else (None, errors)."""
+
+        if row is None:
+            return None, {'row': ["Not a JSON object."]}
+
+        errors = {}
+        source_id = str(row.get('source_id') or '').strip()
+
+        if not source_id:
+            errors['source_id'] = ["This field is required."]
+
+        self.form.process(MultiDict(
+            (field, str(value)) for field, value in row.items()
+            if value is not None))
+
+        if not self.form.validate():
+            errors.update(self.form.errors)
+
+        if errors:
+            return None, errors
+
+        cafe = {field: self.form[field].data for field in IMPORT_FIELDS[1:]}
+        cafe['source_id'] = source_id
+
+        return cafe, None
+
+
+def forget_cached_cafes():
+    """Drop in-process caches of cafes, after writing them without the ORM.
+
+    (The ORM's events would otherwise keep these up to date.)
+    """
+
+    page_cache.invalidate({'cafes', 'cafe:*', 'cities'})
+    cafe_search.reset()
+    nearby_cafes.reset()
+    city_registry.bump()
+
+
+def upsert_cafes(cafes):
+    """Insert or update cafes (dicts of IMPORT_FIELDS) by source_id.
+
+    Runs in the session's transaction; on Postgres the rows are COPYed
+    into a temporary table first. Returns number of cafes added or
+    changed.
+    """
+
+    now = bindparam('now', datetime.utcnow(), type_=db.DateTime)
+
+    if db.engine.dialect.name != 'postgresql':
+        values = ', '.join(f':{field}' for field in IMPORT_FIELDS)
+        stmt = text(upsert_sql(f"VALUES ({values}, 'pending', :now)",
+                               'IS NOT')).bindparams(now)
+
+        return db.session.execute(stmt, cafes).rowcount
+
+    connection = db.session.connection()
+    connection.execute(text("""
+        CREATE TEMPORARY TABLE import_cafes (
+            source_id TEXT, name TEXT, description TEXT, url TEXT,
+            address TEXT, city_code TEXT, image_url TEXT
+        ) ON COMMIT DROP
+    """))
+    copy_rows(connection, 'import_cafes', IMPORT_FIELDS, cafes)
+
+    fields = ', '.join(IMPORT_FIELDS)
+    stmt = text(upsert_sql(
+        f"SELECT {fields}, 'pending', :now FROM import_cafes",
+        'IS DISTINCT FROM',
+    )).bindparams(now)
+
+    return connection.execute(stmt).rowcount
+
+
+def copy_rows(connection, table_name, fields, rows):
+    """COPY rows (dicts with fields) into a Postgres table."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow('\\N' if row[field] is None else row[field]
+                        for field in fields)
+    buffer.seek(0)
+
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        f"COPY {table_name} ({', '.join(fields)}) "
+        f"FROM STDIN WITH (FORMAT csv, NULL '\\N')",
+        buffer,
+    )
+
+
+def bulk_insert(table, rows, batch_size=10000):
+    """Insert rows (dicts of column values) into table, in batches.
+
+    Uses COPY on Postgres and executemany elsewhere. Keys that aren't
+    columns of table are ignored.
+    """
+
+    if not rows:
+        return
+
+    fields = [column.name for column in table.columns
+              if column.name in rows[0]]
+
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+
+        if db.engine.dialect.name == 'postgresql':
+            copy_rows(db.session.connection(), table.name, fields, batch)
+        else:
+            db.session.execute(
+                table.insert(),
+                [{field: row[field] for field in fields} for row in batch])
+
+
+def lookup_ids(column, keys, batch_size=500):
+    """Return {key: id} for the rows of column's table whose column is
+    one of keys.
+
+    Looks them up in batches, so no one query has a huge IN list (which
+    SQLite caps, and which is slow for Postgres to plan).
+    """
+
+    id_column = column.class_.id
+    ids = {}
+
+    for start in range(0, len(keys), batch_size):
+        ids.update(
+            db.session.query(column, id_column)
+            .filter(column.in_(keys[start:start + batch_size])))
+
+    return ids
+
+
+@click.command('import-cafes')
+@click.argument('feed', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'format', type=click.Choice(['csv', 'ndjson']),
+              help='Feed format [default: from file extension].')
+@click.option('--batch-size', default=5000, show_default=True,
+              help='Cafes to write per transaction.')
+@click.option('--rejects', type=click.File('w', encoding='utf-8'),
+              help='Write rejected rows here, as NDJSON.')
+@with_appcontext
+def import_cafes(feed, format, batch_size, rejects):
+    """Add or update cafes from a CSV or NDJSON vendor feed.
+
+    Rows need the cafe form's fields plus a source_id, which identifies
+    the cafe in later imports. Invalid rows are skipped and reported.
+    """
+
+    if format is None:
+        extension = os.path.splitext(feed.name)[1].lower()
+        format = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}.get(
+            extension)
+        if format is None:
+            raise click.UsageError("Can't tell feed format; use --format.")
+
+    start = time.monotonic()
+    validator = CafeRowValidator()
+    # source_id -> cafe; a later row for the same cafe replaces earlier ones
+    batch = {}
+    counts = dict(read=0, written=0, rejected=0)
+
+    def flush():
+        counts['written'] += upsert_cafes(list(batch.values()))
+        CatalogVersion.bump(db.session, {'cafes'})
+        db.session.commit()
+        batch.clear()
+
+    for line_num, row in read_rows(feed, format):
+        counts['read'] += 1
+        cafe, errors = validator.validate(row)
+
+        if errors:
+            counts['rejected'] += 1
+
+            if counts['rejected'] <= 10:
+                click.echo(f"Line {line_num}: " + "; ".join(
+                    f"{field}: {' '.join(messages)}"
+                    for field, messages in errors.items()))
+
+            if rejects:
+                rejects.write(json.dumps(
+                    dict(line=line_num, row=row, errors=errors)) + '\n')
+            continue
+
+        batch[cafe['source_id']] = cafe
+
+        if len(batch) >= batch_size:
+            flush()
+
+    if batch:
+        flush()
+
+    forget_cached_cafes()
+
+    elapsed = time.monotonic() - start
+    click.echo(
+        f"Read {counts['read']} rows in {elapsed:.1f}s "
+        f"({counts['read'] / max(elapsed, 1e-6):.0f} rows/sec): "
+        f"{counts['written']} cafes added or changed, "
+        f"{counts['rejected']} rows rejected.")
+
+    if counts['written']:
+        click.echo("Run `flask backfill-maps` to fetch maps for "
+                   "new and moved cafes.")
+
+
+#######################################
+# generating synthetic data
+
+
+def parse_likes_per_user(ctx, param, value):
+    try:
+        return parse_distribution(value)
+    except ValueError as exc:
+        raise click.BadParameter(str(exc))
+
+
+@click.command('generate-data')
+@click.option('--cities', default=50, show_default=True,
+              type=click.IntRange(min=1))
+@click.option('--cafes', default=10000, show_default=True)
+@click.option('--users', default=1000, show_default=True)
+@click.option('--likes-per-user', default='geometric:20', show_default=True,
+              callback=parse_likes_per_user,
+              help='fixed:N, uniform:LO:HI or geometric:MEAN.')
+@click.option('--skew', default=1.1, show_default=True,
+              help='Zipf exponent for city sizes & cafe popularity.')
+@click.option('--seed', default=0, show_default=True,
+              help='Random seed; the same seed gives the same data.')
+@click.option('--password', default='password', show_default=True,
+              help='Password for every generated user.')
+@click.option('--reset', is_flag=True,
+              help='Drop and recreate all tables first.')
+@with_appcontext
+def generate_data(cities, cafes, users, likes_per_user, skew, seed,
+                  password, reset):
+    """Fill the database with synthetic cities, cafes, users & likes.
+
+    Cafes get locations but no maps, so MapQuest is never called. The
+    first user is an admin called "admin"; the rest are user1, user2...
+    """
+
+    if reset:
+        db.drop_all()
+        db.create_all()
+
+    start = time.monotonic()
+    generator = DataGenerator(seed=seed, skew=skew)
+
+    city_rows = generator.cities(cities)
+    cafe_rows = generator.cafes(cafes, city_rows)
+    # hashing is slow on purpose; do it once & share it
+    hashed = password_hasher.hash(password)
+    user_rows = generator.users(users, hashed)
+    likes = generator.likes(user_rows, cafe_rows, likes_per_user)
+
+    bulk_insert(City.__table__, city_rows)
+    bulk_insert(Cafe.__table__, cafe_rows)
+    bulk_insert(User.__table__, user_rows)
+
+    # look up the ids the rows were given
+    cafe_ids = lookup_ids(
+        Cafe.source_id, [cafe['source_id'] for cafe in cafe_rows])
+    user_ids = lookup_ids(
+        User.username, [user['username'] for user in user_rows])
+
+    bulk_insert(UserLikesCafe.__table__, [
+        dict(user_id=user_ids[user_rows[user_index]['username']],
+             cafe_id=cafe_ids[cafe_rows[cafe_index]['source_id']])
+        for user_index, cafe_index in likes
+    ])
+
+    CatalogVersion.bump(db.session, {'cafes', 'cities'})
+    db.session.commit()
+    forget_cached_cafes()
+    recommender.reset()
+
+    click.echo(f"Generated {cities} cities, {cafes} cafes, {users} users & "
+               f"{len(likes)} likes in {time.monotonic() - start:.1f}s.")
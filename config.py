@@ -0,0 +1,81 @@
+"""Configuration profiles for Flask Cafe.
+
+create_app() takes one of these by name:
+
+- "dev": debug mode & the debug toolbar
+- "test": the test database, no CSRF
+- "prod": no debug tooling; FLASK_SECRET_KEY must be set
+
+Secrets and the database come from the environment: FLASK_SECRET_KEY,
+MAPQUEST_API_KEY and DATABASE_URL.
+"""
+
+import os
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'postgres:///flaskcafe')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    SECRET_KEY = os.environ.get('FLASK_SECRET_KEY')
+    MAPQUEST_API_KEY = os.environ.get('MAPQUEST_API_KEY')
+
+    # load the debug toolbar? (only ever imported if so)
+    DEBUG_TOOLBAR = False
+
+    CAFES_PER_PAGE = 24
+    CAFES_MAX_PER_PAGE = 100
+    LIKES_BULK_MAX = 500
+    USER_CACHE_TTL = 60
+    USER_CACHE_SIZE = 10000
+
+    # per-client limits on requests that change things (see ratelimit.py)
+    RATE_LIMITS = {
+        'views.login_user': '10/minute',
+        'views.signup_user': '5/minute',
+        'views.like_cafe': '120/minute',
+        'views.unlike_cafe': '120/minute',
+        'views.batch_like_cafes': '30/minute',
+    }
+
+
+class DevelopmentConfig(Config):
+    DEBUG = True
+    DEBUG_TOOLBAR = True
+    DEBUG_TB_INTERCEPT_REDIRECTS = True
+
+    SECRET_KEY = Config.SECRET_KEY or 'dev-secret-key'
+
+
+class TestingConfig(Config):
+    # Make Flask errors be real errors, rather than HTML pages with error info
+    TESTING = True
+
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'TEST_DATABASE_URL', 'postgresql:///flaskcafe-test')
+
+    SECRET_KEY = 'test-secret-key'
+
+    # Don't req CSRF for testing
+    WTF_CSRF_ENABLED = False
+
+    # Tests log in & like cafes far faster than people do
+    RATE_LIMITS = {}
+
+    # Hash passwords quickly, in the caller
+    PASSWORD_HASHER = 'inline'
+    BCRYPT_LOG_ROUNDS = 4
+
+
+class ProductionConfig(Config):
+    pass
+
+
+PROFILES = {
+    'dev': DevelopmentConfig,
+    'test': TestingConfig,
+    'prod': ProductionConfig,
+}
@@ -0,0 +1,224 @@
+"""Synthetic data for load testing Flask Cafe.
+
+Generates cities, cafes, users and likes as plain dicts of column values,
+ready to bulk insert (see the generate-data command). Everything comes
+from one seeded random.Random, so the same arguments always produce the
+same data.
+
+Popularity is skewed the way real data is: a few big cities hold most
+cafes, and a few cafes get most likes (both Zipf-distributed). How many
+likes each user makes follows the --likes-per-user distribution.
+"""
+
+import bisect
+import itertools
+import math
+import random
+from datetime import datetime
+
+STATES = ['CA', 'NY', 'TX', 'WA', 'OR', 'IL', 'MA', 'CO', 'FL', 'GA']
+
+NAME_WORDS = [
+    'Blue', 'Bottle', 'Bean', 'Brew', 'Corner', 'Daily', 'Ember', 'Fox',
+    'Golden', 'Grind', 'Harbor', 'Hearth', 'Iron', 'Juniper', 'Lantern',
+    'Little', 'Maple', 'Moon', 'North', 'Oak', 'Pilot', 'Red', 'Ritual',
+    'Sparrow', 'Stone', 'Sun', 'Union', 'Velvet', 'Wild', 'Yellow',
+]
+
+NAME_KINDS = ['Cafe', 'Coffee', 'Roasters', 'Espresso Bar', 'Coffee House']
+
+DESCRIPTION_WORDS = [
+    'cozy', 'bright', 'quiet', 'busy', 'friendly', 'spacious', 'tiny',
+    'pastries', 'pour-over', 'espresso', 'latte', 'wifi', 'outlets',
+    'patio', 'music', 'books', 'plants', 'roasted', 'in-house', 'local',
+    'beans', 'tea', 'sandwiches', 'laptop-friendly', 'views',
+]
+
+STREETS = ['Main St', 'Market St', 'Oak Ave', 'Park Blvd', '1st St',
+           '2nd Ave', 'Mission St', 'Broadway', 'Pine St', 'Elm St']
+
+FIRST_NAMES = ['Ada', 'Ben', 'Cara', 'Dev', 'Eli', 'Fay', 'Gus', 'Hana',
+               'Ivan', 'Jo', 'Kai', 'Lena', 'Milo', 'Nia', 'Omar', 'Pia']
+
+LAST_NAMES = ['Adams', 'Brooks', 'Chen', 'Diaz', 'Evans', 'Fox', 'Garcia',
+              'Hall', 'Ito', 'Jones', 'Khan', 'Lopez', 'Moore', 'Nguyen']
+
+
+def parse_distribution(spec):
+    """Parse a likes-per-user distribution into a function of an RNG.
+
+    spec is one of:
+
+    - "fixed:N": everyone likes N cafes
+    - "uniform:LO:HI": between LO and HI, evenly
+    - "geometric:MEAN": mostly a few, with a long tail (like real users)
+
+    Raises ValueError for anything else.
+    """
+
+    kind, _, args = spec.partition(':')
+
+    try:
+        args = [float(arg) for arg in args.split(':')] if args else []
+    except ValueError:
+        raise ValueError(f"Bad distribution: {spec}")
+
+    if kind == 'fixed' and len(args) == 1:
+        n = int(args[0])
+        return lambda rng: n
+
+    if kind == 'uniform' and len(args) == 2:
+        low, high = int(args[0]), int(args[1])
+        return lambda rng: rng.randint(low, high)
+
+    if kind == 'geometric' and len(args) == 1 and args[0] > 0:
+        # failures before first success, with P(success) = p has mean
+        # (1 - p) / p
+        p = 1 / (args[0] + 1)
+        log_q = math.log(1 - p)
+        return lambda rng: int(math.log(1 - rng.random()) / log_q)
+
+    raise ValueError(f"Bad distribution: {spec}")
+
+
+class ZipfSampler:
+    """Picks from n items, the i-th (0-based) with weight 1 / (i+1)**s."""
+
+    def __init__(self, n, s):
+        self.cum_weights = list(itertools.accumulate(
+            1 / (i + 1) ** s for i in range(n)))
+
+    def pick(self, rng):
+        total = self.cum_weights[-1]
+        return bisect.bisect(self.cum_weights, rng.random() * total)
+
+    def pick_distinct(self, rng, k):
+        """Return k distinct items (or all of them, if there are fewer)."""
+
+        n = len(self.cum_weights)
+        k = min(k, n)
+        picked = set()
+        tries = 0
+
+        while len(picked) < k and tries < 10 * k:
+            picked.add(self.pick(rng))
+            tries += 1
+
+        if len(picked) < k:
+            # only the long tail is left, and it's rarely picked; take
+            # the rest evenly rather than waiting for it
+            rest = [i for i in range(n) if i not in picked]
+            picked.update(rng.sample(rest, k - len(picked)))
+
+        return picked
+
+
+class DataGenerator:
+    """Generates a synthetic dataset; call the methods in order."""
+
+    def __init__(self, seed=0, skew=1.1):
+        self.rng = random.Random(seed)
+        self.skew = skew
+        self.now = datetime(2020, 1, 1)
+
+    def cities(self, n):
+        """Return list of city dicts, biggest city first."""
+
+        cities = []
+
+        for i in range(n):
+            cities.append(dict(
+                code=f'c{i:05d}',
+                name=f'{self.rng.choice(NAME_WORDS)}ville {i}',
+                state=self.rng.choice(STATES),
+                # city centre, somewhere in the continental US
+                latitude=self.rng.uniform(30, 48),
+                longitude=self.rng.uniform(-122, -75),
+            ))
+
+        return cities
+
+    def cafes(self, n, cities):
+        """Return list of cafe dicts; likes() fills in their like counts."""
+
+        in_city = ZipfSampler(len(cities), self.skew)
+        cafes = []
+
+        for i in range(n):
+            city = cities[in_city.pick(self.rng)]
+            name = (f'{self.rng.choice(NAME_WORDS)} '
+                    f'{self.rng.choice(NAME_WORDS)} '
+                    f'{self.rng.choice(NAME_KINDS)}')
+            slug = name.lower().replace(' ', '-')
+            words = self.rng.sample(DESCRIPTION_WORDS, 8)
+
+            cafes.append(dict(
+                source_id=f'synthetic-{i}',
+                name=name,
+                description=' '.join(words).capitalize() + '.',
+                url=f'https://{slug}-{i}.example.com/',
+                address=f'{self.rng.randint(1, 9999)} '
+                        f'{self.rng.choice(STREETS)}',
+                city_code=city['code'],
+                image_url='/static/images/default-cafe.jpg',
+                like_count=0,
+                map_status='pending',
+                # about a km or two around the city centre
+                latitude=city['latitude'] + self.rng.gauss(0, 0.02),
+                longitude=city['longitude'] + self.rng.gauss(0, 0.02),
+                revision=1,
+                updated_at=self.now,
+            ))
+
+        return cafes
+
+    def users(self, n, hashed_password):
+        """Return list of user dicts; the first is an admin."""
+
+        users = []
+
+        for i in range(n):
+            first_name = self.rng.choice(FIRST_NAMES)
+            last_name = self.rng.choice(LAST_NAMES)
+            username = 'admin' if i == 0 else f'user{i}'
+
+            users.append(dict(
+                username=username,
+                admin=i == 0,
+                email=f'{username}@example.com',
+                first_name=first_name,
+                last_name=last_name,
+                description=f"{first_name} likes coffee.",
+                image_url='',
+                hashed_password=hashed_password,
+                revision=1,
+                updated_at=self.now,
+                likes_version=0,
+                likes_updated_at=self.now,
+            ))
+
+        return users
+
+    def likes(self, users, cafes, likes_per_user):
+        """Return list of (user index, cafe index) likes.
+
+        Also fills in the cafes' like_count & users' likes_version.
+        Which cafes are popular is shuffled, so it isn't related to id.
+        """
+
+        popularity = list(range(len(cafes)))
+        self.rng.shuffle(popularity)
+        liked = ZipfSampler(len(cafes), self.skew)
+        likes = []
+
+        for user_index, user in enumerate(users):
+            picks = liked.pick_distinct(self.rng, likes_per_user(self.rng))
+
+            for pick in sorted(picks):
+                cafe_index = popularity[pick]
+                cafes[cafe_index]['like_count'] += 1
+                likes.append((user_index, cafe_index))
+
+            user['likes_version'] = len(picks)
+
+        return likes
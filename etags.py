@@ -0,0 +1,125 @@
+"""Conditional GET support: ETag & Last-Modified validators.
+
+A view decorated with `etags.conditional(validator)` first calls
+validator with the view's arguments. It returns the parts that pin down
+what the response would contain (cheap things, like revision numbers and
+the query string -- never the content itself) and when that last changed,
+or None to skip validation. If the request's If-None-Match (or, lacking
+that, If-Modified-Since) shows the client already has that version, we
+answer 304 Not Modified without running the view.
+"""
+
+import functools
+import hashlib
+import os
+from datetime import timezone
+
+from flask import Response, g, make_response, request, session
+
+from extensions import attach
+
+
+def source_digest(app):
+    """Digest of app's templates, so ETags change when templates do."""
+
+    digest = hashlib.sha256()
+    template_dir = os.path.join(app.root_path, app.template_folder)
+
+    for dirpath, dirnames, filenames in sorted(os.walk(template_dir)):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            digest.update(os.path.relpath(path, template_dir).encode('utf8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+
+    return digest.hexdigest()[:16]
+
+
+class ETags:
+    """Adds validators to responses and answers conditional GETs."""
+
+    def __init__(self):
+        self.app = None
+
+    def init_app(self, app):
+        attach(self, app)
+
+        app.config.setdefault('ETAG_SALT', source_digest(app))
+
+    def make_etag(self, parts):
+        """Strong ETag for response identified by parts."""
+
+        raw = repr((self.app.config['ETAG_SALT'], parts)).encode('utf8')
+        return hashlib.sha256(raw).hexdigest()[:32]
+
+    @staticmethod
+    def is_not_modified(etag, last_modified):
+        """Does the client's copy match etag/last_modified?"""
+
+        if request.if_none_match:
+            return request.if_none_match.contains(etag)
+
+        since = request.if_modified_since
+
+        if since is None or last_modified is None:
+            return False
+
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+
+        # Last-Modified only has whole seconds
+        return last_modified.replace(microsecond=0) <= since
+
+    @staticmethod
+    def add_validators(response, etag, last_modified):
+        response.set_etag(etag)
+
+        if last_modified is not None:
+            response.last_modified = last_modified
+
+        response.vary.add('Cookie')
+        # may be stored, but must be revalidated before it's reused
+        response.cache_control.no_cache = True
+        if g.get('user') is None:
+            response.cache_control.public = True
+        else:
+            response.cache_control.private = True
+
+    def conditional(self, validator):
+        """Decorator validating a view's GETs with validator."""
+
+        def decorator(view):
+
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                # pages showing flashed messages are one-offs
+                if '_flashes' in session:
+                    return view(**kwargs)
+
+                validated = validator(**kwargs)
+
+                if validated is None:
+                    return view(**kwargs)
+
+                parts, last_modified = validated
+                etag = self.make_etag(parts)
+
+                if self.is_not_modified(etag, last_modified):
+                    response = Response(status=304)
+                else:
+                    response = make_response(view(**kwargs))
+
+                    if response.status_code != 200:
+                        return response
+
+                self.add_validators(response, etag, last_modified)
+
+                return response
+
+            return wrapper
+
+        return decorator
+
+
+etags = ETags()
@@ -0,0 +1,17 @@
+"""Helpers for Flask Cafe's extensions (job_queue, rate_limiter...)."""
+
+
+def attach(extension, app):
+    """Attach extension to app, from its init_app.
+
+    Extensions are module-level singletons, so there's one app per
+    process: raises RuntimeError if extension is attached to another.
+    """
+
+    current = getattr(extension, 'app', None)
+
+    if current is not None and current is not app:
+        raise RuntimeError(
+            f"{type(extension).__name__} is already attached to another app")
+
+    extension.app = app
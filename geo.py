@@ -0,0 +1,454 @@
+"""Cafe locations: geocoding, and finding the cafes nearest a point.
+
+Cafes are geocoded when their map is fetched, using MapQuest's geocoder
+or (with GEOCODER = 'gazetteer') an offline table of city centres, for
+development & tests. Nearest-cafe queries are answered from an in-memory
+grid index rather than by scanning the cafes table; it's built on first
+use, kept up to date as cafes are committed, and rebuilt in the
+background every NEARBY_INDEX_MAX_AGE seconds. Queries only look
+NEARBY_MAX_RINGS grid cells (~5.5km each) out, so cafes farther than
+that (~275km by default) aren't "nearby".
+"""
+
+import hashlib
+import heapq
+import logging
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from extensions import attach
+from mapquest import mapquest
+from models import db, Cafe
+
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# (city, state) -> (latitude, longitude) of city centre
+GAZETTEER = {
+    ('berkeley', 'CA'): (37.8716, -122.2727),
+    ('los angeles', 'CA'): (34.0522, -118.2437),
+    ('oakland', 'CA'): (37.8044, -122.2712),
+    ('san francisco', 'CA'): (37.7749, -122.4194),
+    ('san jose', 'CA'): (37.3382, -121.8863),
+    ('chicago', 'IL'): (41.8781, -87.6298),
+    ('new york', 'NY'): (40.7128, -74.0060),
+    ('portland', 'OR'): (45.5152, -122.6784),
+    ('seattle', 'WA'): (47.6062, -122.3321),
+}
+
+
+def distance_km(lat1, lng1, lat2, lng2):
+    """Great-circle distance between two points, in km."""
+
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2)
+
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def gazetteer_geocode(address, city, state):
+    """Stand-in geocoder: city centre, nudged (<1km) by address.
+
+    Returns None for cities not in GAZETTEER.
+    """
+
+    centre = GAZETTEER.get((city.lower(), state))
+
+    if centre is None:
+        return None
+
+    # spread a city's cafes out a little, deterministically
+    digest = hashlib.sha256(address.lower().encode('utf8')).digest()
+    nudge_lat = (digest[0] / 255 - 0.5) * 0.01
+    nudge_lng = (digest[1] / 255 - 0.5) * 0.01
+
+    return centre[0] + nudge_lat, centre[1] + nudge_lng
+
+
+def geocode_cafe(cafe):
+    """Set cafe's latitude & longitude from its address.
+
+    Leaves them unset if the location can't be found; raises
+    MapQuestUnavailable if the MapQuest geocoder can't be reached.
+    """
+
+    address, city, state = cafe.get_map_location()
+
+    if current_app.config['GEOCODER'] == 'gazetteer':
+        found = gazetteer_geocode(address, city, state)
+    else:
+        found = mapquest.geocode(f"{address},{city},{state}")
+
+    if found is not None:
+        cafe.latitude, cafe.longitude = found
+
+
+class GridIndex:
+    """Points bucketed into a grid of `cell_size`-degree cells.
+
+    Queries only search `max_rings` rings of cells out, so points farther
+    than that aren't found, but no query probes more than about
+    4 * max_rings ** 2 cells.
+    """
+
+    def __init__(self, cell_size=0.05, max_rings=50):
+        self.cell_size = cell_size
+        self.max_rings = max_rings
+        # (row, col) -> {id: (lat, lng)}
+        self.cells = defaultdict(dict)
+        # id -> (row, col)
+        self.where = {}
+        # row -> number of points in it, and the same for columns
+        self.row_counts = Counter()
+        self.col_counts = Counter()
+        # (min row, max row, min col, max col) of the points, if any
+        self.bounds = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.where)
+
+    def cell_for(self, lat, lng):
+        return (math.floor(lat / self.cell_size),
+                math.floor(lng / self.cell_size))
+
+    def _remove(self, id):
+        cell = self.where.pop(id, None)
+
+        if cell is None:
+            return
+
+        del self.cells[cell][id]
+        if not self.cells[cell]:
+            del self.cells[cell]
+
+        row, col = cell
+        for counts, key in [(self.row_counts, row), (self.col_counts, col)]:
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+
+        if not self.where:
+            self.bounds = None
+            return
+
+        # shrink the bounds past any rows & columns left empty
+        min_row, max_row, min_col, max_col = self.bounds
+        while min_row not in self.row_counts:
+            min_row += 1
+        while max_row not in self.row_counts:
+            max_row -= 1
+        while min_col not in self.col_counts:
+            min_col += 1
+        while max_col not in self.col_counts:
+            max_col -= 1
+        self.bounds = (min_row, max_row, min_col, max_col)
+
+    def add(self, id, lat, lng):
+        with self._lock:
+            self._remove(id)
+            cell = self.cell_for(lat, lng)
+            self.cells[cell][id] = (lat, lng)
+            self.where[id] = cell
+
+            row, col = cell
+            self.row_counts[row] += 1
+            self.col_counts[col] += 1
+
+            if self.bounds is None:
+                self.bounds = (row, row, col, col)
+            else:
+                min_row, max_row, min_col, max_col = self.bounds
+                self.bounds = (min(min_row, row), max(max_row, row),
+                               min(min_col, col), max(max_col, col))
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def nearest(self, lat, lng, k):
+        """Return [(distance_km, id), ...] of the k points nearest lat/lng.
+
+        Searches outward ring by ring from the cell containing lat/lng,
+        stopping once no unsearched cell could hold anything closer, or
+        after max_rings rings (returning what's been found by then).
+        """
+
+        with self._lock:
+            if self.bounds is None or k < 1:
+                return []
+
+            row, col = self.cell_for(lat, lng)
+            min_row, max_row, min_col, max_col = self.bounds
+            # rings nearer than first don't reach the bounds; rings beyond
+            # last are past them
+            first = max(0, min_row - row, row - max_row,
+                        min_col - col, col - max_col)
+            last = min(self.max_rings,
+                       max(row - min_row, max_row - row,
+                           col - min_col, max_col - col))
+
+            best = []   # max-heap of (-distance, -id)
+
+            for ring in range(first, last + 1):
+                if len(best) == k:
+                    # anything beyond this ring is at least this far away
+                    # (lng degrees shrink towards the poles, so be safe)
+                    far_lat = min(abs(lat) + ring * self.cell_size, 89.9)
+                    bound = ((ring - 1) * self.cell_size * KM_PER_DEGREE
+                             * math.cos(math.radians(far_lat)))
+                    if bound > -best[0][0]:
+                        break
+
+                for cell in self._ring(row, col, ring):
+                    points = self.cells.get(cell, {})
+                    for id, (p_lat, p_lng) in points.items():
+                        entry = (-distance_km(lat, lng, p_lat, p_lng), -id)
+                        if len(best) < k:
+                            heapq.heappush(best, entry)
+                        elif entry > best[0]:
+                            heapq.heapreplace(best, entry)
+
+        return [(-neg_dist, -neg_id)
+                for neg_dist, neg_id in sorted(best, reverse=True)]
+
+    def _ring(self, row, col, ring):
+        """Cells exactly `ring` cells away from (row, col), within bounds.
+
+        Call with the lock held.
+        """
+
+        if ring == 0:
+            yield (row, col)
+            return
+
+        min_row, max_row, min_col, max_col = self.bounds
+        cols = range(max(col - ring, min_col), min(col + ring, max_col) + 1)
+        rows = range(max(row - ring + 1, min_row),
+                     min(row + ring - 1, max_row) + 1)
+
+        for r in (row - ring, row + ring):
+            if min_row <= r <= max_row:
+                for c in cols:
+                    yield (r, c)
+        for c in (col - ring, col + ring):
+            if min_col <= c <= max_col:
+                for r in rows:
+                    yield (r, c)
+
+
+def apply_location_updates(index, updates):
+    """Apply {cafe id: (lat, lng), or None if gone} to index."""
+
+    for cafe_id, location in updates.items():
+        if location is None:
+            index.remove(cafe_id)
+        else:
+            index.add(cafe_id, *location)
+
+
+class NearbyCafes:
+    """Finds cafes nearest a point, from an in-memory GridIndex."""
+
+    def __init__(self):
+        self.app = None
+        self.index = None
+        self.built_at = 0
+        # background thread rebuilding a stale index
+        self.refresher = None
+        # location updates committed while rebuilding, to re-apply to it
+        self.refreshing = False
+        self.changes = []
+        # bumped by reset(), so rebuilds started before it are dropped
+        self.generation = 0
+        self._lock = threading.Lock()
+        # held while rebuilding, so there's one rebuild at a time
+        self._refresh_lock = threading.Lock()
+
+    def init_app(self, app):
+        attach(self, app)
+
+        app.config.setdefault('GEOCODER', 'mapquest')
+        app.config.setdefault('NEARBY_MAX_RESULTS', 50)
+        # rebuild this often, to pick up other processes' changes
+        app.config.setdefault('NEARBY_INDEX_MAX_AGE', 300)
+        # how far (in grid cells, ~5.5km each) to look for cafes
+        app.config.setdefault('NEARBY_MAX_RINGS', 50)
+
+    def _build(self):
+        """Build a GridIndex of every geocoded cafe."""
+
+        index = GridIndex(max_rings=self.app.config['NEARBY_MAX_RINGS'])
+        rows = (db.session.query(Cafe.id, Cafe.latitude, Cafe.longitude)
+                .filter(Cafe.latitude.isnot(None)))
+
+        for id, lat, lng in rows.yield_per(1000):
+            index.add(id, lat, lng)
+
+        return index
+
+    def _rebuild(self):
+        """Build a new index and switch to it. Call with _refresh_lock."""
+
+        with self._lock:
+            generation = self.generation
+            self.refreshing = True
+            self.changes = []
+
+        try:
+            started = time.monotonic()
+            index = self._build()
+
+            with self._lock:
+                if generation == self.generation:
+                    for updates in self.changes:
+                        apply_location_updates(index, updates)
+                    self.index = index
+                    self.built_at = started
+        finally:
+            with self._lock:
+                self.refreshing = False
+                self.changes = []
+
+    def refresh(self):
+        """Rebuild the index from the cafes table.
+
+        Slow (it reads every cafe), so get_index runs it in the
+        background; call it directly to wait for it.
+        """
+
+        with self._refresh_lock:
+            self._rebuild()
+
+    def _refresh_in_background(self):
+        with self.app.app_context():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Couldn't rebuild the nearby cafes index")
+
+    def get_index(self):
+        """Return the grid index, building it if there's none yet.
+
+        Once there is one, it's rebuilt in a background thread when it's
+        NEARBY_INDEX_MAX_AGE old, and used until the new one's ready.
+        """
+
+        max_age = self.app.config['NEARBY_INDEX_MAX_AGE']
+
+        with self._lock:
+            index = self.index
+            stale = (index is not None
+                     and time.monotonic() - self.built_at > max_age)
+
+            if stale and not self.refreshing and not (
+                    self.refresher and self.refresher.is_alive()):
+                self.refresher = threading.Thread(
+                    target=self._refresh_in_background,
+                    name='nearby-refresh',
+                    daemon=True,
+                )
+                self.refresher.start()
+
+        if index is None:
+            # nothing to serve yet: build it (or wait for whoever is)
+            with self._refresh_lock:
+                if self.index is None:
+                    self._rebuild()
+                index = self.index
+
+        return index
+
+    def reset(self):
+        with self._lock:
+            self.generation += 1
+            self.index = None
+
+    def update(self, updates):
+        """Apply committed {cafe id: (lat, lng), or None if gone}."""
+
+        with self._lock:
+            if self.index is not None:
+                apply_location_updates(self.index, updates)
+            if self.refreshing:
+                self.changes.append(updates)
+
+    def nearest(self, lat, lng, k):
+        """Return [(Cafe, distance_km), ...] for the k nearest cafes."""
+
+        k = min(k, self.app.config['NEARBY_MAX_RESULTS'])
+        index = self.get_index()
+
+        if index is None:
+            return []
+
+        found = index.nearest(lat, lng, k)
+        cafes = Cafe.query.filter(Cafe.id.in_([id for _, id in found]))
+        cafes = {cafe.id: cafe for cafe in cafes}
+
+        return [(cafes[id], dist) for dist, id in found if id in cafes]
+
+
+nearby_cafes = NearbyCafes()
+
+
+#######################################
+# keeping the grid index in sync
+
+
+@event.listens_for(Cafe, 'after_insert')
+@event.listens_for(Cafe, 'after_update')
+def note_cafe_location(mapper, connection, cafe):
+    """Remember cafe's location, to reindex it when the session commits."""
+
+    attrs = inspect(cafe).attrs
+    if not (attrs.latitude.history.has_changes()
+            or attrs.longitude.history.has_changes()):
+        return
+
+    pending = object_session(cafe).info.setdefault('location_updates', {})
+
+    if cafe.latitude is None or cafe.longitude is None:
+        pending[cafe.id] = None
+    else:
+        pending[cafe.id] = (cafe.latitude, cafe.longitude)
+
+
+@event.listens_for(Cafe, 'after_delete')
+def note_cafe_deleted(mapper, connection, cafe):
+    pending = object_session(cafe).info.setdefault('location_updates', {})
+    pending[cafe.id] = None
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def note_bulk_cafe_change(context):
+    if context.mapper.class_ is Cafe:
+        context.session.info['location_reset'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def update_location_index(session):
+    updates = session.info.pop('location_updates', {})
+
+    if session.info.pop('location_reset', False):
+        nearby_cafes.reset()
+
+    if updates:
+        nearby_cafes.update(updates)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_location_updates(session):
+    session.info.pop('location_updates', None)
+    session.info.pop('location_reset', None)
@@ -0,0 +1,129 @@
+"""Per-request SQL instrumentation.
+
+Counts the SQL statements each request runs and how long they take, and
+reports them three ways:
+
+- a `Server-Timing` header (shown in the browser's dev tools), like
+  `db;dur=4.2;desc="3 queries", total;dur=11.8`
+- a log line per request, of key=value pairs, on the "instrumentation"
+  logger at INFO
+- a warning when a request runs more than SQL_QUERY_BUDGET statements,
+  which is usually an N+1 (a query per row of a listing)
+
+Statements run outside a request (CLI commands, background jobs) aren't
+counted.
+"""
+
+import logging
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from extensions import attach
+
+
+logger = logging.getLogger(__name__)
+
+
+class RequestStats:
+    """SQL statements run (& time spent in them) by one request."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+
+    @property
+    def total_time(self):
+        return time.perf_counter() - self.started
+
+
+class SQLInstrumentation:
+    """Times each request's SQL and reports it."""
+
+    def __init__(self):
+        self.app = None
+
+    def init_app(self, app):
+        attach(self, app)
+
+        app.config.setdefault('SQL_QUERY_BUDGET', 10)
+        app.config.setdefault('SQL_SERVER_TIMING', True)
+
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+
+    @staticmethod
+    def current():
+        """This request's RequestStats, or None outside of a request."""
+
+        if not has_request_context():
+            return None
+        return g.get('sql_stats')
+
+    @staticmethod
+    def start_request():
+        g.sql_stats = RequestStats()
+
+    def finish_request(self, response):
+        stats = g.pop('sql_stats', None)
+
+        if stats is None:
+            return response
+
+        db_ms = stats.db_time * 1000
+        total_ms = stats.total_time * 1000
+
+        if self.app.config['SQL_SERVER_TIMING']:
+            response.headers.add(
+                'Server-Timing',
+                f'db;dur={db_ms:.1f};desc="{stats.queries} queries", '
+                f'total;dur={total_ms:.1f}')
+
+        logger.info(
+            "method=%s path=%s status=%s queries=%d db_ms=%.1f total_ms=%.1f",
+            request.method, request.path, response.status_code,
+            stats.queries, db_ms, total_ms)
+
+        budget = self.app.config['SQL_QUERY_BUDGET']
+        if budget and stats.queries > budget:
+            logger.warning(
+                "%s %s ran %d SQL statements (budget is %d)",
+                request.method, request.path, stats.queries, budget)
+
+        return response
+
+
+sql_instrumentation = SQLInstrumentation()
+
+
+#######################################
+# timing statements, on every engine
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    if SQLInstrumentation.current() is not None:
+        conn.info.setdefault('sql_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    stats = SQLInstrumentation.current()
+    started = conn.info.get('sql_started')
+
+    if stats is not None and started:
+        stats.queries += 1
+        stats.db_time += time.perf_counter() - started.pop()
+
+
+@event.listens_for(Engine, 'handle_error')
+def forget_failed_statement(context):
+    started = context.connection.info.get('sql_started')
+
+    if started:
+        started.pop()
@@ -0,0 +1,329 @@
+"""Background job queue for Flask Cafe.
+
+Slow work (like fetching cafe maps from MapQuest) is enqueued here rather
+than run inside the request. Which backend runs the jobs is chosen by the
+JOB_QUEUE_BACKEND setting:
+
+- "thread": an in-process thread pool (default)
+- "database": a durable `jobs` table polled by worker threads, so queued
+  work survives a restart; a job whose worker dies mid-run is picked up
+  again once its JOB_LEASE_TIMEOUT-second lease runs out
+- "inline": run the job immediately, in the caller (for tests & scripts)
+"""
+
+import json
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+
+from flask import current_app, has_app_context
+
+from extensions import attach
+from models import db, Job
+
+
+logger = logging.getLogger(__name__)
+
+
+class Task:
+    """A named job function, plus what to do once retries run out."""
+
+    def __init__(self, name, func, on_give_up=None):
+        self.name = name
+        self.func = func
+        self.on_give_up = on_give_up
+
+
+class JobQueue:
+    """Registry of tasks and front door for enqueueing them."""
+
+    def __init__(self, app=None):
+        self.tasks = {}
+        self.app = None
+        self._backend = None
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Attach queue to app and set default configuration."""
+
+        attach(self, app)
+
+        app.config.setdefault('JOB_QUEUE_BACKEND', 'thread')
+        app.config.setdefault('JOB_QUEUE_WORKERS', 2)
+        app.config.setdefault('JOB_MAX_ATTEMPTS', 4)
+        app.config.setdefault('JOB_RETRY_BACKOFF', 2.0)
+        app.config.setdefault('JOB_POLL_INTERVAL', 1.0)
+        # how long a database job may run before it's presumed lost
+        app.config.setdefault('JOB_LEASE_TIMEOUT', 600)
+
+        app.extensions['job_queue'] = self
+
+    def task(self, name=None, on_give_up=None):
+        """Decorator registering a function as a task."""
+
+        def register(func):
+            task_name = name or func.__name__
+            self.tasks[task_name] = Task(task_name, func, on_give_up)
+            return func
+
+        return register
+
+    @property
+    def backend(self):
+        """Backend picked from config the first time it's needed."""
+
+        with self._lock:
+            if self._backend is None:
+                kind = self.app.config['JOB_QUEUE_BACKEND']
+                self._backend = BACKENDS[kind](self)
+            return self._backend
+
+    def enqueue(self, name, *args):
+        """Queue task `name` to be run with `args` (which must be JSON-able)."""
+
+        if name not in self.tasks:
+            raise KeyError(f"No such task: {name}")
+
+        self.backend.submit(name, list(args))
+
+    def app_context(self):
+        """Context to run a job in: our app's, unless we're already in it.
+
+        (Pushing a second context for the same app in the same thread would
+        close the caller's database session when it's popped.)
+        """
+
+        if (has_app_context()
+                and current_app._get_current_object() is self.app):
+            return nullcontext()
+
+        return self.app.app_context()
+
+    def retry_delay(self, attempt):
+        """Seconds to wait before retrying after failed `attempt` (1-based)."""
+
+        return self.app.config['JOB_RETRY_BACKOFF'] * 2 ** (attempt - 1)
+
+    def run_once(self, name, args):
+        """Run one attempt of a task in an app context.
+
+        Returns True if it succeeded; failures are logged, not raised.
+        """
+
+        task = self.tasks[name]
+
+        with self.app_context():
+            try:
+                task.func(*args)
+                return True
+            except Exception:
+                logger.exception("Job %s%r failed", name, tuple(args))
+                db.session.rollback()
+                return False
+
+    def give_up(self, name, args):
+        """Call task's give-up hook after its final failed attempt."""
+
+        task = self.tasks[name]
+        logger.error("Giving up on job %s%r", name, tuple(args))
+
+        if task.on_give_up:
+            with self.app_context():
+                task.on_give_up(*args)
+
+    def run_with_retries(self, name, args):
+        """Run task until it succeeds or runs out of attempts."""
+
+        max_attempts = self.app.config['JOB_MAX_ATTEMPTS']
+
+        for attempt in range(1, max_attempts + 1):
+            if self.run_once(name, args):
+                return True
+            if attempt < max_attempts:
+                time.sleep(self.retry_delay(attempt))
+
+        self.give_up(name, args)
+        return False
+
+    def shutdown(self, wait=True):
+        """Stop the backend's workers (they're restarted on next enqueue)."""
+
+        with self._lock:
+            if self._backend is not None:
+                self._backend.shutdown(wait)
+                self._backend = None
+
+
+class InlineBackend:
+    """Runs jobs right away, in the calling thread."""
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def submit(self, name, args):
+        self.queue.run_with_retries(name, args)
+
+    def shutdown(self, wait):
+        pass
+
+
+class ThreadBackend:
+    """Runs jobs on an in-process thread pool; lost if the process exits."""
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.executor = ThreadPoolExecutor(
+            max_workers=queue.app.config['JOB_QUEUE_WORKERS'],
+            thread_name_prefix='job-queue',
+        )
+
+    def submit(self, name, args):
+        self.executor.submit(self.queue.run_with_retries, name, args)
+
+    def shutdown(self, wait):
+        self.executor.shutdown(wait=wait)
+
+
+class DatabaseBackend:
+    """Stores jobs in the `jobs` table; worker threads poll and run them.
+
+    Retries are rescheduled in the table rather than slept on, so a
+    worker is never tied up waiting out a backoff.
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.stopping = threading.Event()
+        self.workers = [
+            threading.Thread(
+                target=self.work,
+                name=f'job-queue-db-{i}',
+                daemon=True,
+            )
+            for i in range(queue.app.config['JOB_QUEUE_WORKERS'])
+        ]
+
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, name, args):
+        with self.queue.app_context():
+            db.session.add(Job(name=name, args=json.dumps(args)))
+            db.session.commit()
+
+    def claim(self):
+        """Mark the next due job as running and return it, or None.
+
+        Due jobs are pending ones whose time has come, and running ones
+        whose lease (run_at, while running) has run out: their worker
+        must have died. Those past JOB_MAX_ATTEMPTS are given up on.
+        """
+
+        config = self.queue.app.config
+        now = datetime.utcnow()
+
+        with self.queue.app.app_context():
+            job = (Job.query
+                   .filter(Job.status.in_(['pending', 'running']))
+                   .filter(Job.run_at <= now)
+                   .order_by(Job.run_at, Job.id)
+                   .first())
+
+            if job is None:
+                return None
+
+            claimed = (job.id, job.name, json.loads(job.args),
+                       job.attempts + 1)
+            lost = claimed[3] > config['JOB_MAX_ATTEMPTS']
+
+            if lost:
+                changes = {'status': 'failed'}
+            else:
+                lease = timedelta(seconds=config['JOB_LEASE_TIMEOUT'])
+                changes = {'status': 'running',
+                           'attempts': Job.attempts + 1,
+                           'run_at': now + lease}
+
+            # another worker may have claimed it since we looked
+            updated = (Job.query
+                       .filter_by(id=job.id, status=job.status,
+                                  attempts=job.attempts)
+                       .update(changes, synchronize_session=False))
+            db.session.commit()
+
+        if not updated:
+            return None
+
+        if lost:
+            self.queue.give_up(claimed[1], claimed[2])
+            return None
+
+        return claimed
+
+    def finish(self, job_id, name, args, attempt, succeeded):
+        """Record the outcome of one attempt at a job."""
+
+        max_attempts = self.queue.app.config['JOB_MAX_ATTEMPTS']
+
+        if succeeded:
+            status = 'done'
+        elif attempt < max_attempts:
+            status = 'pending'
+        else:
+            status = 'failed'
+
+        with self.queue.app.app_context():
+            job = Job.query.get(job_id)
+            job.status = status
+
+            if status == 'pending':
+                delay = self.queue.retry_delay(attempt)
+                job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+
+            db.session.commit()
+
+        if status == 'failed':
+            self.queue.give_up(name, args)
+
+    def work(self):
+        """Worker loop: run due jobs, sleeping when there are none."""
+
+        poll_interval = self.queue.app.config['JOB_POLL_INTERVAL']
+
+        while not self.stopping.is_set():
+            try:
+                claimed = self.claim()
+            except Exception:
+                logger.exception("Couldn't claim job")
+                claimed = None
+
+            if claimed is None:
+                self.stopping.wait(poll_interval)
+                continue
+
+            job_id, name, args, attempt = claimed
+            succeeded = self.queue.run_once(name, args)
+            self.finish(job_id, name, args, attempt, succeeded)
+
+    def shutdown(self, wait):
+        self.stopping.set()
+
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+
+BACKENDS = {
+    'inline': InlineBackend,
+    'thread': ThreadBackend,
+    'database': DatabaseBackend,
+}
+
+
+job_queue = JobQueue()
@@ -0,0 +1,268 @@
+"""Write-behind buffering of likes & unlikes.
+
+Normally each like or unlike is its own transaction, so a cafe that
+suddenly gets popular has every request waiting on the same likes table
+(and like count) rows. With LIKE_BUFFER on, the like views just record
+the user's intent here and return.
+
+Only the last intent per (user, cafe) is kept, so toggling a cafe back &
+forth costs at most one write. A flusher thread writes whatever's waiting
+in one transaction every LIKE_BUFFER_INTERVAL seconds, or as soon as
+LIKE_BUFFER_MAX_EVENTS are waiting, and once more at exit.
+
+Users see their own likes right away: before any GET from a user with
+intents waiting, theirs are written first. Other users (and like counts)
+may be up to LIKE_BUFFER_INTERVAL behind.
+
+Buffers are per process: if one user's likes & unlikes of a cafe land on
+different worker processes within an interval, the last flushed wins.
+Intents still buffered when a process is killed (not shut down) are lost.
+"""
+
+import atexit
+import logging
+import threading
+from contextlib import nullcontext
+
+from flask import current_app, has_app_context, request, session
+from sqlalchemy.exc import IntegrityError
+
+from extensions import attach
+from models import db, UserLikesCafe
+
+
+logger = logging.getLogger(__name__)
+
+# requests that flush the user's intents first, so they see them
+READ_METHODS = {'GET', 'HEAD'}
+
+
+class LikeBuffer:
+    """Buffers like/unlike intents and writes them in batches."""
+
+    def __init__(self):
+        self.app = None
+        self.user_key = None
+        # user id -> {cafe id: liked?}
+        self.pending = {}
+        # ids of users whose intents are being written right now
+        self.writing = set()
+        self.size = 0
+        self.flushed = 0
+        self.batches = 0
+        self._lock = threading.Lock()
+        # held while writing, so a user's intents can't be written twice
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._registered = False
+
+    def init_app(self, app, user_key):
+        """Attach to app; user_key is the session key holding user ids."""
+
+        attach(self, app)
+
+        app.config.setdefault('LIKE_BUFFER', False)
+        app.config.setdefault('LIKE_BUFFER_INTERVAL', 0.2)
+        app.config.setdefault('LIKE_BUFFER_MAX_EVENTS', 500)
+
+        app.before_request(self.flush_for_reader)
+        self.user_key = user_key
+
+    @property
+    def enabled(self):
+        return self.app.config['LIKE_BUFFER']
+
+    def add(self, user_id, cafe_id, liked):
+        """Buffer user's intent to like (or, if not liked, unlike) cafe."""
+
+        with self._lock:
+            intents = self.pending.setdefault(user_id, {})
+
+            if cafe_id not in intents:
+                self.size += 1
+            intents[cafe_id] = liked
+
+            full = self.size >= self.app.config['LIKE_BUFFER_MAX_EVENTS']
+            self._start()
+
+        if full:
+            self._wake.set()
+
+    def _start(self):
+        """Start the flusher thread if it isn't running.
+
+        Call with the lock held.
+        """
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self.run, name='like-buffer', daemon=True)
+        self._thread.start()
+
+        if not self._registered:
+            atexit.register(self.shutdown)
+            self._registered = True
+
+    def run(self):
+        """Flusher loop: flush every interval, or sooner when woken."""
+
+        while not self._stopping.is_set():
+            self._wake.wait(self.app.config['LIKE_BUFFER_INTERVAL'])
+            self._wake.clear()
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Couldn't flush buffered likes")
+
+    def app_context(self):
+        """Our app's context, unless we're already in it (see jobs.py)."""
+
+        if (has_app_context()
+                and current_app._get_current_object() is self.app):
+            return nullcontext()
+
+        return self.app.app_context()
+
+    def _take(self, user_id=None):
+        """Remove & return [(user id, cafe id, liked), ...] to write.
+
+        Takes just user_id's, if given; otherwise everyone's.
+        """
+
+        with self._lock:
+            if user_id is None:
+                pending, self.pending = self.pending, {}
+            else:
+                pending = {}
+                if user_id in self.pending:
+                    pending[user_id] = self.pending.pop(user_id)
+
+            intents = [(user_id, cafe_id, liked)
+                       for user_id, cafes in pending.items()
+                       for cafe_id, liked in cafes.items()]
+            self.size -= len(intents)
+            self.writing.update(pending)
+
+        return intents
+
+    def _put_back(self, intents):
+        """Re-buffer intents that weren't written, behind any newer ones."""
+
+        with self._lock:
+            for user_id, cafe_id, liked in intents:
+                cafes = self.pending.setdefault(user_id, {})
+                if cafe_id not in cafes:
+                    cafes[cafe_id] = liked
+                    self.size += 1
+
+    @staticmethod
+    def _write(intents):
+        # in cafe order, so concurrent writers lock like counts in the
+        # same order and can't deadlock on them
+        for user_id, cafe_id, liked in sorted(
+                intents, key=lambda intent: (intent[1], intent[0])):
+            if liked:
+                UserLikesCafe.like(user_id, cafe_id)
+            else:
+                UserLikesCafe.unlike(user_id, cafe_id)
+
+        db.session.commit()
+
+    def flush(self, user_id=None):
+        """Write buffered intents in one transaction; return how many.
+
+        Writes just user_id's intents, if given. If the batch fails, it's
+        put back to be retried; except if a row was refused (say, the
+        user has since been deleted), then the intents are written one by
+        one and the refused ones dropped.
+        """
+
+        with self._flush_lock:
+            intents = self._take(user_id)
+
+            if not intents:
+                return 0
+
+            try:
+                with self.app_context():
+                    try:
+                        self._write(intents)
+                        written = len(intents)
+                    except IntegrityError:
+                        db.session.rollback()
+                        written = self._write_each(intents)
+                    except Exception:
+                        db.session.rollback()
+                        self._put_back(intents)
+                        raise
+            finally:
+                with self._lock:
+                    self.writing.clear()
+
+            with self._lock:
+                self.flushed += written
+                self.batches += 1
+
+            return written
+
+    def _write_each(self, intents):
+        written = 0
+
+        for intent in intents:
+            try:
+                self._write([intent])
+                written += 1
+            except IntegrityError:
+                db.session.rollback()
+                logger.warning("Dropped buffered like %r", intent)
+
+        return written
+
+    def flush_for_reader(self):
+        """Before a GET, write the user's own intents so they see them.
+
+        If some are being written already, waits for that to finish.
+        """
+
+        user_id = session.get(self.user_key)
+
+        if request.method not in READ_METHODS or user_id is None:
+            return
+
+        with self._lock:
+            waiting = user_id in self.pending or user_id in self.writing
+
+        if waiting:
+            self.flush(user_id)
+
+    def stats(self):
+        """Return dict of intents waiting & written, and batches written."""
+
+        with self._lock:
+            return {
+                'pending': self.size,
+                'flushed': self.flushed,
+                'batches': self.batches,
+            }
+
+    def shutdown(self):
+        """Stop the flusher thread and write everything still buffered."""
+
+        with self._lock:
+            thread, self._thread = self._thread, None
+
+        if thread is not None:
+            self._stopping.set()
+            self._wake.set()
+            thread.join()
+
+        self.flush()
+
+
+like_buffer = LikeBuffer()
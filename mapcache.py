@@ -0,0 +1,139 @@
+"""Content-addressed cache of static map images.
+
+Maps are stored under a hash of the normalized location they show, so a
+cafe whose address hasn't changed (or two cafes at the same address) can
+reuse an image we already have instead of asking MapQuest again. The
+cache is bounded in size; least recently used images are evicted first.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+from extensions import attach
+
+
+APP_DIR = os.path.abspath(os.path.dirname(__file__))
+DEFAULT_MAPS_DIR = os.path.join(APP_DIR, 'static', 'images', 'maps')
+DEFAULT_CACHE_DIR = os.path.join(DEFAULT_MAPS_DIR, 'cache')
+DEFAULT_MAX_BYTES = 200 * 1024 * 1024
+
+
+def location_key(address, city, state):
+    """Return hash identifying a location, ignoring case & spacing."""
+
+    normalized = ','.join(
+        ' '.join(part.split()).lower() for part in (address, city, state))
+
+    return hashlib.sha256(normalized.encode('utf8')).hexdigest()
+
+
+class MapCache:
+    """Directory of map images named by location key, with LRU eviction.
+
+    Also knows `maps_dir`, where each cafe's own map image is served from.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES, maps_dir=DEFAULT_MAPS_DIR):
+        self.app = None
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.maps_dir = maps_dir
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Take cache location & size limit from app config."""
+
+        attach(self, app)
+        self.maps_dir = app.config.setdefault('MAPS_DIR', self.maps_dir)
+        self.directory = app.config.setdefault(
+            'MAP_CACHE_DIR', self.directory)
+        self.max_bytes = app.config.setdefault(
+            'MAP_CACHE_MAX_BYTES', self.max_bytes)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, f'{key}.jpeg')
+
+    def get(self, key):
+        """Return path of cached image for key, or None if not cached."""
+
+        path = self.path_for(key)
+
+        try:
+            # bump mtime: it's what eviction uses to find the LRU image
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    def put(self, key, content):
+        """Store image content under key; return its path."""
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path_for(key)
+
+        # write to a temp file and rename, so readers never see half a map
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Remove least recently used images until under max_bytes.
+
+        The image at path `keep` (if given) is never removed.
+        """
+
+        with self._lock:
+            entries = []
+            total = 0
+
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith('.jpeg'):
+                        stat = entry.stat()
+                        total += stat.st_size
+                        if entry.path != keep:
+                            entries.append((stat.st_mtime, stat.st_size,
+                                            entry.path))
+
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def link(self, key, dest):
+        """Make dest a copy of the cached image for key.
+
+        Uses a hard link where possible, so the image isn't duplicated on
+        disk and outlives the cache entry if that's evicted.
+        """
+
+        src = self.path_for(key)
+        tmp_dest = f'{dest}.tmp'
+
+        try:
+            os.remove(tmp_dest)
+        except FileNotFoundError:
+            pass
+
+        try:
+            os.link(src, tmp_dest)
+        except OSError:
+            shutil.copyfile(src, tmp_dest)
+
+        os.replace(tmp_dest, dest)
+
+
+map_cache = MapCache()
@@ -0,0 +1,254 @@
+"""Shared HTTP client for the MapQuest API.
+
+All MapQuest calls go through one pooled requests session with connect &
+read timeouts and a bounded number of retries. A circuit breaker stops us
+calling MapQuest at all for a while after several consecutive failures,
+so when it's down we fail fast (and cafes keep their placeholder map)
+instead of tying up workers waiting on it.
+"""
+
+import json
+import logging
+import threading
+import time
+from urllib.parse import urlencode
+
+from extensions import attach
+
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BASE_URL = "https://www.mapquestapi.com"
+
+
+class MapQuestUnavailable(Exception):
+    """MapQuest couldn't be reached, errored, or the circuit is open."""
+
+
+class CircuitOpen(MapQuestUnavailable):
+    """Call refused without trying: MapQuest has been failing."""
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures and decides whether to allow calls.
+
+    Closed: calls go through. After `failure_threshold` consecutive
+    failures it opens, refusing calls for `reset_timeout` seconds; then it
+    lets a single trial call through (half-open), closing again if that
+    succeeds and reopening if it fails.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0,
+                 clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def allow(self):
+        """Should a call be attempted now?"""
+
+        with self._lock:
+            state = self.state
+
+            if state == 'closed':
+                return True
+
+            if state == 'half-open' and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_in_flight = False
+
+            if (self.opened_at is not None
+                    or self.failures >= self.failure_threshold):
+                self.opened_at = self.clock()
+
+
+class MapQuestClient:
+    """Pooled, bounded, circuit-broken client for MapQuest."""
+
+    def __init__(self, app=None):
+        self.app = None
+        self.base_url = DEFAULT_BASE_URL
+        self.api_key = None
+        self.timeout = (3.05, 10)
+        self.retries = 2
+        self.pool_size = 10
+        self.breaker = CircuitBreaker()
+
+        self._session = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure client from app config."""
+
+        attach(self, app)
+        config = app.config
+        self.api_key = config.get('MAPQUEST_API_KEY')
+        self.base_url = config.setdefault('MAPQUEST_BASE_URL', self.base_url)
+        self.timeout = (
+            config.setdefault('MAPQUEST_CONNECT_TIMEOUT', self.timeout[0]),
+            config.setdefault('MAPQUEST_READ_TIMEOUT', self.timeout[1]),
+        )
+        self.retries = config.setdefault('MAPQUEST_RETRIES', self.retries)
+        self.pool_size = config.setdefault(
+            'MAPQUEST_POOL_SIZE', self.pool_size)
+        self.breaker = CircuitBreaker(
+            failure_threshold=config.setdefault(
+                'MAPQUEST_BREAKER_THRESHOLD', 5),
+            reset_timeout=config.setdefault('MAPQUEST_BREAKER_RESET', 30.0),
+        )
+
+        self.close()
+
+    @property
+    def session(self):
+        """Shared session, created on first use."""
+
+        # requests is slow to import & only needed once we call MapQuest
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+
+        with self._lock:
+            if self._session is None:
+                retry = Retry(
+                    total=self.retries,
+                    backoff_factor=0.2,
+                    status_forcelist=(500, 502, 503, 504),
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_size,
+                    pool_maxsize=self.pool_size,
+                    max_retries=retry,
+                )
+                session = requests.Session()
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+
+            return self._session
+
+    def close(self):
+        """Close pooled connections (a new session is made on next use)."""
+
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = 0
+            self.failures = 0
+            self.short_circuits = 0
+            self.total_latency = 0.0
+
+    def stats(self):
+        """Return dict of call counters and latency."""
+
+        with self._lock:
+            attempted = self.calls - self.short_circuits
+            return {
+                'calls': self.calls,
+                'failures': self.failures,
+                'short_circuits': self.short_circuits,
+                'total_latency': self.total_latency,
+                'avg_latency': (self.total_latency / attempted
+                                if attempted else 0.0),
+                'breaker_state': self.breaker.state,
+            }
+
+    def _count(self, failed=False, short_circuited=False, latency=0.0):
+        with self._lock:
+            self.calls += 1
+            self.failures += failed
+            self.short_circuits += short_circuited
+            self.total_latency += latency
+
+    def static_map_url(self, where):
+        """Get URL for a static map centered on & marking `where`."""
+
+        base = f"{self.base_url}/staticmap/v5/map?key={self.api_key}"
+        return f"{base}&center={where}&size=@2x&zoom=15&locations={where}"
+
+    def geocode_url(self, location):
+        """Get URL for geocoding a free-text location."""
+
+        query = urlencode(dict(key=self.api_key, location=location,
+                               maxResults=1))
+        return f"{self.base_url}/geocoding/v1/address?{query}"
+
+    def geocode(self, location):
+        """Return (latitude, longitude) of location, or None if not found.
+
+        Raises MapQuestUnavailable like get().
+        """
+
+        try:
+            data = json.loads(self.get(self.geocode_url(location)))
+            lat_lng = data['results'][0]['locations'][0]['latLng']
+        except (ValueError, KeyError, IndexError):
+            return None
+
+        return lat_lng['lat'], lat_lng['lng']
+
+    def get(self, url):
+        """GET url from MapQuest and return the response body.
+
+        Raises MapQuestUnavailable if it can't be fetched, or CircuitOpen
+        (without calling MapQuest) if it's been failing.
+        """
+
+        if not self.breaker.allow():
+            self._count(failed=True, short_circuited=True)
+            raise CircuitOpen(url)
+
+        import requests
+
+        start = time.monotonic()
+
+        try:
+            response = self.session.get(url, timeout=self.timeout)
+            response.raise_for_status()
+        except requests.RequestException as exc:
+            self._count(failed=True, latency=time.monotonic() - start)
+            self.breaker.record_failure()
+            logger.warning("MapQuest request failed: %s", exc)
+            raise MapQuestUnavailable(url) from exc
+
+        self._count(latency=time.monotonic() - start)
+        self.breaker.record_success()
+
+        return response.content
+
+
+mapquest = MapQuestClient()
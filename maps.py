@@ -0,0 +1,43 @@
+"""Static map fetching for cafes, run on the background job queue."""
+
+from geo import geocode_cafe
+from jobs import job_queue
+from models import db, Cafe
+
+
+def mark_map_failed(cafe_id):
+    """Record that we gave up on fetching this cafe's map."""
+
+    cafe = Cafe.query.get(cafe_id)
+
+    if cafe is not None:
+        cafe.map_status = 'failed'
+        db.session.commit()
+
+
+@job_queue.task(on_give_up=mark_map_failed)
+def fetch_cafe_map(cafe_id):
+    """Download and save the static map for a cafe, and geocode it."""
+
+    cafe = Cafe.query.get(cafe_id)
+
+    # cafe may have been deleted while the job was queued
+    if cafe is None:
+        return
+
+    cafe.save_map()
+
+    if cafe.latitude is None:
+        geocode_cafe(cafe)
+
+    db.session.commit()
+
+
+def queue_map_fetch(cafe):
+    """Queue a job to fetch cafe's map.
+
+    Call after the cafe (with map_status 'pending') has been committed,
+    so the job can find it.
+    """
+
+    job_queue.enqueue('fetch_cafe_map', cafe.id)
@@ -1,16 +1,28 @@
 """Data models for Flask Cafe"""
 
 
-from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
-from secrets import MAPQUEST_API_KEY as API_KEY
+from sqlalchemy import DDL, event, inspect, literal, select
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session, load_only, object_session
+from pagination import keyset_page
+from mapcache import map_cache, location_key
+from mapquest import mapquest
+from passwords import PasswordHasherBusy, password_hasher
+from collections import namedtuple
+from datetime import datetime
 import os
-import requests
+import threading
+import time
 
 
-bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+MAP_PLACEHOLDER_URL = "/static/images/map-placeholder.svg"
+
+# how much of each cafe's description lists of favorites show
+DESCRIPTION_PREVIEW = 200
+
 
 class City(db.Model):
     """Cities for cafes."""
@@ -33,10 +45,109 @@ class City(db.Model):
     )
 
 
+CityInfo = namedtuple('CityInfo', ['code', 'name', 'state'])
+
+
+class CityRegistry:
+    """In-process copy of the cities table.
+
+    Cities almost never change, so rather than query them on every page
+    we load them all once. Committing a change to a City bumps `version`,
+    and the next lookup reloads. Changes made by other processes are
+    picked up when we meet an unknown city code, or after `max_age`
+    seconds.
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.version = 0
+        self._loaded_version = None
+        self._loaded_at = 0
+        self._cities = {}
+        self._lock = threading.Lock()
+
+    def bump(self):
+        """Note that cities have changed, so we reload on next lookup."""
+
+        with self._lock:
+            self.version += 1
+
+    def _load(self):
+        """Return {code: CityInfo}, (re)loading from database if stale."""
+
+        with self._lock:
+            fresh = (self._loaded_version == self.version
+                     and time.monotonic() - self._loaded_at < self.max_age)
+
+            if not fresh:
+                version = self.version
+                rows = db.session.query(City.code, City.name, City.state)
+                self._cities = {
+                    code: CityInfo(code, name, state)
+                    for code, name, state in rows.order_by(City.name)
+                }
+                self._loaded_version = version
+                self._loaded_at = time.monotonic()
+
+            return self._cities
+
+    def get(self, code):
+        """Return CityInfo for city code, or None if there's no such city."""
+
+        city = self._load().get(code)
+
+        if city is None:
+            # may have been added by another process since we loaded
+            self.bump()
+            city = self._load().get(code)
+
+        return city
+
+    def choices(self):
+        """Return [(code, name), ...] of all cities, for a select field."""
+
+        return [(city.code, city.name) for city in self._load().values()]
+
+
+city_registry = CityRegistry()
+
+
+@event.listens_for(City, 'after_insert')
+@event.listens_for(City, 'after_update')
+@event.listens_for(City, 'after_delete')
+def note_city_change(mapper, connection, city):
+    """Flag session so city registry is refreshed when it commits."""
+
+    object_session(city).info['cities_changed'] = True
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def note_bulk_city_change(context):
+    if context.mapper.class_ is City:
+        context.session.info['cities_changed'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def refresh_city_registry(session):
+    if session.info.pop('cities_changed', False):
+        city_registry.bump()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_city_changes(session):
+    session.info.pop('cities_changed', None)
+
+
 class Cafe(db.Model):
     """Cafe information."""
 
     __tablename__ = 'cafes'
+    __table_args__ = (
+        # support keyset pagination of the cafe listing, in either order
+        db.Index('ix_cafes_name_id', 'name', 'id'),
+        db.Index('ix_cafes_like_count_id', 'like_count', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -75,6 +186,59 @@ class Cafe(db.Model):
         default="/static/images/default-cafe.jpg",
     )
 
+    # vendor feed's id for cafes loaded by `flask import-cafes`, which
+    # upserts on it
+    source_id = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # number of users_like_cafes rows for this cafe, kept up to date by
+    # UserLikesCafe.like/unlike (and fixable with Cafe.recount_likes)
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # 'pending' until the map job has saved this cafe's static map,
+    # then 'ready' (or 'failed' if MapQuest never came through)
+    map_status = db.Column(
+        db.Text,
+        nullable=False,
+        default='pending',
+    )
+
+    # set by geocoding the address (see geo.py) when the map is fetched
+    latitude = db.Column(
+        db.Float,
+    )
+
+    longitude = db.Column(
+        db.Float,
+    )
+
+    # location key (see mapcache.location_key) of the saved map image
+    map_key = db.Column(
+        db.Text,
+    )
+
+    # bumped whenever the cafe is edited (see bump_revision); likes, which
+    # only change like_count, don't count
+    revision = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
     city = db.relationship("City", backref='cafes')
     liking_users = db.relationship('User', secondary="users_like_cafes")
 
@@ -82,39 +246,190 @@ class Cafe(db.Model):
     def __repr__(self):
         return f'<Cafe id={self.id} name="{self.name}">'
 
+    @classmethod
+    def get_list_page(cls, limit, after=None, before=None, sort='name'):
+        """Return a Page of cafes for the cafe listing.
+
+        sort is 'name' (A-Z) or 'popular' (most liked first).
+
+        Only the columns the listing cards show are loaded; cities come
+        from the city registry.
+        """
+
+        orders = {
+            'name': [(cls.name, False), (cls.id, False)],
+            'popular': [(cls.like_count, True), (cls.id, True)],
+        }
+
+        query = cls.query.options(
+            load_only('id', 'name', 'description', 'image_url', 'city_code',
+                      'like_count'))
+
+        return keyset_page(
+            query,
+            orders[sort],
+            limit,
+            after=after,
+            before=before,
+        )
+
+    @classmethod
+    def recount_likes(cls):
+        """Recompute every cafe's like_count from users_like_cafes.
+
+        Returns number of cafes whose count was wrong.
+        """
+
+        likes = (db.session.query(db.func.count())
+                 .filter(UserLikesCafe.cafe_id == cls.id)
+                 .correlate(cls)
+                 .as_scalar())
+
+        return (cls.query
+                .filter(cls.like_count != likes)
+                .update({cls.like_count: likes}, synchronize_session=False))
+
     def get_city_state(self):
         """Return 'city, state' for cafe."""
 
-        city = self.city
+        city = city_registry.get(self.city_code)
         return f'{city.name}, {city.state}'
 
 
+    def get_map_location(self):
+        """Return (address, city, state) that this cafe's map shows."""
+
+        city = city_registry.get(self.city_code)
+        return (self.address, city.name, city.state)
+
     def get_map_url(self):
         """Get MapQuest URL for a static map for this location."""
-        address = self.address
-        city = self.city.name
-        state = self.city.state
+        address, city, state = self.get_map_location()
+
+        return mapquest.static_map_url(f"{address},{city},{state}")
+
+    def get_map_path(self):
+        """Get filesystem path of this cafe's saved map image."""
 
-        base = f"https://www.mapquestapi.com/staticmap/v5/map?key={API_KEY}"
-        where = f"{address},{city},{state}"
-        return f"{base}&center={where}&size=@2x&zoom=15&locations={where}"
+        return os.path.join(map_cache.maps_dir, f'{self.id}.jpeg')
 
+    def get_map_image_url(self):
+        """Get URL of saved map image, or a placeholder if not ready yet."""
+
+        if self.map_status == 'ready':
+            return f"/static/images/maps/{self.id}.jpeg"
+
+        return MAP_PLACEHOLDER_URL
+
+    def map_is_current(self):
+        """Is the saved map image of this cafe's current location?"""
+
+        return (self.map_status == 'ready'
+                and self.map_key == location_key(*self.get_map_location())
+                and os.path.exists(self.get_map_path()))
 
     def save_map(self):
-        """Get static map and save in static/maps directory of this app."""
-        id = self.id
-        address = self.address
-        city = self.city.name
-        state = self.city.state
+        """Get static map and save in static/maps directory of this app.
+
+        Maps are shared through the map cache, so this only calls MapQuest
+        when no map of this location has been fetched before.
+
+        Raises MapQuestUnavailable if MapQuest can't supply it.
+        """
+
+        if self.map_is_current():
+            return
 
-        path = os.path.abspath(os.path.dirname(__file__))
-        url = self.get_map_url()
-        response = requests.get(url)
-        with open(f'{path}/static/images/maps/{id}.jpeg', "wb") as f:
-            f.write(response.content)
+        key = location_key(*self.get_map_location())
 
+        if map_cache.get(key) is None:
+            map_cache.put(key, mapquest.get(self.get_map_url()))
 
-class User(db.Model):
+        map_cache.link(key, self.get_map_path())
+
+        self.map_key = key
+        self.map_status = 'ready'
+
+
+# Postgres full-text search column for cafes (see search.py), kept in sync
+# by the database as a generated column. It isn't mapped, as other
+# databases don't have it.
+event.listen(
+    Cafe.__table__,
+    'after_create',
+    DDL("""
+        ALTER TABLE cafes ADD COLUMN search_vector tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', name), 'A') ||
+            setweight(to_tsvector('english', address), 'B') ||
+            setweight(to_tsvector('english', description), 'C')
+        ) STORED;
+        CREATE INDEX ix_cafes_search_vector ON cafes
+        USING GIN (search_vector);
+    """).execute_if(dialect='postgresql'),
+)
+
+
+class LikesMixin:
+    """ Like lookups for anything with a user `id` """
+
+    def has_liked(self, cafe_id):
+        """ Returns whether user likes cafe, without loading liked_cafes """
+
+        liked = UserLikesCafe.query.filter_by(
+            user_id=self.id,
+            cafe_id=cafe_id,
+        ).exists()
+
+        return db.session.query(liked).scalar()
+
+    def liked_cafe_ids(self, cafe_ids):
+        """ Returns set of the given cafe ids that user likes """
+
+        if not cafe_ids:
+            return set()
+
+        rows = (db.session.query(UserLikesCafe.cafe_id)
+                .filter(UserLikesCafe.user_id == self.id)
+                .filter(UserLikesCafe.cafe_id.in_(cafe_ids)))
+
+        return {cafe_id for (cafe_id,) in rows}
+
+    def liked_cafes_page(self, limit, after=None, before=None,
+                         sort='recent'):
+        """ Returns a Page of the cafes user likes
+
+            sort is 'recent' (most recently liked first) or 'name' (A-Z).
+
+            Items are rows of just what the profile shows (id, name,
+            image_url, address, description cut to DESCRIPTION_PREVIEW
+            characters, and liked_at), not Cafes.
+        """
+
+        orders = {
+            'recent': [(UserLikesCafe.liked_at, True), (Cafe.id, True)],
+            'name': [(Cafe.name, False), (Cafe.id, False)],
+        }
+
+        query = (db.session
+                 .query(Cafe.id, Cafe.name, Cafe.image_url, Cafe.address,
+                        db.func.substr(Cafe.description, 1,
+                                       DESCRIPTION_PREVIEW)
+                        .label('description'),
+                        UserLikesCafe.liked_at)
+                 .join(UserLikesCafe, UserLikesCafe.cafe_id == Cafe.id)
+                 .filter(UserLikesCafe.user_id == self.id))
+
+        return keyset_page(
+            query,
+            orders[sort],
+            limit,
+            after=after,
+            before=before,
+        )
+
+
+class User(LikesMixin, db.Model):
     """Users for cafes."""
 
     __tablename__ = 'users'
@@ -167,6 +482,34 @@ class User(db.Model):
         nullable=False,
     )
 
+    # bumped whenever the user is edited (see bump_revision)
+    revision = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # bumped whenever the user likes or unlikes a cafe
+    likes_version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
     liked_cafes = db.relationship('Cafe', secondary="users_like_cafes")
 
     @classmethod
@@ -182,9 +525,7 @@ class User(db.Model):
         admin=False
         ):
         """ Hashes user password, creates and returns a new user """
-        hashed = bcrypt.generate_password_hash(password)
-
-        hashed_utf8 = hashed.decode('utf8')
+        hashed_utf8 = password_hasher.hash(password)
 
         return cls(
             username=username, 
@@ -226,7 +567,16 @@ class User(db.Model):
 
         u = User.query.filter_by(username=username).first()
 
-        if u and bcrypt.check_password_hash(u.hashed_password, pwd):
+        if u and password_hasher.check(u.hashed_password, pwd):
+            if password_hasher.needs_rehash(u.hashed_password):
+                # hashed at an old cost; now we know the password, bring
+                # it up to date (the caller commits), unless we're too
+                # busy -- a later login will
+                try:
+                    u.hashed_password = password_hasher.hash(pwd)
+                except PasswordHasherBusy:
+                    pass
+
             # return user instance
             return u
         else:
@@ -236,14 +586,60 @@ class User(db.Model):
         """ Returns first_name and last_name for user """
         return self.first_name + " " + self.last_name
 
-    def has_liked(self, cafe_id):
-        return Cafe.query.get(cafe_id) in self.liked_cafes
+class UserIdentity(LikesMixin):
+    """ Slim, cacheable stand-in for a User, with what every page needs
+
+        Unlike a User it isn't tied to a database session, so it can be
+        kept between requests. Use get_user() for the full User.
+    """
+
+    FIELDS = ('id', 'username', 'admin', 'first_name', 'last_name',
+              'image_url')
+
+    def __init__(self, **fields):
+        for field in self.FIELDS:
+            setattr(self, field, fields[field])
+
+    def __repr__(self):
+        return f"<UserIdentity {self.id} {self.username}>"
+
+    @classmethod
+    def from_user(cls, user):
+        """ Returns identity for a User """
+
+        return cls(**{field: getattr(user, field) for field in cls.FIELDS})
+
+    @classmethod
+    def load(cls, user_id):
+        """ Returns identity of user with this id, or None if no such user """
+
+        user = (User.query
+                .options(load_only(*cls.FIELDS))
+                .filter_by(id=user_id)
+                .first())
+
+        return user and cls.from_user(user)
+
+    def get_full_name(self):
+        """ Returns first_name and last_name for user """
+        return self.first_name + " " + self.last_name
+
+    def get_user(self):
+        """ Returns the full User """
+        return User.query.get(self.id)
 
 
 class UserLikesCafe(db.Model):
     """ Middle table for Cafe and User defining what cafes a user likes """
 
     __tablename__ = 'users_like_cafes'
+    __table_args__ = (
+        # the primary key leads with cafe_id; lookups by user need this
+        db.Index('ix_users_like_cafes_user_id', 'user_id', 'cafe_id'),
+        # for paging through a user's likes, newest first
+        db.Index('ix_users_like_cafes_user_id_liked_at',
+                 'user_id', 'liked_at', 'cafe_id'),
+    )
 
     cafe_id = db.Column(
         db.Integer,
@@ -257,9 +653,259 @@ class UserLikesCafe(db.Model):
         primary_key=True,
     )
 
+    liked_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
     def __repr__(self):
         return f"<UserLikesCafe {self.cafe_id}  {self.user_id}>"
 
+    @classmethod
+    def like(cls, user_id, cafe_id):
+        """ Records that user likes cafe, in a single statement.
+
+            Liking an already-liked (or nonexistent) cafe is a no-op.
+            Returns True if a like was added.
+        """
+
+        table = cls.__table__
+        cafe = (select([literal(user_id), Cafe.id,
+                        literal(datetime.utcnow(), db.DateTime)])
+                .where(Cafe.id == cafe_id))
+
+        if db.engine.dialect.name == 'postgresql':
+            stmt = postgresql.insert(table).on_conflict_do_nothing()
+        else:
+            stmt = table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+
+        stmt = stmt.from_select(['user_id', 'cafe_id', 'liked_at'], cafe)
+        liked = db.session.execute(stmt).rowcount == 1
+
+        if liked:
+            cls._record_like_change(user_id, cafe_id, 1)
+
+        return liked
+
+    @classmethod
+    def unlike(cls, user_id, cafe_id):
+        """ Removes user's like of cafe, in a single statement.
+
+            Unliking a cafe that isn't liked is a no-op.
+            Returns True if a like was removed.
+        """
+
+        table = cls.__table__
+        stmt = table.delete().where(
+            (table.c.user_id == user_id) & (table.c.cafe_id == cafe_id))
+        unliked = db.session.execute(stmt).rowcount == 1
+
+        if unliked:
+            cls._record_like_change(user_id, cafe_id, -1)
+
+        return unliked
+
+    @staticmethod
+    def _record_like_change(user_id, cafe_id, change):
+        """ Adjusts cafe's like_count and bumps user's likes_version,
+            in the same transaction as the like; notes the change for
+            recommendations (see recommend.py) once it's committed
+        """
+
+        db.session.info.setdefault('like_changes', []).append(
+            (user_id, cafe_id, change > 0))
+
+        cafes = Cafe.__table__
+        db.session.execute(
+            cafes.update()
+            .where(cafes.c.id == cafe_id)
+            .values(like_count=cafes.c.like_count + change))
+
+        users = User.__table__
+        db.session.execute(
+            users.update()
+            .where(users.c.id == user_id)
+            .values(likes_version=users.c.likes_version + 1,
+                    likes_updated_at=datetime.utcnow()))
+
+
+@event.listens_for(Cafe, 'before_update')
+@event.listens_for(User, 'before_update')
+def bump_revision(mapper, connection, target):
+    """Bump revision & updated_at of an edited cafe or user."""
+
+    if object_session(target).is_modified(target, include_collections=False):
+        target.revision = type(target).revision + 1
+        target.updated_at = datetime.utcnow()
+
+
+#######################################
+# catalog versions
+
+
+# Cafe columns whose changes show up in listings, search or nearby results
+CATALOG_FIELDS = ('name', 'description', 'image_url', 'city_code',
+                  'address', 'latitude', 'longitude')
+
+
+class CatalogVersion(db.Model):
+    """ Version counters for whole collections: 'cafes' and 'cities'
+
+        Bumped in the same transaction as any change to the collection
+        that could show up in a listing, so listings can be validated
+        (for ETags) without querying the collection itself.
+    """
+
+    __tablename__ = 'catalog_versions'
+
+    name = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+    )
+
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    @classmethod
+    def get(cls, *names):
+        """Return {name: (version, updated_at)} for collection names."""
+
+        rows = (db.session
+                .query(cls.name, cls.version, cls.updated_at)
+                .filter(cls.name.in_(names)))
+
+        return {name: (version, updated_at)
+                for name, version, updated_at in rows}
+
+    @classmethod
+    def bump(cls, session, names):
+        """Bump versions of collection names, in session's transaction."""
+
+        table = cls.__table__
+        session.execute(
+            table.update()
+            .where(table.c.name.in_(sorted(names)))
+            .values(version=table.c.version + 1,
+                    updated_at=datetime.utcnow()))
+
+
+event.listen(
+    CatalogVersion.__table__,
+    'after_create',
+    DDL("""
+        INSERT INTO catalog_versions (name, version, updated_at)
+        VALUES ('cafes', 1, CURRENT_TIMESTAMP),
+               ('cities', 1, CURRENT_TIMESTAMP)
+    """),
+)
+
+
+def _note_catalog_change(session, name):
+    session.info.setdefault('catalog_changes', set()).add(name)
+
+
+@event.listens_for(Cafe, 'after_insert')
+@event.listens_for(Cafe, 'after_delete')
+def note_catalog_cafe_added_or_deleted(mapper, connection, cafe):
+    _note_catalog_change(object_session(cafe), 'cafes')
+
+
+@event.listens_for(Cafe, 'after_update')
+def note_catalog_cafe_updated(mapper, connection, cafe):
+    attrs = inspect(cafe).attrs
+    if any(attrs[field].history.has_changes() for field in CATALOG_FIELDS):
+        _note_catalog_change(object_session(cafe), 'cafes')
+
+
+@event.listens_for(City, 'after_insert')
+@event.listens_for(City, 'after_update')
+@event.listens_for(City, 'after_delete')
+def note_catalog_city_changed(mapper, connection, city):
+    _note_catalog_change(object_session(city), 'cities')
+
+
+@event.listens_for(Session, 'after_flush')
+def bump_catalog_versions(session, flush_context):
+    names = session.info.pop('catalog_changes', None)
+
+    if names:
+        CatalogVersion.bump(session, names)
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def bump_catalog_versions_in_bulk(context):
+    names = {Cafe: 'cafes', City: 'cities'}
+    name = names.get(context.mapper.class_)
+
+    if name is not None:
+        CatalogVersion.bump(context.session, {name})
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_catalog_changes(session):
+    session.info.pop('catalog_changes', None)
+
+
+class Job(db.Model):
+    """ Durable background job, for the "database" job queue backend """
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # JSON-encoded list of arguments for the task
+    args = db.Column(
+        db.Text,
+        nullable=False,
+        default='[]',
+    )
+
+    # pending -> running -> done, or back to pending to retry, or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='pending',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # when to run it; while running, when its lease runs out
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.name} {self.status}>"
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -0,0 +1,396 @@
+"""Cache of rendered pages for anonymous visitors.
+
+Views decorated with `page_cache.cached(...)` are rendered once and then
+served from the cache to visitors who aren't logged in (and have no
+flashed messages waiting). Parts of pages that are the same for everyone
+can be cached for logged-in users too, with `page_cache.fragment(...)`.
+
+Each cached page or fragment depends on some tags, like "cafe:12";
+committing a change to a cafe or city bumps the version of the tags it
+affects, which invalidates everything cached that depends on them.
+
+Which backend stores pages (and tag versions) is chosen by the
+PAGE_CACHE_BACKEND setting:
+
+- "memory": a bounded in-process LRU (default)
+- "filesystem": files under PAGE_CACHE_DIR, shared by every worker
+  process on the host
+- "null": cache nothing
+
+Like counts shown on cached pages may lag by up to PAGE_CACHE_TTL; likes
+don't invalidate pages.
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+import threading
+import time
+import uuid
+
+from flask import g, make_response, request, session
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session, object_session
+
+from caching import TTLCache
+from extensions import attach
+from models import Cafe, City
+
+
+# Cafe columns shown in the cafe listing
+LISTING_FIELDS = ('name', 'description', 'image_url', 'city_code')
+
+
+class NullBackend:
+    """Caches nothing."""
+
+    def __init__(self, app):
+        pass
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def get_versions(self, tags):
+        return {}
+
+    def bump(self, tags):
+        pass
+
+    def clear(self):
+        pass
+
+
+class MemoryBackend:
+    """Pages in an in-process LRU; only right with a single process."""
+
+    def __init__(self, app):
+        self.pages = TTLCache(maxsize=app.config['PAGE_CACHE_SIZE'])
+        # tag -> version; kept apart from the LRU so it's never evicted
+        self.versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.pages.get(key)
+
+    def set(self, key, value, ttl):
+        self.pages.set(key, value, ttl)
+
+    def get_versions(self, tags):
+        with self._lock:
+            return {tag: self.versions.get(tag) for tag in tags}
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self.versions[tag] = uuid.uuid4().hex
+
+    def clear(self):
+        with self._lock:
+            self.pages.clear()
+            self.versions.clear()
+
+
+class FileSystemBackend:
+    """Pages & tag versions in files, shared between worker processes.
+
+    Files are replaced atomically, so readers never see a partial write.
+    Once there are more than PAGE_CACHE_SIZE pages, the oldest are
+    pruned.
+    """
+
+    # how many stores between checks for pages to prune
+    PRUNE_EVERY = 100
+
+    def __init__(self, app):
+        self.directory = app.config['PAGE_CACHE_DIR']
+        self.maxsize = app.config['PAGE_CACHE_SIZE']
+        self.pages_dir = os.path.join(self.directory, 'pages')
+        self.tags_dir = os.path.join(self.directory, 'tags')
+        self.stores = 0
+
+        os.makedirs(self.pages_dir, exist_ok=True)
+        os.makedirs(self.tags_dir, exist_ok=True)
+
+    @staticmethod
+    def _name(key):
+        return hashlib.sha256(key.encode('utf8')).hexdigest()
+
+    @staticmethod
+    def _write(path, data):
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        path = os.path.join(self.pages_dir, self._name(key))
+
+        try:
+            with open(path, 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        return value if expires > time.time() else None
+
+    def set(self, key, value, ttl):
+        path = os.path.join(self.pages_dir, self._name(key))
+        self._write(path, pickle.dumps((time.time() + ttl, value)))
+
+        self.stores += 1
+        if self.stores % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        """Remove oldest pages until there are at most maxsize."""
+
+        entries = []
+
+        for entry in os.scandir(self.pages_dir):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+
+        entries.sort()
+
+        for _, path in entries[:max(0, len(entries) - self.maxsize)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def get_versions(self, tags):
+        versions = {}
+
+        for tag in tags:
+            try:
+                with open(os.path.join(self.tags_dir, self._name(tag))) as f:
+                    versions[tag] = f.read()
+            except FileNotFoundError:
+                versions[tag] = None
+
+        return versions
+
+    def bump(self, tags):
+        for tag in tags:
+            path = os.path.join(self.tags_dir, self._name(tag))
+            self._write(path, uuid.uuid4().hex.encode('ascii'))
+
+    def clear(self):
+        for directory in (self.pages_dir, self.tags_dir):
+            for entry in os.scandir(directory):
+                os.remove(entry.path)
+
+
+BACKENDS = {
+    'null': NullBackend,
+    'memory': MemoryBackend,
+    'filesystem': FileSystemBackend,
+}
+
+
+class PageCache:
+    """Caches anonymous GETs of decorated views."""
+
+    def __init__(self):
+        self.app = None
+        self._backend = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def init_app(self, app):
+        attach(self, app)
+
+        app.config.setdefault('PAGE_CACHE_BACKEND', 'memory')
+        app.config.setdefault('PAGE_CACHE_TTL', 300)
+        app.config.setdefault('PAGE_CACHE_SIZE', 1000)
+        app.config.setdefault(
+            'PAGE_CACHE_DIR', os.path.join(app.instance_path, 'page-cache'))
+
+    @property
+    def backend(self):
+        """Backend picked from config the first time it's needed."""
+
+        with self._lock:
+            if self._backend is None:
+                kind = self.app.config['PAGE_CACHE_BACKEND']
+                self._backend = BACKENDS[kind](self.app)
+            return self._backend
+
+    def reset(self):
+        """Forget the backend (it's re-made from config on next use)."""
+
+        with self._lock:
+            self._backend = None
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.fragment_hits = 0
+            self.fragment_misses = 0
+
+    def stats(self):
+        """Return dict of page & fragment hit and miss counts."""
+
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'fragment_hits': self.fragment_hits,
+                'fragment_misses': self.fragment_misses,
+            }
+
+    def _count(self, hit, fragment=False):
+        with self._lock:
+            if fragment:
+                self.fragment_hits += hit
+                self.fragment_misses += not hit
+            else:
+                self.hits += hit
+                self.misses += not hit
+
+    def invalidate(self, tags):
+        """Invalidate every cached page depending on any of tags."""
+
+        if tags:
+            self.backend.bump(tags)
+
+    def fragment(self, key, tags, render):
+        """Return cached value for key, or call render() and cache that.
+
+        Unlike pages, fragments are cached for everyone, so render()
+        mustn't depend on who's asking.
+        """
+
+        backend = self.backend
+        key = f'fragment:{key}'
+        versions = backend.get_versions(tags)
+        entry = backend.get(key)
+
+        if entry is not None and entry[0] == versions:
+            self._count(hit=True, fragment=True)
+            return entry[1]
+
+        self._count(hit=False, fragment=True)
+        value = render()
+        backend.set(key, (versions, value), self.app.config['PAGE_CACHE_TTL'])
+
+        return value
+
+    @staticmethod
+    def is_cacheable():
+        """Can this request be answered from (and stored in) the cache?"""
+
+        return (request.method == 'GET'
+                and g.get('user') is None
+                and '_flashes' not in session)
+
+    def cached(self, tags):
+        """Decorator caching a view's anonymous responses.
+
+        tags is a function taking the view's arguments and returning the
+        tags its page depends on.
+        """
+
+        def decorator(view):
+
+            @functools.wraps(view)
+            def wrapper(**kwargs):
+                if not self.is_cacheable():
+                    return view(**kwargs)
+
+                backend = self.backend
+                key = request.full_path
+                versions = backend.get_versions(tags(**kwargs))
+                entry = backend.get(key)
+
+                if entry is not None and entry[0] == versions:
+                    self._count(hit=True)
+                    _, body, mimetype = entry
+                    response = make_response(body)
+                    response.mimetype = mimetype
+                    response.headers['X-Cache'] = 'HIT'
+                    return response
+
+                self._count(hit=False)
+                response = make_response(view(**kwargs))
+
+                if response.status_code == 200 and not session.modified:
+                    backend.set(
+                        key,
+                        (versions, response.get_data(), response.mimetype),
+                        self.app.config['PAGE_CACHE_TTL'],
+                    )
+
+                response.headers['X-Cache'] = 'MISS'
+                return response
+
+            return wrapper
+
+        return decorator
+
+
+page_cache = PageCache()
+
+
+#######################################
+# invalidating pages when cafes & cities change
+
+
+def _note_tags(session, tags):
+    session.info.setdefault('page_cache_tags', set()).update(tags)
+
+
+@event.listens_for(Cafe, 'after_insert')
+@event.listens_for(Cafe, 'after_delete')
+def note_cafe_added_or_deleted(mapper, connection, cafe):
+    _note_tags(object_session(cafe), {'cafes', f'cafe:{cafe.id}'})
+
+
+@event.listens_for(Cafe, 'after_update')
+def note_cafe_updated(mapper, connection, cafe):
+    tags = {f'cafe:{cafe.id}'}
+
+    attrs = inspect(cafe).attrs
+    if any(attrs[field].history.has_changes() for field in LISTING_FIELDS):
+        tags.add('cafes')
+
+    _note_tags(object_session(cafe), tags)
+
+
+@event.listens_for(City, 'after_insert')
+@event.listens_for(City, 'after_update')
+@event.listens_for(City, 'after_delete')
+def note_city_changed(mapper, connection, city):
+    _note_tags(object_session(city), {'cities'})
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def note_bulk_page_change(context):
+    # we don't know which rows changed, so invalidate all of them
+    if context.mapper.class_ is Cafe:
+        _note_tags(context.session, {'cafes', 'cafe:*'})
+    elif context.mapper.class_ is City:
+        _note_tags(context.session, {'cities'})
+
+
+@event.listens_for(Session, 'after_commit')
+def invalidate_pages(session):
+    tags = session.info.pop('page_cache_tags', None)
+
+    if tags and page_cache.app is not None:
+        page_cache.invalidate(tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_page_changes(session):
+    session.info.pop('page_cache_tags', None)
@@ -0,0 +1,138 @@
+"""Keyset (cursor) pagination helpers for Flask Cafe."""
+
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+
+class InvalidCursor(ValueError):
+    """Raised when a pagination cursor can't be decoded."""
+
+
+def _to_json(value):
+    # datetimes go in cursors as ISO 8601 strings
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Can't put {value!r} in a cursor")
+
+
+def encode_cursor(values):
+    """Encode a tuple of sort-key values as an opaque URL-safe cursor."""
+
+    raw = json.dumps(list(values), separators=(',', ':'),
+                     default=_to_json).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Decode cursor back to a list of `size` sort-key values."""
+
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor(cursor)
+
+    return values
+
+
+class Page:
+    """One page of results plus cursors for neighbouring pages."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _cursor_value(cursor, column, value):
+    """Check a decoded cursor value is right for column & convert it."""
+
+    python_type = column.type.python_type
+
+    if python_type is datetime and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            raise InvalidCursor(cursor)
+
+    # e.g. a cursor from a listing in a different order
+    if not isinstance(value, python_type):
+        raise InvalidCursor(cursor)
+
+    return value
+
+
+def _seek(order, values, forward):
+    """Build WHERE clause selecting rows past `values` in `order`.
+
+    order is a list of (column, descending) pairs; it must end in a
+    unique column so that every row has a distinct position.
+    """
+
+    clauses = []
+
+    for i, (column, descending) in enumerate(order):
+        later = (column < values[i]) if descending == forward else (
+            column > values[i])
+        equal = [col == values[j] for j, (col, _) in enumerate(order[:i])]
+        clauses.append(and_(*equal, later))
+
+    return or_(*clauses)
+
+
+def keyset_page(query, order, limit, after=None, before=None):
+    """Return a Page of `query` sorted by `order`, seeking from a cursor.
+
+    Only one of `after`/`before` should be given; both are cursors as
+    produced by the returned Page. Rows are located with an indexed
+    comparison on the sort key instead of an OFFSET, so every page costs
+    the same no matter how deep into the listing it is.
+    """
+
+    keys = [column.key for column, _ in order]
+    forward = before is None
+    cursor = after if forward else before
+
+    if cursor is not None:
+        values = decode_cursor(cursor, len(order))
+        values = [_cursor_value(cursor, column, value)
+                  for (column, _), value in zip(order, values)]
+        query = query.filter(_seek(order, values, forward))
+
+    query = query.order_by(*[
+        column.desc() if descending == forward else column.asc()
+        for column, descending in order
+    ])
+
+    rows = query.limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    if not forward:
+        rows.reverse()
+
+    def cursor_for(row):
+        return encode_cursor(getattr(row, key) for key in keys)
+
+    next_cursor = prev_cursor = None
+
+    if rows:
+        if has_more if forward else cursor is not None:
+            next_cursor = cursor_for(rows[-1])
+        if cursor is not None if forward else has_more:
+            prev_cursor = cursor_for(rows[0])
+
+    return Page(rows, next_cursor=next_cursor, prev_cursor=prev_cursor)
@@ -0,0 +1,172 @@
+"""Password hashing, off the request threads.
+
+bcrypt is slow on purpose (100-300 ms a hash at the usual cost) and keeps
+a CPU busy the whole time, so a burst of logins hashed in request threads
+would starve everything else. Instead, hashes are computed by a small
+pool chosen by the PASSWORD_HASHER setting:
+
+- "process": a pool of PASSWORD_HASH_WORKERS processes (default)
+- "thread": a thread pool (bcrypt releases the GIL while it hashes)
+- "inline": in the caller (for tests & scripts)
+
+At most PASSWORD_HASH_QUEUE_SIZE hashes may be running or waiting at
+once; past that, hash() and check() raise PasswordHasherBusy at once
+(views answer 503) rather than queueing up behind a backlog.
+
+New hashes cost BCRYPT_LOG_ROUNDS; logging in with a password hashed at a
+different cost re-hashes it (see User.authenticate).
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import bcrypt
+
+from extensions import attach
+
+
+class PasswordHasherBusy(Exception):
+    """Too many hashes already queued; try again later."""
+
+
+def hash_password(password, rounds):
+    """Return bcrypt hash of password (a str), at cost rounds."""
+
+    hashed = bcrypt.hashpw(password.encode('utf8'), bcrypt.gensalt(rounds))
+    return hashed.decode('utf8')
+
+
+def check_password(hashed, password):
+    """Does password match bcrypt hash hashed?"""
+
+    return bcrypt.checkpw(password.encode('utf8'), hashed.encode('utf8'))
+
+
+def hash_rounds(hashed):
+    """Return the cost a bcrypt hash was made with, like 12 for $2b$12$..."""
+
+    return int(hashed.split('$')[2])
+
+
+class InlineBackend:
+    """Hashes in the caller."""
+
+    def __init__(self, app):
+        pass
+
+    def run(self, func, *args):
+        return func(*args)
+
+    def shutdown(self):
+        pass
+
+
+class ThreadBackend:
+    """Hashes in a thread pool."""
+
+    def __init__(self, app):
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config['PASSWORD_HASH_WORKERS'],
+            thread_name_prefix='password-hasher',
+        )
+
+    def run(self, func, *args):
+        return self.executor.submit(func, *args).result()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class ProcessBackend(ThreadBackend):
+    """Hashes in a process pool."""
+
+    def __init__(self, app):
+        # spawned, not forked: forking a threaded server (with open
+        # database connections) isn't safe
+        self.executor = ProcessPoolExecutor(
+            max_workers=app.config['PASSWORD_HASH_WORKERS'],
+            mp_context=multiprocessing.get_context('spawn'),
+        )
+
+
+BACKENDS = {
+    'inline': InlineBackend,
+    'thread': ThreadBackend,
+    'process': ProcessBackend,
+}
+
+
+class PasswordHasher:
+    """Hashes & checks passwords with a bounded pool."""
+
+    def __init__(self):
+        self.app = None
+        self.pending = 0
+        self.rejected = 0
+        self._backend = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        attach(self, app)
+
+        workers = app.config.setdefault(
+            'PASSWORD_HASH_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('PASSWORD_HASHER', 'process')
+        app.config.setdefault('PASSWORD_HASH_QUEUE_SIZE', 4 * workers)
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        self.reset()
+
+    @property
+    def backend(self):
+        """Backend picked from config the first time it's needed."""
+
+        with self._lock:
+            if self._backend is None:
+                kind = self.app.config['PASSWORD_HASHER']
+                self._backend = BACKENDS[kind](self.app)
+            return self._backend
+
+    def reset(self):
+        """Shut down the backend (it's re-made from config on next use)."""
+
+        with self._lock:
+            if self._backend is not None:
+                self._backend.shutdown()
+            self._backend = None
+
+    def _run(self, func, *args):
+        with self._lock:
+            if self.pending >= self.app.config['PASSWORD_HASH_QUEUE_SIZE']:
+                self.rejected += 1
+                raise PasswordHasherBusy()
+            self.pending += 1
+
+        try:
+            return self.backend.run(func, *args)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    @property
+    def rounds(self):
+        return self.app.config['BCRYPT_LOG_ROUNDS']
+
+    def hash(self, password):
+        """Return hash of password, at the configured cost."""
+
+        return self._run(hash_password, password, self.rounds)
+
+    def check(self, hashed, password):
+        """Does password match hashed?"""
+
+        return self._run(check_password, hashed, password)
+
+    def needs_rehash(self, hashed):
+        """Was hashed made at a different cost than we use now?"""
+
+        return hash_rounds(hashed) != self.rounds
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,299 @@
+"""Admission control: per-client rate limits & a cap on requests in flight.
+
+Both are checked before any view code runs.
+
+Rate limits are token buckets, set per endpoint by RATE_LIMITS, like
+{'views.login_user': '10/minute'}: a client may make 10 requests in a
+burst, then one more every 6 seconds. Only requests that change things
+(not GET/HEAD/OPTIONS) are limited. Each client has a bucket per IP
+address and, once logged in, per user, and a request must have a token
+in both; past the limit, it's answered 429 Too Many Requests.
+
+Where buckets are kept is chosen by the RATE_LIMIT_BACKEND setting:
+
+- "memory": in this process (default); with several workers, each has
+  its own buckets, so a client gets that many times the limit
+- "sqlite": in the SQLite database RATE_LIMIT_DB, shared by every
+  worker process on the host (put it on a tmpfs, like /dev/shm, to keep
+  it in memory)
+
+Separately, once MAX_IN_FLIGHT requests are being handled by this
+process, any more are shed with 503 Service Unavailable (0 means no cap).
+"""
+
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import g, jsonify, render_template, request, session
+
+from caching import TTLCache
+from extensions import attach
+
+
+# methods that are never rate limited
+SAFE_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+def parse_limit(spec):
+    """Parse a limit like "10/minute" into (rate per second, burst).
+
+    Raises ValueError for anything else.
+    """
+
+    count, _, period = spec.partition('/')
+
+    try:
+        count = int(count)
+        seconds = PERIODS[period]
+    except (ValueError, KeyError):
+        raise ValueError(f"Bad rate limit: {spec}")
+
+    if count < 1:
+        raise ValueError(f"Bad rate limit: {spec}")
+
+    return count / seconds, count
+
+
+def take_tokens(buckets, now, rate, burst):
+    """Refill buckets, [(tokens, updated), ...], since they were updated,
+    then take a token from each -- if every one has a token to take.
+
+    Returns ([tokens left in each], seconds to wait; 0 if tokens were
+    taken).
+    """
+
+    tokens = [min(burst, left + (now - updated) * rate)
+              for left, updated in buckets]
+    wait = max((1 - left) / rate for left in tokens)
+
+    if wait <= 0:
+        return [left - 1 for left in tokens], 0
+
+    return tokens, wait
+
+
+class MemoryBackend:
+    """Buckets in this process."""
+
+    def __init__(self, app):
+        self.buckets = TTLCache(maxsize=app.config['RATE_LIMIT_SIZE'])
+        self._lock = threading.Lock()
+
+    def take(self, keys, rate, burst, now):
+        with self._lock:
+            buckets = [self.buckets.get(key, (burst, now)) for key in keys]
+            tokens, wait = take_tokens(buckets, now, rate, burst)
+
+            for key, left in zip(keys, tokens):
+                # once a bucket's full again, it needn't be kept
+                self.buckets.set(key, (left, now), (burst - left) / rate)
+
+        return wait
+
+    def clear(self):
+        self.buckets.clear()
+
+
+class SQLiteBackend:
+    """Buckets in a SQLite database, shared between worker processes."""
+
+    # how many takes between removing buckets that have filled up again
+    PRUNE_EVERY = 1000
+
+    def __init__(self, app):
+        self.path = app.config['RATE_LIMIT_DB']
+        self.takes = 0
+        self._local = threading.local()
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " key TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated REAL NOT NULL,"
+            " full_at REAL NOT NULL)")
+
+    @property
+    def connection(self):
+        """This thread's connection."""
+
+        connection = getattr(self._local, 'connection', None)
+
+        if connection is None:
+            # autocommit; we start our own transactions
+            connection = sqlite3.connect(
+                self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            self._local.connection = connection
+
+        return connection
+
+    def take(self, keys, rate, burst, now):
+        connection = self.connection
+        # lock out other writers, so no one else takes our tokens
+        connection.execute("BEGIN IMMEDIATE")
+
+        try:
+            buckets = [
+                connection.execute(
+                    "SELECT tokens, updated FROM buckets WHERE key = ?",
+                    (key,)).fetchone() or (burst, now)
+                for key in keys
+            ]
+            tokens, wait = take_tokens(buckets, now, rate, burst)
+            connection.executemany(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?, ?)",
+                [(key, left, now, now + (burst - left) / rate)
+                 for key, left in zip(keys, tokens)])
+
+            self.takes += 1
+            if self.takes % self.PRUNE_EVERY == 0:
+                connection.execute(
+                    "DELETE FROM buckets WHERE full_at < ?", (now,))
+
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+        return wait
+
+    def clear(self):
+        self.connection.execute("DELETE FROM buckets")
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+class RateLimiter:
+    """Rejects requests over their client's rate limit, or over capacity."""
+
+    def __init__(self):
+        self.app = None
+        self.user_key = None
+        self.in_flight = 0
+        self._backend = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def init_app(self, app, user_key):
+        """Attach to app; user_key is the session key holding user ids."""
+
+        attach(self, app)
+
+        app.config.setdefault('RATE_LIMITS', {})
+        app.config.setdefault('RATE_LIMIT_BACKEND', 'memory')
+        app.config.setdefault('RATE_LIMIT_SIZE', 100000)
+        app.config.setdefault(
+            'RATE_LIMIT_DB', os.path.join(app.instance_path, 'ratelimit.db'))
+        app.config.setdefault('MAX_IN_FLIGHT', 64)
+
+        app.before_request(self.admit)
+        app.teardown_request(self.finish)
+        self.user_key = user_key
+
+    @property
+    def backend(self):
+        """Backend picked from config the first time it's needed."""
+
+        with self._lock:
+            if self._backend is None:
+                kind = self.app.config['RATE_LIMIT_BACKEND']
+                self._backend = BACKENDS[kind](self.app)
+            return self._backend
+
+    def reset(self):
+        """Forget the backend (it's re-made from config on next use)."""
+
+        with self._lock:
+            self._backend = None
+
+    def reset_stats(self):
+        with self._lock:
+            self.limited = 0
+            self.shed = 0
+
+    def stats(self):
+        """Return dict of requests rejected, and in flight now."""
+
+        with self._lock:
+            return {
+                'limited': self.limited,
+                'shed': self.shed,
+                'in_flight': self.in_flight,
+            }
+
+    def client_keys(self):
+        """Keys of the buckets the current request draws from."""
+
+        keys = [f'ip:{request.remote_addr}']
+
+        if self.user_key in session:
+            keys.append(f'user:{session[self.user_key]}')
+
+        return keys
+
+    def wait_time(self, limit):
+        """Take a token for each of the client's buckets under limit.
+
+        Tokens are taken only if every bucket has one, so a user over
+        their limit doesn't use up their IP address's (which others may
+        share). Returns how long until the client may try again, or 0 if
+        it may go ahead now.
+        """
+
+        rate, burst = parse_limit(limit)
+        keys = [f'{request.endpoint}:{key}' for key in self.client_keys()]
+
+        return self.backend.take(keys, rate, burst, time.time())
+
+    @staticmethod
+    def reject(status, message, retry_after):
+        if request.is_json:
+            response = jsonify(error=message)
+        else:
+            response = render_template(f'{status}.html')
+
+        return response, status, {'Retry-After': str(retry_after)}
+
+    def admit(self):
+        """Before each request, shed it or rate-limit it if we must."""
+
+        cap = self.app.config['MAX_IN_FLIGHT']
+
+        with self._lock:
+            if cap and self.in_flight >= cap:
+                self.shed += 1
+                return self.reject(503, "Server busy", 1)
+
+            self.in_flight += 1
+            g.rate_limit_admitted = True
+
+        limit = self.app.config['RATE_LIMITS'].get(request.endpoint)
+
+        if limit and request.method not in SAFE_METHODS:
+            wait = self.wait_time(limit)
+
+            if wait:
+                with self._lock:
+                    self.limited += 1
+                return self.reject(429, "Too many requests", math.ceil(wait))
+
+    def finish(self, exc):
+        if g.pop('rate_limit_admitted', False):
+            with self._lock:
+                self.in_flight -= 1
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,268 @@
+"""Recommendations: "people who liked this also liked" & picks for users.
+
+Both come from an in-memory matrix of how often cafes are liked by the
+same people (see colikes.py; NumPy & SciPy are only imported once it's
+first needed). It's built from the likes table in a background thread
+on first use (until it's ready, there are no recommendations) and kept
+up to date as likes & unlikes are committed in this process.
+
+Other processes' likes reach it through full rebuilds: run
+`flask rebuild-recommendations` periodically (say, from cron) to save a
+fresh matrix to RECOMMEND_SNAPSHOT, which every process loads within
+RECOMMEND_CHECK_INTERVAL seconds. Without a snapshot, each process
+rebuilds from the database every RECOMMEND_MAX_AGE seconds instead.
+Either way, the old matrix is used until the new one's ready.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from extensions import attach
+from models import db, Cafe, UserLikesCafe
+
+
+logger = logging.getLogger(__name__)
+
+def build_colikes():
+    """Build a CoLikes matrix from every like in the database."""
+
+    from colikes import CoLikes
+
+    built_at = time.time()
+    rows = (db.session
+            .query(UserLikesCafe.user_id, UserLikesCafe.cafe_id)
+            .all())
+
+    return CoLikes([user_id for user_id, _ in rows],
+                   [cafe_id for _, cafe_id in rows],
+                   built_at)
+
+
+def save_snapshot(colikes, path):
+    """Atomically save colikes to path."""
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        colikes.save(f)
+    os.replace(tmp_path, path)
+
+
+class Recommender:
+    """Recommends cafes from an in-memory CoLikes matrix."""
+
+    def __init__(self):
+        self.app = None
+        self.colikes = None
+        self.checked_at = 0
+        self.snapshot_mtime = None
+        # (time, user id, cafe id, liked) committed since colikes was built
+        self.changes = []
+        # background thread loading or building a new matrix
+        self.refresher = None
+        self.refreshing = 0
+        # bumped by reset(), so refreshes started before it are dropped
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        attach(self, app)
+
+        app.config.setdefault('RECOMMEND_SIMILAR', 4)
+        app.config.setdefault('RECOMMEND_PICKS', 6)
+        # ignore cafes fewer people than this like along with another
+        app.config.setdefault('RECOMMEND_MIN_CO_LIKES', 2)
+        app.config.setdefault(
+            'RECOMMEND_SNAPSHOT',
+            os.path.join(app.instance_path, 'recommendations.npz'))
+        app.config.setdefault('RECOMMEND_CHECK_INTERVAL', 60)
+        app.config.setdefault('RECOMMEND_MAX_AGE', 3600)
+
+    def _load_snapshot(self):
+        """Return the saved snapshot if it's new to us & fresh, else None."""
+
+        from colikes import CoLikes
+
+        path = self.app.config['RECOMMEND_SNAPSHOT']
+
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+
+        if (mtime == self.snapshot_mtime
+                or time.time() - mtime > self.app.config['RECOMMEND_MAX_AGE']):
+            return None
+
+        self.snapshot_mtime = mtime
+
+        return CoLikes.load(path)
+
+    def _replace(self, colikes):
+        """Switch to colikes, re-applying changes made since it was built.
+
+        (Changes it already has are no-ops.) Call with the lock held.
+        """
+
+        self.changes = [change for change in self.changes
+                        if change[0] >= colikes.built_at]
+
+        for _, user_id, cafe_id, liked in self.changes:
+            colikes.update(user_id, cafe_id, liked)
+
+        self.colikes = colikes
+
+    def refresh(self):
+        """Switch to a newer snapshot, or a rebuild if ours is too old.
+
+        Slow (it may read every like), so it's run in the background by
+        _get_colikes; call it directly to wait for it.
+        """
+
+        max_age = self.app.config['RECOMMEND_MAX_AGE']
+
+        with self._lock:
+            self.checked_at = time.time()
+            self.refreshing += 1
+            current = self.colikes
+            generation = self.generation
+
+        try:
+            colikes = self._load_snapshot()
+
+            if colikes is None and (
+                    current is None
+                    or time.time() - current.built_at > max_age):
+                colikes = build_colikes()
+
+            with self._lock:
+                newer = colikes is not None and (
+                    self.colikes is None
+                    or colikes.built_at > self.colikes.built_at)
+
+                if newer and generation == self.generation:
+                    self._replace(colikes)
+        finally:
+            with self._lock:
+                self.refreshing -= 1
+
+    def _refresh_in_background(self):
+        with self.app.app_context():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Couldn't refresh recommendations")
+
+    def _get_colikes(self):
+        """Return the matrix (None until there is one), starting a refresh
+        in the background if it's due.
+
+        Call with the lock held.
+        """
+
+        interval = self.app.config['RECOMMEND_CHECK_INTERVAL']
+        due = (self.colikes is None
+               or time.time() - self.checked_at > interval)
+
+        if due and not self.refreshing and not (
+                self.refresher and self.refresher.is_alive()):
+            self.checked_at = time.time()
+            self.refresher = threading.Thread(
+                target=self._refresh_in_background,
+                name='recommend-refresh',
+                daemon=True,
+            )
+            self.refresher.start()
+
+        return self.colikes
+
+    def reset(self):
+        with self._lock:
+            self.generation += 1
+            self.colikes = None
+            self.snapshot_mtime = None
+            self.changes = []
+
+    def update(self, changes):
+        """Apply committed [(user id, cafe id, liked), ...]."""
+
+        with self._lock:
+            # kept while a matrix is being made, to re-apply to it
+            if self.colikes is None and not self.refreshing:
+                return
+
+            now = time.time()
+
+            for user_id, cafe_id, liked in changes:
+                if self.colikes is not None:
+                    self.colikes.update(user_id, cafe_id, liked)
+                self.changes.append((now, user_id, cafe_id, liked))
+
+    @staticmethod
+    def _get_cafes(ids):
+        """Return cafes with these ids, in the same order."""
+
+        if not ids:
+            return []
+
+        cafes = Cafe.query.filter(Cafe.id.in_(ids))
+        cafes = {cafe.id: cafe for cafe in cafes}
+
+        return [cafes[id] for id in ids if id in cafes]
+
+    def similar_cafes(self, cafe_id):
+        """Return cafes most liked by the people who like cafe_id."""
+
+        config = self.app.config
+
+        with self._lock:
+            colikes = self._get_colikes()
+
+            if colikes is None:
+                return []
+
+            ids = colikes.similar(
+                cafe_id,
+                config['RECOMMEND_SIMILAR'],
+                config['RECOMMEND_MIN_CO_LIKES'],
+            )
+
+        return self._get_cafes(ids)
+
+    def picks(self, user_id):
+        """Return cafes user hasn't liked but likely would."""
+
+        with self._lock:
+            colikes = self._get_colikes()
+
+            if colikes is None:
+                return []
+
+            ids = colikes.picks(user_id, self.app.config['RECOMMEND_PICKS'])
+
+        return self._get_cafes(ids)
+
+
+recommender = Recommender()
+
+
+#######################################
+# keeping the matrix in sync (see UserLikesCafe._record_like_change)
+
+
+@event.listens_for(Session, 'after_commit')
+def update_recommendations(session):
+    changes = session.info.pop('like_changes', None)
+
+    if changes:
+        recommender.update(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_like_changes(session):
+    session.info.pop('like_changes', None)
@@ -0,0 +1,271 @@
+"""Full-text search over cafe names, addresses and descriptions.
+
+On Postgres this uses the `search_vector` tsvector column (and its GIN
+index) that models.py adds to cafes. Elsewhere (like SQLite, when
+testing locally) it falls back to an in-memory inverted index, built on
+first use and kept up to date as cafes are committed.
+
+Both rank name matches above address matches above description matches.
+"""
+
+import heapq
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session, object_session
+
+from extensions import attach
+from models import db, Cafe
+
+
+WORD_RE = re.compile(r'\w+')
+
+# how much a word counts for, depending on which field it's in
+FIELD_WEIGHTS = {
+    'name': 1.0,
+    'address': 0.4,
+    'description': 0.2,
+}
+
+
+def tokenize(text):
+    """Return list of lowercased words in text."""
+
+    return WORD_RE.findall(text.lower())
+
+
+class InvertedIndex:
+    """Maps each word to the cafes containing it, with a weighted score.
+
+    A word's postings are also grouped by score, so searches can visit
+    the best-scoring cafes first and stop once nothing further down could
+    make the top results; common words don't cost a scan of every cafe.
+    """
+
+    def __init__(self):
+        # word -> {cafe_id: score}
+        self.postings = defaultdict(dict)
+        # word -> {score: {cafe_id, ...}}
+        self.buckets = defaultdict(lambda: defaultdict(set))
+        # cafe_id -> set of words, so a cafe can be removed/reindexed
+        self.words = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.words)
+
+    def _remove(self, cafe_id):
+        for word in self.words.pop(cafe_id, ()):
+            score = self.postings[word].pop(cafe_id)
+            bucket = self.buckets[word][score]
+            bucket.discard(cafe_id)
+            if not bucket:
+                del self.buckets[word][score]
+            if not self.postings[word]:
+                del self.postings[word]
+                del self.buckets[word]
+
+    def add(self, cafe_id, fields):
+        """(Re)index cafe, given {field name: text}."""
+
+        scores = defaultdict(float)
+
+        for field, weight in FIELD_WEIGHTS.items():
+            for word in tokenize(fields.get(field) or ''):
+                scores[word] += weight
+
+        with self._lock:
+            self._remove(cafe_id)
+            for word, score in scores.items():
+                self.postings[word][cafe_id] = score
+                self.buckets[word][score].add(cafe_id)
+            self.words[cafe_id] = set(scores)
+
+    def remove(self, cafe_id):
+        with self._lock:
+            self._remove(cafe_id)
+
+    def search(self, query, limit):
+        """Return ids of up to `limit` best cafes containing every word.
+
+        Cafes with equal scores come back in id order, except that which
+        of them make the cut at the `limit` boundary is arbitrary.
+        """
+
+        words = set(tokenize(query))
+
+        if not words or limit < 1:
+            return []
+
+        with self._lock:
+            if any(word not in self.postings for word in words):
+                return []
+
+            # walk the rarest word's cafes, best scoring first
+            rarest = min(words, key=lambda word: len(self.postings[word]))
+            others = [self.postings[word] for word in words - {rarest}]
+            others_max = sum(max(self.buckets[word]) for word in words
+                             if word != rarest)
+
+            best = []   # min-heap of (score, -cafe_id)
+
+            for score in sorted(self.buckets[rarest], reverse=True):
+                bound = score + others_max
+
+                if len(best) == limit and bound <= best[0][0]:
+                    break
+
+                for cafe_id in self.buckets[rarest][score]:
+                    if len(best) == limit and bound <= best[0][0]:
+                        break
+
+                    total = score
+
+                    for postings in others:
+                        if cafe_id not in postings:
+                            break
+                        total += postings[cafe_id]
+                    else:
+                        entry = (total, -cafe_id)
+                        if len(best) < limit:
+                            heapq.heappush(best, entry)
+                        elif entry > best[0]:
+                            heapq.heapreplace(best, entry)
+
+        return [-neg_id for _, neg_id in sorted(best, reverse=True)]
+
+
+class CafeSearch:
+    """Search front end, picking a backend to suit the database."""
+
+    def __init__(self):
+        self.app = None
+        self.index = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        attach(self, app)
+
+        # "auto" uses Postgres full-text search when on Postgres
+        app.config.setdefault('SEARCH_BACKEND', 'auto')
+        app.config.setdefault('SEARCH_MAX_RESULTS', 50)
+
+    @property
+    def backend(self):
+        backend = self.app.config['SEARCH_BACKEND']
+
+        if backend == 'auto':
+            is_postgres = db.engine.dialect.name == 'postgresql'
+            backend = 'postgres' if is_postgres else 'python'
+
+        return backend
+
+    def get_index(self):
+        """Return the in-memory index, building it if need be."""
+
+        with self._lock:
+            if self.index is None:
+                index = InvertedIndex()
+                rows = db.session.query(
+                    Cafe.id, Cafe.name, Cafe.address, Cafe.description)
+
+                for id, name, address, description in rows.yield_per(1000):
+                    index.add(id, dict(
+                        name=name, address=address, description=description))
+
+                self.index = index
+
+            return self.index
+
+    def reset(self):
+        """Throw away the in-memory index; it's rebuilt when next needed."""
+
+        with self._lock:
+            self.index = None
+
+    def search_ids(self, query, limit=None):
+        """Return ids of cafes matching query, best first."""
+
+        max_results = self.app.config['SEARCH_MAX_RESULTS']
+        limit = max(1, min(limit or max_results, max_results))
+
+        if self.backend == 'postgres':
+            rows = db.session.execute(text("""
+                SELECT id
+                FROM cafes, websearch_to_tsquery('english', :query) AS query
+                WHERE search_vector @@ query
+                ORDER BY ts_rank(search_vector, query) DESC, id
+                LIMIT :limit
+            """), dict(query=query, limit=limit))
+
+            return [id for (id,) in rows]
+
+        return self.get_index().search(query, limit)
+
+    def search(self, query, limit=None):
+        """Return list of Cafes matching query, best first."""
+
+        ids = self.search_ids(query, limit)
+        cafes = Cafe.query.filter(Cafe.id.in_(ids))
+        cafes = {cafe.id: cafe for cafe in cafes}
+
+        return [cafes[id] for id in ids if id in cafes]
+
+
+cafe_search = CafeSearch()
+
+
+#######################################
+# keeping the in-memory index in sync
+
+
+@event.listens_for(Cafe, 'after_insert')
+@event.listens_for(Cafe, 'after_update')
+def note_cafe_text(mapper, connection, cafe):
+    """Remember cafe's text, to (re)index it when the session commits."""
+
+    attrs = inspect(cafe).attrs
+    if not any(attrs[field].history.has_changes() for field in FIELD_WEIGHTS):
+        return
+
+    pending = object_session(cafe).info.setdefault('search_updates', {})
+    pending[cafe.id] = dict(
+        name=cafe.name, address=cafe.address, description=cafe.description)
+
+
+@event.listens_for(Cafe, 'after_delete')
+def note_cafe_deleted(mapper, connection, cafe):
+    pending = object_session(cafe).info.setdefault('search_updates', {})
+    pending[cafe.id] = None
+
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def note_bulk_cafe_change(context):
+    if context.mapper.class_ is Cafe:
+        context.session.info['search_reset'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def update_search_index(session):
+    updates = session.info.pop('search_updates', {})
+
+    if session.info.pop('search_reset', False):
+        cafe_search.reset()
+
+    index = cafe_search.index
+
+    if index is not None:
+        for cafe_id, fields in updates.items():
+            if fields is None:
+                index.remove(cafe_id)
+            else:
+                index.add(cafe_id, fields)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_search_updates(session):
+    session.info.pop('search_updates', None)
+    session.info.pop('search_reset', None)
@@ -1,16 +1,11 @@
 """Initial data."""
 
-from models import City, Cafe, User, db, connect_db
-from flask import Flask
+from app import create_app
+from models import City, Cafe, User, db
 
-app = Flask(__name__)
-
-app.config['SQLALCHEMY_DATABASE_URI'] = 'postgres:///flaskcafe'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app = create_app()
 app.config['SQLALCHEMY_ECHO'] = True
 
-connect_db(app)
-
 db.drop_all()
 db.create_all()
 
@@ -88,6 +83,9 @@ ua.liked_cafes.append(c1)
 
 db.session.commit()
 
+Cafe.recount_likes()
+db.session.commit()
+
 
 #######################################
 # cafe maps
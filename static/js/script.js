@@ -1,41 +1,137 @@
+const LIKE_FLUSH_DELAY_MS = 250;
+
+// cafe_id -> "like" | "unlike"; only the latest click per cafe is sent
+let pendingLikes = {};
+let likeFlushTimer = null;
+
 $(function(){
-  
+
   $('body').on("submit", ".like-button", likeCafe);
   $('body').on("submit", ".unlike-button", unlikeCafe);
+
+  if ($('body').is('[data-logged-in]')) {
+    $('.cafe-state').each((i, el) => showCafeState($(el)));
+  }
+
+  $('.more-favorites').each((i, el) => loadFavoritesOnScroll($(el)));
 });
 
-async function likeCafe(e){
+const LIKE_BUTTON = `
+  <form class="d-inline-block like-button" method="POST" action="/api/like">
+    <button class="btn btn-outline-primary mb-3" id="like-button">Like</button>
+  </form>
+`;
+
+const UNLIKE_BUTTON = `
+  <form class="d-inline-block unlike-button" method="POST" action="/api/unlike">
+    <button class="btn btn-outline-primary mb-3" id="like-button">Unlike</button>
+  </form>
+`;
+
+// cafe detail pages are the same for everyone; fill in this user's bits
+async function showCafeState($state){
+  const resp = await axios.get(`/api/cafes/${$state.data('cafe-id')}/state`);
+
+  if (resp.data.error) return;
+
+  $state.html(resp.data.liked ? UNLIKE_BUTTON : LIKE_BUTTON);
+
+  if (resp.data.admin) {
+    $('.cafe-admin').removeClass('d-none');
+  }
+}
+
+// profile favorites: instead of following the Next link, load the next
+// page in place whenever the link scrolls into view
+function loadFavoritesOnScroll($more){
+  let loading = false;
+
+  const observer = new IntersectionObserver(async entries => {
+    if (!entries[0].isIntersecting || loading) return;
+
+    loading = true;
+    const resp = await axios.get('/api/profile/likes', {params: {
+      sort: $more.data('sort'),
+      limit: $more.data('limit'),
+      after: $more.data('next'),
+    }});
+    loading = false;
+
+    if (resp.data.error) return;
+
+    for (let cafe of resp.data.cafes) {
+      $('.favorites').append(favoriteHTML(cafe));
+    }
+
+    if (resp.data.next) {
+      $more.data('next', resp.data.next);
+    } else {
+      observer.disconnect();
+      $more.remove();
+    }
+  });
+
+  observer.observe($more[0]);
+}
+
+// like templates/profile/_favorite.html
+function favoriteHTML(cafe){
+  const $image = $('<div class="d-inline-block col-4 col-sm-4 col-md-4 col-lg-3">')
+    .append($('<img class="img-fluid mb-5">').attr('src', cafe.image_url));
+
+  const $name = $('<h2 class="d-inline-block mr-3">')
+    .append($('<a>').attr('href', cafe.url).text(cafe.name));
+
+  const $details = $('<div class="d-inline-block col-8 col-sm-8 col-md-8">')
+    .append($name)
+    .append($('<div>').attr('id', `toggle-cafe-${cafe.id}`).html(UNLIKE_BUTTON))
+    .append($('<p>').text(cafe.description))
+    .append($('<p>').text(`Address: ${cafe.address}`));
+
+  return [$image, $details];
+}
+
+function cafeIdFor($parent){
+  return $parent.attr('id').split('-')[2];
+}
+
+function queueLikeOp(cafe_id, action){
+  pendingLikes[cafe_id] = action;
+
+  clearTimeout(likeFlushTimer);
+  likeFlushTimer = setTimeout(flushLikes, LIKE_FLUSH_DELAY_MS);
+}
+
+async function flushLikes(){
+  const ops = Object.entries(pendingLikes).map(
+    ([cafe_id, action]) => ({"cafe_id": Number(cafe_id), "action": action})
+  );
+  pendingLikes = {};
+
+  if (ops.length) {
+    await axios.post('/api/likes/batch', {"ops": ops});
+  }
+}
+
+function likeCafe(e){
   e.preventDefault()
-  $parent = $(e.target).parent();
-  cafe_id = $parent.attr('id').split('-')[2];
-   
-  await axios.post('/api/like', {"cafe_id": cafe_id});
-  
-  
+  const $parent = $(e.target).parent();
+
+  queueLikeOp(cafeIdFor($parent), "like");
+
   $parent.empty()
-  $parent.append(`
-    <form class="d-inline-block unlike-button" method="POST" action="/api/unlike">
-      <button class="btn btn-outline-primary mb-3" id="like-button">Unlike</button>
-    </form>
-  `)
+  $parent.append(UNLIKE_BUTTON)
 
 }
 
 
-async function unlikeCafe(e){
+function unlikeCafe(e){
   e.preventDefault()
+  const $parent = $(e.target).parent();
 
-  $parent = $(e.target).parent();
-  cafe_id = $parent.data('id').split('-')[2];
-  /* TODO can use data attributes (e.g. data-cafe-id={{ cafe.id }})*/
-
-  await axios.post('/api/unlike', {"cafe_id": cafe_id});
+  queueLikeOp(cafeIdFor($parent), "unlike");
 
   // TODO refactor to just change individual attributes
   $parent.empty()
-  $parent.append(`
-    <form class="d-inline-block like-button" method="POST" action="/api/like">
-      <button class="btn btn-outline-primary mb-3" id="like-button">Like</button>
-    </form>
-  `)
-}
\ No newline at end of file
+  $parent.append(LIKE_BUTTON)
+}
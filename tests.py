@@ -1,26 +1,55 @@
 """Tests for Flask Cafe."""
 
 
+import json
+import os
+import random
 import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from unittest import TestCase
-
-from flask import session
-from app import app, CURR_USER_KEY, NOT_LOGGED_IN_MSG
-from models import db, Cafe, City, User, UserLikesCafe
+from unittest.mock import call, patch
+
+from flask import Flask, session
+from app import create_app, CURR_USER_KEY, NOT_LOGGED_IN_MSG, user_cache
+from models import db, Cafe, City, User, UserLikesCafe, Job, CatalogVersion
+from models import MAP_PLACEHOLDER_URL, UserIdentity, city_registry
+import bench
+from caching import TTLCache
+from config import ProductionConfig
+from datagen import DataGenerator, parse_distribution
+from commands import lookup_ids
+from search import InvertedIndex, cafe_search
+from geo import GridIndex, distance_km, nearby_cafes
+from recommend import recommender
+from colikes import CoLikes
+from pagecache import FileSystemBackend, page_cache
+from likebuffer import like_buffer
+from ratelimit import SQLiteBackend, parse_limit, rate_limiter
+from passwords import PasswordHasherBusy, hash_rounds, password_hasher
+from jobs import job_queue
+from mapcache import MapCache, map_cache, location_key
+from mapquest import MapQuestClient, MapQuestUnavailable, CircuitOpen
+from mapquest import mapquest
 from sqlalchemy.inspection import inspect
 
-# Use test database and don't clutter tests with SQL
-app.config['SQLALCHEMY_DATABASE_URI'] = "postgresql:///flaskcafe-test"
-app.config['SQLALCHEMY_ECHO'] = False
+# Use test database, without CSRF (see TestingConfig)
+app = create_app('test')
 
-# Make Flask errors be real errors, rather than HTML pages with error info
-app.config['TESTING'] = True
+# Run background jobs right away, and don't wait between retries
+app.config['JOB_QUEUE_BACKEND'] = 'inline'
+app.config['JOB_RETRY_BACKOFF'] = 0
 
-# This is a bit of hack, but don't use Flask DebugToolbar
-app.config['DEBUG_TB_HOSTS'] = ['dont-show-debug-toolbar']
+# Geocode from the offline table of city centres, not MapQuest
+app.config['GEOCODER'] = 'gazetteer'
 
-# Don't req CSRF for testing
-app.config['WTF_CSRF_ENABLED'] = False
+# Tests delete & recreate users freely, so don't cache them between requests
+app.config['USER_CACHE_TTL'] = 0
 
 db.drop_all()
 db.create_all()
@@ -157,6 +186,34 @@ class CityModelTestCase(TestCase):
     # depending on how you solve exercise, you may have things to test on
     # the City model, so here's a good place to put that stuff.
 
+    def test_registry(self):
+        self.assertEqual(city_registry.choices(), [("sf", "San Francisco")])
+        self.assertEqual(city_registry.get("sf").state, "CA")
+        self.assertIsNone(city_registry.get("nowhere"))
+
+    def test_registry_refresh(self):
+        version = city_registry.version
+        city_registry.choices()
+
+        City.query.get("sf").name = "San Fran"
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.commit()
+
+        self.assertGreater(city_registry.version, version)
+        self.assertEqual(
+            city_registry.choices(),
+            [("oak", "Oakland"), ("sf", "San Fran")])
+        self.assertEqual(self.cafe.get_city_state(), "San Fran, CA")
+
+    def test_registry_ignores_rollback(self):
+        version = city_registry.version
+
+        db.session.add(City(code="oak", name="Oakland", state="CA"))
+        db.session.flush()
+        db.session.rollback()
+
+        self.assertEqual(city_registry.version, version)
+
 
 #######################################
 # cafes
@@ -192,6 +249,420 @@ class CafeModelTestCase(TestCase):
         self.assertEqual(self.cafe.get_city_state(), "San Francisco, CA")
 
 
+class MapCacheTestCase(TestCase):
+    """Tests for the map image cache and Cafe.save_map."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        db.session.commit()
+
+        self.cafe = cafe
+        self.saved_dirs = (map_cache.directory, map_cache.maps_dir)
+        map_cache.directory = tempfile.mkdtemp()
+        map_cache.maps_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        map_cache.directory, map_cache.maps_dir = self.saved_dirs
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_location_key(self):
+        self.assertEqual(
+            location_key("500  Sansome St", "San Francisco", "CA"),
+            location_key("500 sansome st ", "san francisco", "ca"))
+        self.assertNotEqual(
+            location_key("500 Sansome St", "San Francisco", "CA"),
+            location_key("501 Sansome St", "San Francisco", "CA"))
+
+    def test_lru_eviction(self):
+        cache = MapCache(directory=tempfile.mkdtemp(), max_bytes=10)
+
+        cache.put('a', b'aaaaaa')
+        os.utime(cache.path_for('a'), (0, 0))
+        cache.put('b', b'bbbbbb')
+
+        self.assertIsNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('b'))
+
+    @patch('models.mapquest.get')
+    def test_save_map_uses_cache(self, mock_get):
+        key = location_key(*self.cafe.get_map_location())
+        map_cache.put(key, b'map image')
+
+        self.cafe.save_map()
+
+        mock_get.assert_not_called()
+        self.assertEqual(self.cafe.map_status, 'ready')
+        with open(self.cafe.get_map_path(), 'rb') as f:
+            self.assertEqual(f.read(), b'map image')
+
+    @patch('models.mapquest.get')
+    def test_save_map_fetches_once(self, mock_get):
+        mock_get.return_value = b'fetched map'
+
+        self.cafe.save_map()
+        self.cafe.save_map()
+        self.assertEqual(mock_get.call_count, 1)
+
+        self.cafe.address = "1 Market St"
+        self.cafe.save_map()
+        self.assertEqual(mock_get.call_count, 2)
+
+
+class BackfillMapsTestCase(TestCase):
+    """Tests for the backfill-maps command."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafes = [
+            Cafe(**CAFE_DATA),
+            Cafe(**dict(CAFE_DATA, address="1 Market St")),
+        ]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+        self.saved_dirs = (map_cache.directory, map_cache.maps_dir)
+        map_cache.directory = tempfile.mkdtemp()
+        map_cache.maps_dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(tempfile.mkdtemp(), 'progress.json')
+
+    def tearDown(self):
+        map_cache.directory, map_cache.maps_dir = self.saved_dirs
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def backfill(self, *args):
+        runner = app.test_cli_runner()
+        return runner.invoke(args=[
+            'backfill-maps', '--rate', '0', '--checkpoint', self.checkpoint,
+            *args])
+
+    @patch('models.mapquest.get', return_value=b'map')
+    def test_backfill(self, mock_get):
+        result = self.backfill()
+        self.assertIn("Fetched 2 maps; 0 failed.", result.output)
+        self.assertEqual(mock_get.call_count, 2)
+
+        db.session.expire_all()
+        for cafe_id in self.cafe_ids:
+            self.assertTrue(Cafe.query.get(cafe_id).map_is_current())
+
+        # a clean run leaves no checkpoint, so the next scans every cafe
+        self.assertFalse(os.path.exists(self.checkpoint))
+        result = self.backfill()
+        self.assertIn("0 cafes after id 0 need maps.", result.output)
+        self.assertEqual(mock_get.call_count, 2)
+
+        # ...and finds maps that have since gone missing
+        os.remove(Cafe.query.get(self.cafe_ids[0]).get_map_path())
+        result = self.backfill()
+        self.assertIn("1 cafes after id 0 need maps.", result.output)
+
+    def test_failures_retried(self):
+        first, second = self.cafe_ids
+
+        with patch('commands.job_queue.run_once',
+                   side_effect=lambda name, args: args[0] != first):
+            result = self.backfill()
+        self.assertIn("Fetched 1 maps; 1 failed.", result.output)
+
+        with open(self.checkpoint) as f:
+            self.assertLess(json.load(f)['last_id'], first)
+
+        with patch('commands.job_queue.run_once',
+                   return_value=True) as mock_run:
+            self.backfill()
+        self.assertIn(call('fetch_cafe_map', [first]), mock_run.call_args_list)
+
+    @patch('models.mapquest.get', return_value=b'map')
+    def test_resume(self, mock_get):
+        with open(self.checkpoint, 'w') as f:
+            f.write(f'{{"last_id": {self.cafe_ids[0]}}}')
+
+        result = self.backfill()
+        self.assertIn("Fetched 1 maps; 0 failed.", result.output)
+
+        db.session.expire_all()
+        self.assertFalse(Cafe.query.get(self.cafe_ids[0]).map_is_current())
+        self.assertTrue(Cafe.query.get(self.cafe_ids[1]).map_is_current())
+
+
+class ImportCafesTestCase(TestCase):
+    """Tests for the import-cafes command."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        db.session.commit()
+
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def import_feed(self, filename, content, *args):
+        path = os.path.join(self.dir, filename)
+        with open(path, 'w') as f:
+            f.write(content)
+
+        runner = app.test_cli_runner()
+        return runner.invoke(args=['import-cafes', path, *args])
+
+    def test_import_csv(self):
+        feed = "\n".join([
+            "source_id,name,description,url,address,city_code,image_url",
+            "v1,Cafe One,Nice,http://one.com/,1 Main St,sf,http://one.com/i",
+            "v2,Cafe Two,Nice,not a url,2 Main St,sf,http://two.com/i",
+            "v3,Cafe Three,Nice,http://three.com/,3 Main St,xx,http://t.com/i",
+            ",Cafe Four,Nice,http://four.com/,4 Main St,sf,http://f.com/i",
+        ])
+
+        result = self.import_feed('feed.csv', feed)
+        self.assertIn("Read 4 rows", result.output)
+        self.assertIn("1 cafes added or changed, 3 rows rejected",
+                      result.output)
+        self.assertIn("Line 3: url: Invalid URL.", result.output)
+        self.assertIn("Line 4: city_code: Not a valid choice", result.output)
+        self.assertIn("Line 5: source_id: This field is required.",
+                      result.output)
+
+        cafe = Cafe.query.filter_by(source_id='v1').one()
+        self.assertEqual(cafe.name, "Cafe One")
+        self.assertEqual(cafe.map_status, 'pending')
+        self.assertEqual(cafe.revision, 1)
+
+    def test_import_ndjson_upserts(self):
+        rows = [dict(CAFE_DATA, source_id=f"v{i}", name=f"Cafe {i}")
+                for i in range(5)]
+        feed = "\n".join(json.dumps(row) for row in rows)
+
+        result = self.import_feed('feed.ndjson', feed, '--batch-size', '2')
+        self.assertIn("5 cafes added or changed, 0 rows rejected",
+                      result.output)
+
+        # reimporting changes nothing, unless a row has changed
+        rows[0]['name'] = "Renamed"
+        feed = "\n".join(json.dumps(row) for row in rows + ["junk"])
+
+        result = self.import_feed('feed.ndjson', feed)
+        self.assertIn("1 cafes added or changed, 1 rows rejected",
+                      result.output)
+
+        self.assertEqual(Cafe.query.count(), 5)
+        cafe = Cafe.query.filter_by(source_id='v0').one()
+        self.assertEqual(cafe.name, "Renamed")
+        self.assertEqual(cafe.revision, 2)
+
+        # imported cafes are searchable & listed
+        self.assertEqual(cafe_search.search_ids("renamed"), [cafe.id])
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            self.assertIn(b"Renamed", resp.data)
+
+
+class GenerateDataTestCase(TestCase):
+    """Tests for the synthetic data generator."""
+
+    def setUp(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    tearDown = setUp
+
+    def test_deterministic(self):
+        def generate(seed):
+            generator = DataGenerator(seed=seed)
+            cities = generator.cities(3)
+            cafes = generator.cafes(50, cities)
+            users = generator.users(20, 'hashed')
+            likes = generator.likes(
+                users, cafes, parse_distribution('fixed:5'))
+            return cafes, likes
+
+        self.assertEqual(generate(1), generate(1))
+        self.assertNotEqual(generate(1), generate(2))
+
+        cafes, likes = generate(1)
+        self.assertEqual(len(likes), 100)
+        self.assertEqual(len(set(likes)), 100)
+        self.assertEqual(sum(cafe['like_count'] for cafe in cafes), 100)
+
+    def test_distributions(self):
+        rng = random.Random(0)
+
+        self.assertEqual(parse_distribution('fixed:3')(rng), 3)
+        self.assertIn(parse_distribution('uniform:2:4')(rng), [2, 3, 4])
+
+        geometric = parse_distribution('geometric:10')
+        mean = sum(geometric(rng) for _ in range(10000)) / 10000
+        self.assertAlmostEqual(mean, 10, delta=1)
+
+        with self.assertRaises(ValueError):
+            parse_distribution('zipf')
+
+    def test_generate_data(self):
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=[
+            'generate-data', '--cities', '3', '--cafes', '40',
+            '--users', '10', '--likes-per-user', 'uniform:1:5'])
+        self.assertIn("Generated 3 cities, 40 cafes, 10 users", result.output)
+
+        self.assertEqual(Cafe.query.count(), 40)
+        self.assertTrue(User.query.filter_by(username='admin').one().admin)
+        self.assertTrue(User.authenticate('user1', 'password'))
+
+        # like counts match the likes
+        self.assertEqual(Cafe.recount_likes(), 0)
+        self.assertEqual(
+            db.session.query(db.func.sum(Cafe.like_count)).scalar(),
+            UserLikesCafe.query.count())
+
+    def test_lookup_ids(self):
+        runner = app.test_cli_runner()
+        runner.invoke(args=['generate-data', '--cities', '2', '--cafes', '20',
+                            '--users', '2'])
+
+        keys = [f'synthetic-{i}' for i in range(20)] + ['missing']
+        ids = lookup_ids(Cafe.source_id, keys, batch_size=6)
+
+        self.assertEqual(
+            ids, dict(db.session.query(Cafe.source_id, Cafe.id)))
+
+
+class BenchTestCase(TestCase):
+    """Tests for the route benchmarks (bench.py)."""
+
+    def setUp(self):
+        GenerateDataTestCase.setUp(self)
+
+        runner = app.test_cli_runner()
+        runner.invoke(args=['generate-data', '--cities', '2', '--cafes', '30',
+                            '--users', '3', '--password', 'secret'])
+
+    tearDown = GenerateDataTestCase.tearDown
+
+    def test_routes(self):
+        with app.app_context():
+            data = bench.Dataset('user1', 'secret')
+
+        for mode in ['client', 'server']:
+            results = bench.run_benchmarks(
+                app, data, mode=mode, n=5, warmup=1, concurrency=2)
+
+            self.assertEqual(set(results),
+                             {scenario.name for scenario in bench.SCENARIOS})
+            for name, result in results.items():
+                self.assertEqual(result['errors'], 0, name)
+
+            self.assertGreater(results['profile']['sql_per_request'], 0)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(bench.percentile(values, 50), 50)
+        self.assertEqual(bench.percentile(values, 99), 99)
+        self.assertEqual(bench.percentile([7], 95), 7)
+
+    def test_compare(self):
+        baseline = {'cafe_list': dict(p95_ms=10.0, rps=100.0,
+                                      sql_per_request=2.0)}
+
+        results = {'cafe_list': dict(p95_ms=11.0, rps=95.0,
+                                     sql_per_request=2.0)}
+        self.assertEqual(bench.compare(results, baseline), [])
+
+        results = {'cafe_list': dict(p95_ms=20.0, rps=50.0,
+                                     sql_per_request=3.0)}
+        self.assertEqual(len(bench.compare(results, baseline)), 3)
+
+
+class StubMapQuestHandler(BaseHTTPRequestHandler):
+    """Stands in for MapQuest: replies with the server's `status`."""
+
+    def do_GET(self):
+        self.server.hits += 1
+        self.send_response(self.server.status)
+        self.end_headers()
+        self.wfile.write(b'stub map')
+
+    def log_message(self, *args):
+        pass
+
+
+class MapQuestClientTestCase(TestCase):
+    """Tests for the MapQuest HTTP client, against a local stub server."""
+
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StubMapQuestHandler)
+        self.server.hits = 0
+        self.server.status = 200
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        self.client = MapQuestClient()
+        self.client.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.client.retries = 0
+        self.client.breaker.failure_threshold = 2
+        self.url = self.client.static_map_url("500 Sansome St,SF,CA")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get(self):
+        self.assertEqual(self.client.get(self.url), b'stub map')
+        self.assertEqual(self.client.get(self.url), b'stub map')
+
+        stats = self.client.stats()
+        self.assertEqual((stats['calls'], stats['failures']), (2, 0))
+        self.assertGreater(stats['total_latency'], 0)
+
+    def test_circuit_breaker(self):
+        self.server.status = 500
+
+        for _ in range(2):
+            with self.assertRaises(MapQuestUnavailable):
+                self.client.get(self.url)
+
+        # breaker is now open: fail fast without calling the server
+        with self.assertRaises(CircuitOpen):
+            self.client.get(self.url)
+        self.assertEqual(self.server.hits, 2)
+
+        # after the reset timeout a trial call goes through & closes it
+        self.server.status = 200
+        self.client.breaker.reset_timeout = 0
+        self.assertEqual(self.client.get(self.url), b'stub map')
+        self.assertEqual(self.client.breaker.state, 'closed')
+
+        stats = self.client.stats()
+        self.assertEqual(
+            (stats['calls'], stats['failures'], stats['short_circuits']),
+            (4, 3, 1))
+
+
 class CafeViewsTestCase(TestCase):
     """Tests for views on cafes."""
 
@@ -231,15 +702,77 @@ class CafeViewsTestCase(TestCase):
             self.assertIn(b"Test Cafe", resp.data)
             self.assertIn(b'testcafe.com', resp.data)
 
+    def test_list_pagination(self):
+        db.session.add(Cafe(**dict(CAFE_DATA, name="Another Cafe")))
+        db.session.commit()
 
-class CafeAdminViewsTestCase(TestCase):
-    """Tests for add/edit views on cafes."""
+        with app.test_client() as client:
+            resp = client.get("/cafes?limit=1")
+            self.assertIn(b"Another Cafe", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
 
-    def setUp(self):
-        """Before each test, add sample city, users, and cafes"""
+            next_cursor = re.search(
+                r'after=([^&"]+)', resp.data.decode('utf8')).group(1)
+            resp = client.get(f"/cafes?after={next_cursor}&limit=1")
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertNotIn(b"Another Cafe", resp.data)
+            self.assertNotIn(b"after=", resp.data)
 
-        City.query.delete()
+            prev_cursor = re.search(
+                r'before=([^&"]+)', resp.data.decode('utf8')).group(1)
+            resp = client.get(f"/cafes?before={prev_cursor}&limit=1")
+            self.assertIn(b"Another Cafe", resp.data)
+            self.assertNotIn(b"before=", resp.data)
+
+    def test_detail_map_placeholder(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(bytes(MAP_PLACEHOLDER_URL, 'utf8'), resp.data)
+
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.map_status = 'ready'
+            db.session.commit()
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(
+                bytes(f"/static/images/maps/{self.cafe_id}.jpeg", 'utf8'),
+                resp.data)
+
+    def test_list_bad_cursor(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes?after=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_list_popular(self):
+        popular = Cafe(**dict(CAFE_DATA, name="Popular Cafe", like_count=5))
+        db.session.add(popular)
+        db.session.commit()
+
+        with app.test_client() as client:
+            resp = client.get("/cafes?sort=popular&limit=1")
+            self.assertIn(b"Popular Cafe", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+            next_cursor = re.search(
+                r'after=([^&"]+)', resp.data.decode('utf8')).group(1)
+            resp = client.get(f"/cafes?sort=popular&after={next_cursor}")
+            self.assertIn(b"Test Cafe", resp.data)
+
+            # cursors from one ordering don't work in another
+            resp = client.get(f"/cafes?after={next_cursor}")
+            self.assertEqual(resp.status_code, 400)
+
+            resp = client.get("/cafes?sort=nonsense")
+            self.assertEqual(resp.status_code, 400)
+
+
+class PageCacheTestCase(TestCase):
+    """Tests for caching anonymous pages."""
+
+    def setUp(self):
         Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
 
         sf = City(**CITY_DATA)
         db.session.add(sf)
@@ -247,68 +780,973 @@ class CafeAdminViewsTestCase(TestCase):
         cafe = Cafe(**CAFE_DATA)
         db.session.add(cafe)
 
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
         db.session.commit()
 
         self.cafe_id = cafe.id
+        self.user_id = user.id
+        page_cache.backend.clear()
+        page_cache.reset_stats()
 
     def tearDown(self):
-        """After each test, delete the cities."""
-
         Cafe.query.delete()
         City.query.delete()
+        User.query.delete()
         db.session.commit()
 
-    def test_add(self):
+    def test_cached(self):
         with app.test_client() as client:
-            resp = client.get(f"/cafes/add")
-            self.assertIn(b'Add Cafe', resp.data)
+            for path in ["/", "/cafes", f"/cafes/{self.cafe_id}"]:
+                resp = client.get(path)
+                self.assertEqual(resp.headers['X-Cache'], 'MISS')
 
-            resp = client.post(
-                f"/cafes/add",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'added', resp.data)
+                resp = client.get(path)
+                self.assertEqual(resp.headers['X-Cache'], 'HIT')
+                self.assertEqual(resp.status_code, 200)
+                self.assertIn(b"</html>", resp.data)
 
-    def test_dynamic_cities_vocab(self):
-       id = self.cafe_id
+        self.assertEqual(page_cache.stats()['hits'], 3)
+        self.assertEqual(page_cache.stats()['misses'], 3)
 
-       # the following is a regular expression for the HTML for the drop-down
-       # menu pattern we want to check for
-       choices_pattern = re.compile(
-           r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
-           r'San Francisco</option></select>')
+    def test_not_cached_when_logged_in(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
 
-       with app.test_client() as client:
-           resp = client.get(f"/cafes/add")
-           self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+            client.get("/cafes")
+            resp = client.get("/cafes")
+            self.assertNotIn('X-Cache', resp.headers)
 
-           resp = client.get(f"/cafes/{id}/edit")
-           self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+    def test_invalidated_by_edits(self):
+        with app.test_client() as client:
+            client.get("/cafes")
+            client.get(f"/cafes/{self.cafe_id}")
 
-    def test_edit(self):
-        id = self.cafe_id
+            # a change the listing doesn't show leaves it cached
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.address = "1 New Street"
+            db.session.commit()
 
+            resp = client.get("/cafes")
+            self.assertEqual(resp.headers['X-Cache'], 'HIT')
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertEqual(resp.headers['X-Cache'], 'MISS')
+            self.assertIn(b"1 New Street", resp.data)
+
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.name = "Renamed Cafe"
+            db.session.commit()
+
+            resp = client.get("/cafes")
+            self.assertIn(b"Renamed Cafe", resp.data)
+
+            city = City.query.get("sf")
+            city.name = "San Fran"
+            db.session.commit()
+
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertIn(b"San Fran,", resp.data)
+
+    def test_detail_body_shared_by_users(self):
         with app.test_client() as client:
-            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
-            self.assertIn(b'Edit Test Cafe', resp.data)
+            client.get(f"/cafes/{self.cafe_id}")
 
-            resp = client.post(
-                f"/cafes/{id}/edit",
-                data=CAFE_DATA_EDIT,
-                follow_redirects=True)
-            self.assertIn(b'edited', resp.data)
+            do_login(client, self.user_id)
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            self.assertNotIn('X-Cache', resp.headers)
+            self.assertIn(b"Test Cafe", resp.data)
+            self.assertIn(b"Testy MacTest", resp.data)
 
+        self.assertEqual(page_cache.stats()['fragment_misses'], 1)
+        self.assertEqual(page_cache.stats()['fragment_hits'], 1)
 
-#######################################
-# users
+    def test_filesystem_backend_is_shared(self):
+        app.config['PAGE_CACHE_DIR'] = tempfile.mkdtemp()
 
+        try:
+            worker1 = FileSystemBackend(app)
+            worker2 = FileSystemBackend(app)
+
+            worker1.set('/cafes?', 'page', 60)
+            self.assertEqual(worker2.get('/cafes?'), 'page')
+
+            self.assertEqual(worker2.get_versions(['cafes']), {'cafes': None})
+            worker1.bump(['cafes'])
+            self.assertIsNotNone(worker2.get_versions(['cafes'])['cafes'])
+        finally:
+            del app.config['PAGE_CACHE_DIR']
+            page_cache.init_app(app)
+
+
+class ConditionalGetTestCase(TestCase):
+    """Tests for ETags & 304 Not Modified responses."""
+
+    def setUp(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        self.user_id = user.id
+
+    def tearDown(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def assertNotModified(self, client, path, etag):
+        resp = client.get(path, headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b"")
+
+    def test_missing_catalog_versions(self):
+        CatalogVersion.query.delete()
+        db.session.commit()
+
+        try:
+            with app.test_client() as client:
+                for path in ["/cafes", f"/cafes/{self.cafe_id}"]:
+                    resp = client.get(path)
+                    self.assertEqual(resp.status_code, 200)
+                    self.assertIsNone(resp.headers.get('ETag'))
+        finally:
+            db.session.add_all([CatalogVersion(name='cafes'),
+                                CatalogVersion(name='cities')])
+            db.session.commit()
+
+    def test_cafe_detail(self):
+        path = f"/cafes/{self.cafe_id}"
+
+        with app.test_client() as client:
+            resp = client.get(path)
+            etag, _ = resp.get_etag()
+            self.assertIsNotNone(resp.last_modified)
+            self.assertNotModified(client, path, etag)
+
+            last_modified = resp.headers['Last-Modified']
+            resp = client.get(
+                path, headers={'If-Modified-Since': last_modified})
+            self.assertEqual(resp.status_code, 304)
+
+            # likes don't change the page...
+            UserLikesCafe.like(self.user_id, self.cafe_id)
+            db.session.commit()
+            self.assertNotModified(client, path, etag)
+
+            # ...but edits do
+            cafe = Cafe.query.get(self.cafe_id)
+            cafe.description = "New description"
+            db.session.commit()
+            self.assertEqual(cafe.revision, 2)
+
+            resp = client.get(path, headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"New description", resp.data)
+            self.assertNotEqual(resp.get_etag()[0], etag)
+
+    def test_cafe_list(self):
+        with app.test_client() as client:
+            resp = client.get("/cafes")
+            etag, _ = resp.get_etag()
+            self.assertNotModified(client, "/cafes", etag)
+
+            # different pages have different tags
+            resp = client.get("/cafes?sort=popular")
+            self.assertNotEqual(resp.get_etag()[0], etag)
+
+            db.session.add(Cafe(**dict(CAFE_DATA, name="Another Cafe")))
+            db.session.commit()
+
+            resp = client.get("/cafes", headers={'If-None-Match': f'"{etag}"'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(b"Another Cafe", resp.data)
+
+    def test_user_likes(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            for path in ["/profile", f"/api/likes?cafe_id={self.cafe_id}"]:
+                resp = client.get(path)
+                etag, _ = resp.get_etag()
+                self.assertIn('private', resp.headers['Cache-Control'])
+                self.assertNotModified(client, path, etag)
+
+                client.post("/api/like", json={"cafe_id": self.cafe_id})
+
+                resp = client.get(path, headers={'If-None-Match': f'"{etag}"'})
+                self.assertEqual(resp.status_code, 200)
+
+                client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+
+    def test_no_etag_on_flashed_pages(self):
+        with app.test_client() as client:
+            with client.session_transaction() as sess:
+                sess['_flashes'] = [('message', 'Hello!')]
+
+            resp = client.get("/cafes")
+            self.assertIn(b"Hello!", resp.data)
+            self.assertIsNone(resp.get_etag()[0])
+
+
+class InstrumentationTestCase(TestCase):
+    """Tests for per-request SQL counts & the query budget."""
+
+    def setUp(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+        page_cache.backend.clear()
+
+    def tearDown(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+        app.config['SQL_QUERY_BUDGET'] = 10
+
+    def test_server_timing(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{self.cafe_id}")
+            timing = resp.headers['Server-Timing']
+            match = re.match(
+                r'db;dur=[0-9.]+;desc="(\d+) queries", total;dur=[0-9.]+',
+                timing)
+            self.assertIsNotNone(match)
+            self.assertGreater(int(match.group(1)), 0)
+
+            # the homepage doesn't touch the database
+            resp = client.get("/")
+            self.assertIn('"0 queries"', resp.headers['Server-Timing'])
+
+    def test_log_line(self):
+        with app.test_client() as client:
+            with self.assertLogs('instrumentation', 'INFO') as logs:
+                client.get(f"/cafes/{self.cafe_id}")
+
+        self.assertIn(f"method=GET path=/cafes/{self.cafe_id} status=200",
+                      logs.output[0])
+
+    def test_query_budget(self):
+        app.config['SQL_QUERY_BUDGET'] = 1
+
+        with app.test_client() as client:
+            with self.assertLogs('instrumentation', 'WARNING') as logs:
+                client.get(f"/cafes/{self.cafe_id}")
+
+        self.assertIn("(budget is 1)", logs.output[0])
+
+
+class AppFactoryTestCase(TestCase):
+    """Tests for create_app & its profiles."""
+
+    def test_prod_needs_secret_key(self):
+        with patch.object(ProductionConfig, 'SECRET_KEY', None):
+            with self.assertRaises(RuntimeError):
+                create_app('prod')
+
+    def test_prod_skips_debug_tooling(self):
+        # in a new process, so we see just what the app imports
+        code = """if True:
+            import sys
+            from app import create_app
+            app = create_app('prod')
+            print(app.debug, 'flask_debugtoolbar' in sys.modules,
+                  'requests' in sys.modules, 'numpy' in sys.modules)
+        """
+        env = dict(os.environ, FLASK_SECRET_KEY='secret')
+        output = subprocess.run(
+            [sys.executable, '-c', code],
+            env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+
+        self.assertEqual(output.split(), [b'False'] * 4)
+
+    def test_startup_times(self):
+        with app.test_client() as client:
+            client.get("/")
+
+        times = app.extensions['startup_times']
+        self.assertEqual(set(times), {'imports', 'create_app',
+                                      'first_request'})
+        self.assertGreater(times['first_request'], times['imports'])
+
+    def test_one_app_per_process(self):
+        other = Flask(__name__)
+
+        for extension in [job_queue, recommender, page_cache, map_cache,
+                          mapquest, nearby_cafes]:
+            with self.assertRaises(RuntimeError):
+                extension.init_app(other)
+
+        with self.assertRaises(RuntimeError):
+            rate_limiter.init_app(other, user_key=CURR_USER_KEY)
+
+        self.assertEqual(other.before_request_funcs, {})
+
+
+class SearchTestCase(TestCase):
+    """Tests for cafe search (using the in-memory index)."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafes = [
+            Cafe(**CAFE_DATA),
+            Cafe(**dict(CAFE_DATA, name="Espresso Bar",
+                        description="Great test espresso")),
+        ]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+        cafe_search.reset()
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_inverted_index(self):
+        index = InvertedIndex()
+        index.add(1, dict(name="Blue Bottle", description="coffee"))
+        index.add(2, dict(name="Coffee Bar", description="blue door"))
+        index.add(3, dict(name="Tea House", description="no coffee"))
+
+        self.assertEqual(index.search("coffee", 10), [2, 1, 3])
+        self.assertEqual(index.search("blue coffee", 10), [1, 2])
+        self.assertEqual(index.search("coffee", 1), [2])
+        self.assertEqual(index.search("matcha", 10), [])
+
+        index.remove(2)
+        self.assertEqual(index.search("coffee", 10), [1, 3])
+
+    def test_search_ranks_name_first(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/search?q=test")
+            self.assertEqual(
+                [cafe['id'] for cafe in resp.json['cafes']], self.cafe_ids)
+
+            resp = client.get("/api/cafes/search?q=test&limit=-1")
+            self.assertEqual(
+                [cafe['id'] for cafe in resp.json['cafes']],
+                self.cafe_ids[:1])
+
+            resp = client.get("/cafes/search?q=espresso")
+            self.assertIn(b"Espresso Bar", resp.data)
+            self.assertNotIn(b"Test Cafe", resp.data)
+
+    def test_index_follows_edits(self):
+        cafe_search.search("test")
+
+        cafe = Cafe.query.get(self.cafe_ids[0])
+        cafe.name = "Renamed"
+        db.session.commit()
+
+        self.assertEqual(
+            cafe_search.search_ids("renamed"), [self.cafe_ids[0]])
+        self.assertEqual(cafe_search.search_ids("cafe"), [])
+
+
+class NearbyTestCase(TestCase):
+    """Tests for geocoding and finding nearby cafes."""
+
+    def setUp(self):
+        Cafe.query.delete()
+        City.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        near = Cafe(**CAFE_DATA, latitude=37.79, longitude=-122.40)
+        far = Cafe(**dict(CAFE_DATA, name="Far Cafe"),
+                   latitude=40.71, longitude=-74.00)
+        db.session.add_all([near, far])
+        db.session.commit()
+
+        self.near_id = near.id
+        self.far_id = far.id
+        nearby_cafes.reset()
+
+    def tearDown(self):
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_grid_matches_brute_force(self):
+        rng = random.Random(0)
+        points = {
+            id: (rng.uniform(37, 38.5), rng.uniform(-123, -121.5))
+            for id in range(500)
+        }
+        points[500] = (-33.9, 151.2)
+
+        index = GridIndex(cell_size=0.05)
+        for id, (lat, lng) in points.items():
+            index.add(id, lat, lng)
+
+        for lat, lng in [(37.77, -122.42), (38.4, -121.6)]:
+            expected = sorted(
+                (distance_km(lat, lng, *point), id)
+                for id, point in points.items())[:10]
+            self.assertEqual(
+                [id for _, id in index.nearest(lat, lng, 10)],
+                [id for _, id in expected])
+
+        # only points within max_rings rings are found
+        self.assertEqual(
+            [id for _, id in index.nearest(-33.8, 151.1, 10)], [500])
+        self.assertEqual(index.nearest(0, 0, 10), [])
+
+    def test_bounds_follow_removals(self):
+        index = GridIndex(cell_size=1, max_rings=3)
+        index.add(1, 0.5, 0.5)
+        index.add(2, 10.5, 20.5)
+        self.assertEqual(index.bounds, (0, 10, 0, 20))
+        self.assertEqual([id for _, id in index.nearest(10, 18, 1)], [2])
+
+        index.remove(2)
+        self.assertEqual(index.bounds, (0, 0, 0, 0))
+        self.assertEqual(index.nearest(10, 18, 1), [])
+        self.assertEqual([id for _, id in index.nearest(3, 3, 1)], [1])
+
+        index.remove(1)
+        self.assertIsNone(index.bounds)
+        self.assertEqual(index.nearest(0, 0, 1), [])
+
+    def test_far_query_on_sparse_grid(self):
+        rng = random.Random(0)
+        points = {
+            id: (rng.uniform(30, 50), rng.uniform(-120, -70))
+            for id in range(10000)
+        }
+
+        index = GridIndex(cell_size=0.05)
+        for id, (lat, lng) in points.items():
+            index.add(id, lat, lng)
+
+        # far from every point, and in the middle of the sparse grid
+        for lat, lng in [(0, 0), (40, -95)]:
+            start = time.perf_counter()
+            found = index.nearest(lat, lng, 5)
+            self.assertLess(time.perf_counter() - start, 0.1)
+
+        self.assertEqual(index.nearest(0, 0, 5), [])
+        expected = sorted(
+            (distance_km(40, -95, *point), id)
+            for id, point in points.items())[:5]
+        self.assertEqual([id for _, id in found],
+                         [id for _, id in expected])
+
+    def test_nearby_api(self):
+        with app.test_client() as client:
+            resp = client.get("/api/cafes/nearby?lat=37.78&lng=-122.41&k=1")
+            cafes = resp.json['cafes']
+            self.assertEqual([cafe['id'] for cafe in cafes], [self.near_id])
+            self.assertLess(cafes[0]['distance_km'], 2)
+
+            # the near cafe is across the country
+            resp = client.get("/api/cafes/nearby?lat=40.7&lng=-74&k=5")
+            self.assertEqual(
+                [cafe['id'] for cafe in resp.json['cafes']], [self.far_id])
+
+            resp = client.get("/api/cafes/nearby?lat=100&lng=0")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_index_follows_edits(self):
+        nearby_cafes.nearest(0, 0, 5)
+
+        far = Cafe.query.get(self.far_id)
+        far.latitude, far.longitude = 0.01, 0.01
+        db.session.commit()
+
+        self.assertEqual(
+            nearby_cafes.nearest(0, 0, 1)[0][0].id, self.far_id)
+
+    def test_rebuilt_in_background(self):
+        old_index = nearby_cafes.get_index()
+        building = threading.Event()
+        finish = threading.Event()
+        build = nearby_cafes._build
+
+        def slow_build():
+            building.set()
+            finish.wait(5)
+            return build()
+
+        with patch.object(nearby_cafes, '_build', slow_build):
+            nearby_cafes.built_at -= app.config['NEARBY_INDEX_MAX_AGE'] + 1
+
+            # the old index is served while the new one's built...
+            self.assertIs(nearby_cafes.get_index(), old_index)
+            self.assertTrue(building.wait(5))
+
+            # ...and edits made meanwhile make it into the new one
+            far = Cafe.query.get(self.far_id)
+            far.latitude, far.longitude = 0.01, 0.01
+            db.session.commit()
+
+            finish.set()
+            nearby_cafes.refresher.join(5)
+
+        self.assertIsNot(nearby_cafes.get_index(), old_index)
+        self.assertEqual(
+            nearby_cafes.nearest(0, 0, 1)[0][0].id, self.far_id)
+
+    @patch('models.mapquest.get', return_value=b'map')
+    def test_geocoded_with_map(self, mock_get):
+        cafe = Cafe(**dict(CAFE_DATA, address="1 Market St"))
+        db.session.add(cafe)
+        db.session.commit()
+        cafe_id = cafe.id
+
+        saved_dirs = (map_cache.directory, map_cache.maps_dir)
+        map_cache.directory = tempfile.mkdtemp()
+        map_cache.maps_dir = tempfile.mkdtemp()
+        try:
+            job_queue.enqueue('fetch_cafe_map', cafe_id)
+        finally:
+            map_cache.directory, map_cache.maps_dir = saved_dirs
+
+        cafe = Cafe.query.get(cafe_id)
+        self.assertAlmostEqual(cafe.latitude, 37.7749, places=1)
+        self.assertAlmostEqual(cafe.longitude, -122.4194, places=1)
+
+
+class RecommendTestCase(TestCase):
+    """Tests for similar cafes & picks."""
+
+    def setUp(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**dict(CAFE_DATA, name=f"Cafe {name}"))
+                 for name in "ABCD"]
+        users = [User.register(**dict(TEST_USER_DATA, username=f"user{i}",
+                                      email=f"user{i}@test.com"))
+                 for i in range(3)]
+        db.session.add_all(cafes + users)
+        db.session.commit()
+
+        self.cafe_ids = [cafe.id for cafe in cafes]
+        self.user_ids = [user.id for user in users]
+        a, b, c, d = self.cafe_ids
+
+        for user_id, liked in zip(self.user_ids, [(a, b), (a, b, c), (c, d)]):
+            for cafe_id in liked:
+                db.session.add(UserLikesCafe(user_id=user_id, cafe_id=cafe_id))
+        db.session.commit()
+
+        recommender.reset()
+        recommender.refresh()
+        page_cache.backend.clear()
+
+    def tearDown(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+        recommender.reset()
+
+    def similar_ids(self, cafe_id):
+        return [cafe.id for cafe in recommender.similar_cafes(cafe_id)]
+
+    def test_similar_and_picks(self):
+        a, b, c, d = self.cafe_ids
+
+        # A & C are liked together by just one user (< RECOMMEND_MIN_CO_LIKES)
+        self.assertEqual(self.similar_ids(a), [b])
+        self.assertEqual(
+            [cafe.id for cafe in recommender.picks(self.user_ids[2])], [a, b])
+        self.assertEqual(
+            [cafe.id for cafe in recommender.picks(self.user_ids[1])], [d])
+
+    def test_builds_in_background(self):
+        a, b, c, d = self.cafe_ids
+        recommender.reset()
+
+        # nothing while it's being built, not a wait
+        self.assertEqual(self.similar_ids(a), [])
+        recommender.refresher.join()
+        self.assertEqual(self.similar_ids(a), [b])
+
+    def test_follows_likes(self):
+        a, b, c, d = self.cafe_ids
+        self.assertEqual(self.similar_ids(b), [a])
+
+        with app.test_client() as client:
+            do_login(client, self.user_ids[2])
+
+            client.post("/api/like", json={"cafe_id": b})
+            self.assertEqual(self.similar_ids(b), [a, c])
+
+            client.post("/api/unlike", json={"cafe_id": b})
+            self.assertEqual(self.similar_ids(b), [a])
+
+    def test_matches_rebuild(self):
+        rng = random.Random(0)
+        likes = {(rng.randrange(30), rng.randrange(15)) for _ in range(150)}
+        colikes = CoLikes(*zip(*likes))
+
+        for _ in range(300):
+            like = (rng.randrange(35), rng.randrange(18))
+            liked = rng.random() < 0.5
+            colikes.update(*like, liked)
+            if liked:
+                likes.add(like)
+            else:
+                likes.discard(like)
+
+        rebuilt = CoLikes(*zip(*likes))
+
+        for cafe_id in range(18):
+            self.assertEqual(colikes.similar(cafe_id, 18),
+                             rebuilt.similar(cafe_id, 18))
+
+    def test_pages(self):
+        a, b, c, d = self.cafe_ids
+
+        with app.test_client() as client:
+            html = client.get(f"/cafes/{a}").get_data(as_text=True)
+            self.assertIn("People who liked this also liked", html)
+            self.assertIn(f'href="/cafes/{b}"', html)
+
+            do_login(client, self.user_ids[2])
+            html = client.get("/profile").get_data(as_text=True)
+            self.assertIn("Picked for You", html)
+            self.assertIn(f'href="/cafes/{a}"', html)
+
+    def test_rebuild_command(self):
+        a, b, c, d = self.cafe_ids
+        path = os.path.join(tempfile.mkdtemp(), 'recommendations.npz')
+        saved_path = app.config['RECOMMEND_SNAPSHOT']
+        app.config['RECOMMEND_SNAPSHOT'] = path
+
+        try:
+            self.assertEqual(self.similar_ids(b), [a])
+
+            # added behind the recommender's back
+            db.session.add(UserLikesCafe(user_id=self.user_ids[2], cafe_id=b))
+            db.session.commit()
+
+            runner = app.test_cli_runner()
+            result = runner.invoke(args=['rebuild-recommendations'])
+            self.assertIn("3 users for 4 cafes", result.output)
+
+            # picked up at the next check
+            recommender.refresh()
+            self.assertEqual(self.similar_ids(b), [a, c])
+        finally:
+            app.config['RECOMMEND_SNAPSHOT'] = saved_path
+
+
+class CafeAdminViewsTestCase(TestCase):
+    """Tests for add/edit views on cafes."""
+
+    def setUp(self):
+        """Before each test, add sample city, users, and cafes"""
+
+        City.query.delete()
+        Cafe.query.delete()
+
+        sf = City(**CITY_DATA)
+        db.session.add(sf)
+
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+
+        db.session.commit()
+
+        self.cafe_id = cafe.id
+
+    def tearDown(self):
+        """After each test, delete the cities."""
+
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def test_add(self):
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/add")
+            self.assertIn(b'Add Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/add",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'added', resp.data)
+
+    def test_dynamic_cities_vocab(self):
+       id = self.cafe_id
+
+       # the following is a regular expression for the HTML for the drop-down
+       # menu pattern we want to check for
+       choices_pattern = re.compile(
+           r'<select [^>]*name="city_code"[^>]*><option [^>]*value="sf">' +
+           r'San Francisco</option></select>')
+
+       with app.test_client() as client:
+           resp = client.get(f"/cafes/add")
+           self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+           resp = client.get(f"/cafes/{id}/edit")
+           self.assertRegex(resp.data.decode('utf8'), choices_pattern)
+
+    def test_edit(self):
+        id = self.cafe_id
+
+        with app.test_client() as client:
+            resp = client.get(f"/cafes/{id}/edit", follow_redirects=True)
+            self.assertIn(b'Edit Test Cafe', resp.data)
+
+            resp = client.post(
+                f"/cafes/{id}/edit",
+                data=CAFE_DATA_EDIT,
+                follow_redirects=True)
+            self.assertIn(b'edited', resp.data)
+
+
+#######################################
+# background jobs
+
+
+job_calls = []
+
+
+def record_give_up(label, failures):
+    job_calls.append(('gave up', label))
+
+
+@job_queue.task(on_give_up=record_give_up)
+def flaky_job(label, failures):
+    """Test task that fails its first `failures` attempts."""
+
+    job_calls.append(('ran', label))
+
+    if job_calls.count(('ran', label)) <= failures:
+        raise RuntimeError("flaky")
+
+
+class JobQueueTestCase(TestCase):
+    """Tests for the background job queue."""
+
+    def setUp(self):
+        job_calls.clear()
+        Job.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        job_queue.shutdown()
+        app.config['JOB_QUEUE_BACKEND'] = 'inline'
+        Job.query.delete()
+        db.session.commit()
+
+    def test_retries_then_succeeds(self):
+        job_queue.enqueue('flaky_job', 'a', 2)
+        self.assertEqual(job_calls, [('ran', 'a')] * 3)
+
+    def test_gives_up(self):
+        job_queue.enqueue('flaky_job', 'b', 10)
+        max_attempts = app.config['JOB_MAX_ATTEMPTS']
+        self.assertEqual(
+            job_calls,
+            [('ran', 'b')] * max_attempts + [('gave up', 'b')])
+
+    def test_unknown_task(self):
+        with self.assertRaises(KeyError):
+            job_queue.enqueue('no_such_task')
+
+    def test_thread_backend(self):
+        job_queue.shutdown()
+        app.config['JOB_QUEUE_BACKEND'] = 'thread'
+
+        job_queue.enqueue('flaky_job', 'c', 1)
+        job_queue.shutdown(wait=True)
+
+        self.assertEqual(job_calls, [('ran', 'c')] * 2)
+
+    def test_database_backend(self):
+        job_queue.shutdown()
+        app.config['JOB_QUEUE_BACKEND'] = 'database'
+        app.config['JOB_POLL_INTERVAL'] = 0.01
+
+        job_queue.enqueue('flaky_job', 'd', 1)
+
+        for _ in range(500):
+            db.session.expire_all()
+            if Job.query.filter_by(status='done').count():
+                break
+            time.sleep(0.01)
+
+        job_queue.shutdown(wait=True)
+
+        self.assertEqual(job_calls, [('ran', 'd')] * 2)
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('done', 2))
+
+
+    def test_database_backend_reclaims_lost_jobs(self):
+        job_queue.shutdown()
+        app.config['JOB_QUEUE_BACKEND'] = 'database'
+        app.config['JOB_POLL_INTERVAL'] = 60
+        # stop its workers; we'll claim jobs ourselves
+        job_queue.backend.shutdown(wait=True)
+
+        # claimed by workers that died, their leases run out
+        max_attempts = app.config['JOB_MAX_ATTEMPTS']
+        expired = datetime(2000, 1, 1)
+        db.session.add_all([
+            Job(name='flaky_job', args='["e", 0]', status='running',
+                attempts=1, run_at=expired),
+            Job(name='flaky_job', args='["f", 0]', status='running',
+                attempts=max_attempts, run_at=datetime(2000, 1, 2)),
+        ])
+        db.session.commit()
+
+        backend = job_queue.backend
+        claimed = backend.claim()
+        self.assertEqual(claimed[1:], ('flaky_job', ['e', 0], 2))
+        self.assertEqual(backend.claim(), None)
+        self.assertEqual(job_calls, [('gave up', 'f')])
+
+        db.session.expire_all()
+        statuses = dict(db.session.query(Job.args, Job.status))
+        self.assertEqual(statuses, {'["e", 0]': 'running',
+                                    '["f", 0]': 'failed'})
+
+        # not taken again while its lease holds
+        self.assertEqual(backend.claim(), None)
+
+
+#######################################
+# users
+
+
+class PasswordHasherTestCase(TestCase):
+    """Tests for hashing passwords in a pool."""
+
+    def tearDown(self):
+        app.config['PASSWORD_HASHER'] = 'inline'
+        password_hasher.reset()
+
+    def test_pools(self):
+        for kind in ['thread', 'process']:
+            app.config['PASSWORD_HASHER'] = kind
+            password_hasher.reset()
+
+            hashed = password_hasher.hash("secret")
+            self.assertTrue(hashed.startswith("$2b$04$"))
+            self.assertTrue(password_hasher.check(hashed, "secret"))
+            self.assertFalse(password_hasher.check(hashed, "WRONG"))
+
+    def test_busy(self):
+        queue_size = app.config['PASSWORD_HASH_QUEUE_SIZE']
+        app.config['PASSWORD_HASHER'] = 'thread'
+        app.config['PASSWORD_HASH_QUEUE_SIZE'] = 1
+        password_hasher.reset()
+
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_hash(password, rounds):
+            started.set()
+            release.wait()
+
+        with patch('passwords.hash_password', slow_hash):
+            thread = threading.Thread(
+                target=password_hasher.hash, args=["secret"])
+            thread.start()
+            started.wait()
+
+            try:
+                with self.assertRaises(PasswordHasherBusy):
+                    password_hasher.hash("secret")
+            finally:
+                release.set()
+                thread.join()
+                app.config['PASSWORD_HASH_QUEUE_SIZE'] = queue_size
+
+        self.assertEqual(password_hasher.pending, 0)
+
+
+class UserModelTestCase(TestCase):
+    """Tests for the user model."""
+
+    def setUp(self):
+        """Before each test, add sample users."""
+
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+
+        db.session.commit()
+
+        self.user = user
+
+    def tearDown(self):
+        """After each test, remove all users."""
+
+        User.query.delete()
+        db.session.commit()
+
+    def test_authenticate(self):
+        rez = User.authenticate("test", "secret")
+        self.assertEqual(rez, self.user)
+
+    def test_authenticate_fail(self):
+        rez = User.authenticate("no-such-user", "secret")
+        self.assertEqual(rez, False)
+
+        rez = User.authenticate("test", "password")
+        self.assertEqual(rez, False)
+
+    def test_full_name(self):
+        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+
+    def test_register(self):
+        u = User.register(**TEST_USER_DATA)
+        # test that password gets bcrypt-hashed (all start w/$2b$)
+        self.assertEqual(u.hashed_password[:4], "$2b$")
+        db.session.rollback()
 
-class UserModelTestCase(TestCase):
-    """Tests for the user model."""
 
-    def setUp(self):
-        """Before each test, add sample users."""
+class UserCacheTestCase(TestCase):
+    """Tests for caching logged-in users between requests."""
 
+    def setUp(self):
         User.query.delete()
 
         user = User.register(**TEST_USER_DATA)
@@ -316,34 +1754,73 @@ class UserModelTestCase(TestCase):
 
         db.session.commit()
 
-        self.user = user
+        self.user_id = user.id
+        app.config['USER_CACHE_TTL'] = 60
+        user_cache.clear()
 
     def tearDown(self):
-        """After each test, remove all users."""
+        app.config['USER_CACHE_TTL'] = 0
+        user_cache.clear()
 
         User.query.delete()
         db.session.commit()
 
-    def test_authenticate(self):
-        rez = User.authenticate("test", "secret")
-        self.assertEqual(rez, self.user)
+    def test_ttl_cache(self):
+        now = [0]
+        cache = TTLCache(maxsize=2, clock=lambda: now[0])
 
-    def test_authenticate_fail(self):
-        rez = User.authenticate("no-such-user", "secret")
-        self.assertEqual(rez, False)
+        cache.set('a', 1, ttl=10)
+        cache.set('b', 2, ttl=10)
+        cache.get('a')
+        cache.set('c', 3, ttl=10)
+        self.assertEqual(
+            (cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
 
-        rez = User.authenticate("test", "password")
-        self.assertEqual(rez, False)
+        now[0] = 10
+        self.assertIsNone(cache.get('a'))
 
-    def test_full_name(self):
-        self.assertEqual(self.user.get_full_name(), "Testy MacTest")
+    def test_cached_identity(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            client.get("/cafes")
 
-    def test_register(self):
-        u = User.register(**TEST_USER_DATA)
-        # test that password gets bcrypt-hashed (all start w/$2b$)
-        self.assertEqual(u.hashed_password[:4], "$2b$")
+            identity = user_cache.get(self.user_id)
+            self.assertIsInstance(identity, UserIdentity)
+            self.assertEqual(identity.get_full_name(), "Testy MacTest")
+
+    def test_edit_invalidates(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            client.get("/cafes")
+
+            resp = client.post(
+                "/profile/edit",
+                data=TEST_USER_DATA_EDIT,
+                follow_redirects=True,
+            )
+
+            self.assertIn(b"new-fn new-ln", resp.data)
+            self.assertEqual(
+                user_cache.get(self.user_id).first_name, "new-fn")
+
+    def test_forgotten_on_commit(self):
+        user = User.query.get(self.user_id)
+        user.first_name = "new-fn"
+        db.session.flush()
+
+        # another request caches the user before our edit's committed
+        user_cache.set(self.user_id, 'stale', 60)
+        db.session.commit()
+        self.assertIsNone(user_cache.get(self.user_id))
+
+        user.first_name = "rolled-back"
+        db.session.flush()
         db.session.rollback()
 
+        user_cache.set(self.user_id, 'cached', 60)
+        db.session.commit()
+        self.assertEqual(user_cache.get(self.user_id), 'cached')
+
 
 class AuthViewsTestCase(TestCase):
     """Tests for views on logging in/logging out/registration."""
@@ -402,6 +1879,60 @@ class AuthViewsTestCase(TestCase):
             self.assertIn(b"Hello, test", resp.data)
             self.assertEqual(session.get(CURR_USER_KEY), self.user_id)
 
+    def test_login_rehashes_old_cost(self):
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        app.config['BCRYPT_LOG_ROUNDS'] = rounds + 1
+
+        try:
+            with app.test_client() as client:
+                client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                )
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+
+        user = User.query.get(self.user_id)
+        self.assertEqual(hash_rounds(user.hashed_password), rounds + 1)
+        self.assertTrue(User.authenticate("test", "secret"))
+
+    def test_login_skips_rehash_when_busy(self):
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        hashed = User.query.get(self.user_id).hashed_password
+        app.config['BCRYPT_LOG_ROUNDS'] = rounds + 1
+
+        try:
+            with patch.object(password_hasher, 'hash',
+                              side_effect=PasswordHasherBusy):
+                with app.test_client() as client:
+                    client.post(
+                        "/login",
+                        data={"username": "test", "password": "secret"},
+                    )
+                    self.assertEqual(session.get(CURR_USER_KEY),
+                                     self.user_id)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+
+        self.assertEqual(User.query.get(self.user_id).hashed_password, hashed)
+
+    def test_login_when_hasher_busy(self):
+        queue_size = app.config['PASSWORD_HASH_QUEUE_SIZE']
+        app.config['PASSWORD_HASH_QUEUE_SIZE'] = 0
+
+        try:
+            with app.test_client() as client:
+                resp = client.post(
+                    "/login",
+                    data={"username": "test", "password": "secret"},
+                )
+        finally:
+            app.config['PASSWORD_HASH_QUEUE_SIZE'] = queue_size
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.headers['Retry-After'], '1')
+        self.assertIn(b"a little busy", resp.data)
+
     def test_logout(self):
         with app.test_client() as client:
             do_login(client, self.user_id)
@@ -518,6 +2049,109 @@ class ProfileViewsTestCase(TestCase):
             self.assertIn(byte_string, resp.data)
 
 
+class FavoritesTestCase(TestCase):
+    """Tests for paging through a user's favorite cafes."""
+
+    def setUp(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.add(City(**CITY_DATA))
+
+        # liked in the order C, A, E, B, D
+        names = ["Cafe C", "Cafe A", "Cafe E", "Cafe B", "Cafe D"]
+        cafes = [Cafe(**dict(CAFE_DATA, name=name, description="x" * 300))
+                 for name in names]
+        db.session.add_all(cafes)
+        db.session.commit()
+
+        for i, cafe in enumerate(cafes):
+            db.session.add(UserLikesCafe(
+                user_id=user.id,
+                cafe_id=cafe.id,
+                liked_at=datetime(2020, 1, 1, 12, i),
+            ))
+        db.session.commit()
+
+        self.user_id = user.id
+
+    def tearDown(self):
+        UserLikesCafe.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def get_all(self, client, sort):
+        """Page through /api/profile/likes; return names & # of pages."""
+
+        path = f"/api/profile/likes?sort={sort}&limit=2"
+        names = []
+        pages = 0
+
+        while path:
+            resp = client.get(path)
+            names += [cafe['name'] for cafe in resp.json['cafes']]
+            pages += 1
+
+            after = resp.json['next']
+            path = after and (
+                f"/api/profile/likes?sort={sort}&limit=2&after={after}")
+
+        return names, pages
+
+    def test_profile_page(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            resp = client.get("/profile?limit=2")
+            html = resp.get_data(as_text=True)
+            self.assertIn("Cafe D", html)
+            self.assertIn("Cafe B", html)
+            self.assertNotIn("Cafe E", html)
+            self.assertIn("more-favorites", html)
+
+            # descriptions are cut short
+            self.assertIn("x" * 200 + "</p>", html)
+
+            resp = client.get("/profile?sort=name&limit=2")
+            self.assertIn(b"Cafe A", resp.data)
+            self.assertNotIn(b"Cafe D", resp.data)
+
+            self.assertEqual(client.get("/profile?sort=x").status_code, 400)
+            self.assertEqual(
+                client.get("/profile?after=nonsense").status_code, 400)
+
+    def test_api(self):
+        with app.test_client() as client:
+            resp = client.get("/api/profile/likes")
+            self.assertEqual(resp.json, {"error": "Not logged in"})
+
+            do_login(client, self.user_id)
+
+            self.assertEqual(
+                self.get_all(client, "recent"),
+                (["Cafe D", "Cafe B", "Cafe E", "Cafe A", "Cafe C"], 3))
+            self.assertEqual(
+                self.get_all(client, "name"),
+                (["Cafe A", "Cafe B", "Cafe C", "Cafe D", "Cafe E"], 3))
+
+            resp = client.get("/api/profile/likes?limit=1")
+            cafe = resp.json['cafes'][0]
+            self.assertEqual(cafe['liked_at'], "2020-01-01T12:04:00")
+            self.assertEqual(cafe['url'], f"/cafes/{cafe['id']}")
+
+            # a cursor for one order doesn't work for another
+            resp = client.get("/api/profile/likes?sort=name&limit=1")
+            resp = client.get(
+                f"/api/profile/likes?sort=recent&after={resp.json['next']}")
+            self.assertEqual(resp.status_code, 400)
+
+
 #######################################
 # likes
 
@@ -629,7 +2263,40 @@ class LikeViewsTestCase(TestCase):
                     likes=True
                 )
             )
- 
+
+    def test_get_api_likes_bulk(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            like = UserLikesCafe(user_id=self.user_id, cafe_id=self.cafe_id)
+
+            db.session.add(like)
+            db.session.commit()
+
+            other_id = self.cafe_id + 1
+            resp = client.get(
+                f"/api/likes?cafe_ids={self.cafe_id},{other_id}")
+
+            self.assertEqual(
+                resp.json,
+                dict(
+                    likes={str(self.cafe_id): True, str(other_id): False}
+                )
+            )
+
+            resp = client.get("/api/likes?cafe_ids=1,oops")
+            self.assertEqual(resp.status_code, 400)
+
+    def test_has_liked(self):
+        user = User.query.get(self.user_id)
+        self.assertFalse(user.has_liked(self.cafe_id))
+
+        like = UserLikesCafe(user_id=self.user_id, cafe_id=self.cafe_id)
+        db.session.add(like)
+        db.session.commit()
+
+        self.assertTrue(user.has_liked(self.cafe_id))
+
     def test_post_api_like(self):
         with app.test_client() as client:
             do_login(client, self.user_id)
@@ -676,4 +2343,397 @@ class LikeViewsTestCase(TestCase):
             )
             cafe = Cafe.query.get(self.cafe_id)
             liked_cafes = User.query.get(self.user_id).liked_cafes
-            self.assertNotIn(cafe, liked_cafes)
\ No newline at end of file
+            self.assertNotIn(cafe, liked_cafes)
+
+    def test_post_api_like_twice(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            for _ in range(2):
+                resp = client.post("/api/like", json={
+                    "cafe_id": self.cafe_id
+                })
+                self.assertEqual(resp.json, dict(liked=self.cafe_id))
+
+            for _ in range(2):
+                resp = client.post("/api/unlike", json={
+                    "cafe_id": self.cafe_id
+                })
+                self.assertEqual(resp.json, dict(unliked=self.cafe_id))
+
+            resp = client.post("/api/like", json={
+                "cafe_id": self.cafe_id + 1
+            })
+            self.assertEqual(resp.status_code, 404)
+
+    def test_post_api_likes_batch(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            resp = client.post("/api/likes/batch", json={"ops": [
+                {"cafe_id": self.cafe_id, "action": "like"},
+                {"cafe_id": self.cafe_id, "action": "unlike"},
+                {"cafe_id": self.cafe_id, "action": "like"},
+            ]})
+
+            self.assertEqual(
+                resp.json,
+                dict(liked=[self.cafe_id], unliked=[])
+            )
+            self.assertEqual(
+                UserLikesCafe.query.filter_by(user_id=self.user_id).count(),
+                1
+            )
+
+            for bad_op in [
+                {"cafe_id": self.cafe_id, "action": "explode"},
+                {"cafe_id": str(self.cafe_id), "action": "like"},
+                {"action": "like"},
+                "like",
+            ]:
+                resp = client.post("/api/likes/batch", json={"ops": [bad_op]})
+                self.assertEqual(resp.status_code, 400)
+
+            resp = client.post("/api/likes/batch", json=[1, 2])
+            self.assertEqual(resp.status_code, 400)
+            self.assertEqual(resp.json, {"error": "Invalid operation"})
+
+            # cafes that don't exist are left out
+            resp = client.post("/api/likes/batch", json={"ops": [
+                {"cafe_id": 0, "action": "like"},
+                {"cafe_id": self.cafe_id, "action": "unlike"},
+            ]})
+            self.assertEqual(
+                resp.json, dict(liked=[], unliked=[self.cafe_id]))
+
+    def test_like_count(self):
+        def like_count():
+            return (db.session.query(Cafe.like_count)
+                    .filter_by(id=self.cafe_id).scalar())
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            client.post("/api/like", json={"cafe_id": self.cafe_id})
+            client.post("/api/like", json={"cafe_id": self.cafe_id})
+            self.assertEqual(like_count(), 1)
+
+            client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+            client.post("/api/unlike", json={"cafe_id": self.cafe_id})
+            self.assertEqual(like_count(), 0)
+
+            client.post("/api/likes/batch", json={"ops": [
+                {"cafe_id": self.cafe_id, "action": "like"},
+            ]})
+            self.assertEqual(like_count(), 1)
+
+        # counts drift if likes are changed behind our back...
+        UserLikesCafe.query.delete()
+        db.session.commit()
+        self.assertEqual(like_count(), 1)
+
+        # ...until they're reconciled
+        self.assertEqual(Cafe.recount_likes(), 1)
+        db.session.commit()
+        self.assertEqual(like_count(), 0)
+        self.assertEqual(Cafe.recount_likes(), 0)
+
+
+    def test_cafe_state(self):
+        with app.test_client() as client:
+            resp = client.get(f"/api/cafes/{self.cafe_id}/state")
+            self.assertEqual(resp.json, dict(error="Not logged in"))
+
+            do_login(client, self.user_id)
+
+            resp = client.get(f"/api/cafes/{self.cafe_id}/state")
+            self.assertEqual(resp.json, dict(liked=False, admin=False))
+
+            client.post("/api/like", json={"cafe_id": self.cafe_id})
+            resp = client.get(f"/api/cafes/{self.cafe_id}/state")
+            self.assertEqual(resp.json, dict(liked=True, admin=False))
+
+
+class LikeBufferTestCase(TestCase):
+    """Tests for buffering likes & unlikes (LIKE_BUFFER)."""
+
+    def setUp(self):
+        UserLikesCafe.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(City(**CITY_DATA))
+        cafes = [Cafe(**dict(CAFE_DATA, name=f"Cafe {i}")) for i in range(2)]
+        db.session.add_all([user, *cafes])
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_ids = [cafe.id for cafe in cafes]
+
+        self.saved_config = {
+            key: app.config[key]
+            for key in ('LIKE_BUFFER', 'LIKE_BUFFER_INTERVAL',
+                        'LIKE_BUFFER_MAX_EVENTS')
+        }
+        # flush only when we say so
+        app.config.update(LIKE_BUFFER=True, LIKE_BUFFER_INTERVAL=60)
+
+    def tearDown(self):
+        like_buffer.shutdown()
+        app.config.update(self.saved_config)
+
+        UserLikesCafe.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+    def stored_likes(self):
+        db.session.rollback()
+        return sorted(cafe_id for (cafe_id,) in
+                      db.session.query(UserLikesCafe.cafe_id))
+
+    def test_coalesces_and_flushes_in_batch(self):
+        a, b = self.cafe_ids
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            client.post("/api/like", json={"cafe_id": a})
+            client.post("/api/unlike", json={"cafe_id": a})
+            client.post("/api/like", json={"cafe_id": a})
+            client.post("/api/likes/batch", json={"ops": [
+                {"cafe_id": b, "action": "like"},
+            ]})
+
+        self.assertEqual(self.stored_likes(), [])
+        self.assertEqual(like_buffer.stats()['pending'], 2)
+
+        batches = like_buffer.stats()['batches']
+        self.assertEqual(like_buffer.flush(), 2)
+        self.assertEqual(like_buffer.stats()['batches'], batches + 1)
+        self.assertEqual(self.stored_likes(), [a, b])
+        self.assertEqual(Cafe.query.get(a).like_count, 1)
+
+    def test_reads_own_writes(self):
+        a, b = self.cafe_ids
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            client.post("/api/like", json={"cafe_id": a})
+            self.assertEqual(self.stored_likes(), [])
+
+            resp = client.get(f"/api/cafes/{a}/state")
+            self.assertEqual(resp.json, dict(liked=True, admin=False))
+            self.assertEqual(self.stored_likes(), [a])
+
+            resp = client.post("/api/like", json={"cafe_id": 0})
+            self.assertEqual(resp.status_code, 404)
+
+    def test_reader_waits_for_flush_in_progress(self):
+        a, b = self.cafe_ids
+        writing = threading.Event()
+        write = like_buffer._write
+
+        def slow_write(intents):
+            writing.set()
+            time.sleep(0.2)
+            write(intents)
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            # the same cafe, however its id is sent
+            client.post("/api/like", json={"cafe_id": str(a)})
+            client.post("/api/like", json={"cafe_id": a})
+            self.assertEqual(like_buffer.stats()['pending'], 1)
+
+            with patch.object(like_buffer, '_write', slow_write):
+                flusher = threading.Thread(target=like_buffer.flush)
+                flusher.start()
+                writing.wait()
+                resp = client.get(f"/api/cafes/{a}/state")
+                flusher.join()
+
+            self.assertEqual(resp.json, dict(liked=True, admin=False))
+
+    def test_flushes_when_full(self):
+        app.config['LIKE_BUFFER_MAX_EVENTS'] = 2
+        flushed = like_buffer.stats()['flushed']
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            for cafe_id in self.cafe_ids:
+                client.post("/api/like", json={"cafe_id": cafe_id})
+
+        for _ in range(100):
+            if like_buffer.stats()['flushed'] == flushed + 2:
+                break
+            time.sleep(0.05)
+
+        self.assertEqual(self.stored_likes(), self.cafe_ids)
+
+    def test_shutdown_flushes(self):
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+            client.post("/api/like", json={"cafe_id": self.cafe_ids[0]})
+
+        like_buffer.shutdown()
+        self.assertEqual(self.stored_likes(), [self.cafe_ids[0]])
+
+
+class RateLimitTestCase(TestCase):
+    """Tests for rate limits & shedding load."""
+
+    def setUp(self):
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+
+        user = User.register(**TEST_USER_DATA)
+        db.session.add(user)
+        db.session.add(City(**CITY_DATA))
+        cafe = Cafe(**CAFE_DATA)
+        db.session.add(cafe)
+        db.session.commit()
+
+        self.user_id = user.id
+        self.cafe_id = cafe.id
+
+        rate_limiter.backend.clear()
+        rate_limiter.reset_stats()
+
+    def tearDown(self):
+        UserLikesCafe.query.delete()
+        User.query.delete()
+        Cafe.query.delete()
+        City.query.delete()
+        db.session.commit()
+
+        app.config['RATE_LIMITS'] = {}
+        app.config['MAX_IN_FLIGHT'] = 64
+
+    def test_parse_limit(self):
+        self.assertEqual(parse_limit("10/minute"), (10 / 60, 10))
+        self.assertEqual(parse_limit("2/second"), (2, 2))
+
+        for bad in ["10", "ten/minute", "10/fortnight", "0/minute"]:
+            with self.assertRaises(ValueError):
+                parse_limit(bad)
+
+    def test_login_limit(self):
+        app.config['RATE_LIMITS'] = {'views.login_user': '2/minute'}
+        login = {"username": "test", "password": "WRONG"}
+
+        with app.test_client() as client:
+            self.assertEqual(client.post("/login", data=login).status_code,
+                             200)
+            self.assertEqual(client.post("/login", data=login).status_code,
+                             200)
+
+            resp = client.post("/login", data=login)
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.headers['Retry-After'], '30')
+            self.assertIn(b"Slow down!", resp.data)
+
+            # only requests that change things are limited
+            self.assertEqual(client.get("/login").status_code, 200)
+
+            # ...and each client has its own limit
+            resp = client.post("/login", data=login,
+                               environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(resp.status_code, 200)
+
+        self.assertEqual(rate_limiter.stats()['limited'], 1)
+
+    def test_like_limit_per_user(self):
+        app.config['RATE_LIMITS'] = {'views.like_cafe': '1/minute'}
+        like = {"cafe_id": self.cafe_id}
+
+        with app.test_client() as client:
+            do_login(client, self.user_id)
+
+            resp = client.post("/api/like", json=like)
+            self.assertEqual(resp.status_code, 200)
+
+            # a different address doesn't get the user a new limit
+            resp = client.post("/api/like", json=like,
+                               environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(resp.status_code, 429)
+            self.assertEqual(resp.json, {"error": "Too many requests"})
+
+        other = User.register(**dict(TEST_USER_DATA, username="other",
+                                     email="other@test.com"))
+        db.session.add(other)
+        db.session.commit()
+
+        with app.test_client() as client:
+            do_login(client, other.id)
+
+            # ...and didn't use up that address's limit
+            resp = client.post("/api/like", json=like,
+                               environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(resp.status_code, 200)
+
+    def test_shed_load(self):
+        app.config['MAX_IN_FLIGHT'] = 1
+
+        with app.test_client() as client:
+            resp = client.get("/")
+            self.assertEqual(resp.status_code, 200)
+
+            rate_limiter.in_flight += 1
+            try:
+                resp = client.get("/")
+            finally:
+                rate_limiter.in_flight -= 1
+
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+
+        self.assertEqual(rate_limiter.stats(),
+                         dict(limited=0, shed=1, in_flight=0))
+
+    def test_sqlite_backend_shared(self):
+        path = app.config['RATE_LIMIT_DB']
+
+        with tempfile.TemporaryDirectory() as directory:
+            app.config['RATE_LIMIT_DB'] = os.path.join(directory, 'rl.db')
+
+            try:
+                # as if in two worker processes
+                first = SQLiteBackend(app)
+                second = SQLiteBackend(app)
+            finally:
+                app.config['RATE_LIMIT_DB'] = path
+
+            now = time.time()
+            self.assertEqual(first.take(['k'], 1, 2, now), 0)
+            self.assertEqual(second.take(['k'], 1, 2, now), 0)
+            self.assertEqual(first.take(['k'], 1, 2, now), 1)
+
+            # a token comes back each second
+            self.assertEqual(second.take(['k'], 1, 2, now + 1), 0)
+
+            # none are taken unless every bucket has one
+            self.assertEqual(first.take(['j', 'k'], 1, 2, now + 1), 1)
+            self.assertEqual(first.take(['j'], 1, 2, now + 1), 0)
+            self.assertEqual(first.take(['j'], 1, 2, now + 1), 0)
+
+    def test_sqlite_backend_bare_filename(self):
+        path = app.config['RATE_LIMIT_DB']
+        cwd = os.getcwd()
+
+        with tempfile.TemporaryDirectory() as directory:
+            os.chdir(directory)
+            app.config['RATE_LIMIT_DB'] = 'rl.db'
+
+            try:
+                backend = SQLiteBackend(app)
+                self.assertEqual(backend.take(['k'], 1, 2, time.time()), 0)
+            finally:
+                app.config['RATE_LIMIT_DB'] = path
+                os.chdir(cwd)
@@ -0,0 +1,5 @@
+"""Production entry point, for a WSGI server: gunicorn wsgi:app"""
+
+from app import create_app
+
+app = create_app('prod')